@@ -3,9 +3,79 @@ path_to_save_csv = 'PATH_TO_SAVE_CSV'
 path_to_save_segmentations = 'PATH_TO_SAVE_SEGMENTATIONS'
 path_to_save_models = 'PATH_TO_SAVE_MODELS'
 nvidia_server_address = 'NVIDIA_SERVER_ADDRESS'
+# 'obj' saves the model of the segment, as the module does; 'ply' or 'stl' opt in to meshing the mask into a compact binary file
+model_format = 'obj'
+# Volumes read ahead, and segmented volumes waiting for their outputs to be written, at most
+queue_size = 2
+# Volumes segmented together by the model in one batch, and seconds the first one waits for the others
+inference_batch_size = 4
+inference_batch_wait = 0.5
+import shutil
+import tempfile
 from pathlib import Path
-for path in Path(path_to_volumes).rglob('*.nrrd'):
-	[success, masterVolumeNode] = slicer.util.loadVolume(str(path), returnNode=True)
+import numpy as np
+import temporal_bone_batching
+import temporal_bone_cache
+import temporal_bone_inference
+import temporal_bone_mesh
+import temporal_bone_metrics
+import temporal_bone_mmap
+import temporal_bone_prefetch
+import temporal_bone_statistics
+from temporal_bone_slicer_module import TemporalBoneAutosegmentationLogic
+# Model outputs are cached by volume content, re-running the cohort only repeats the post-processing
+logic = TemporalBoneAutosegmentationLogic()
+# Statistics of the cochlear duct of every volume, one row per volume
+statisticsWriter = temporal_bone_statistics.StatisticsWriter(path_to_save_csv+'cochlear_duct_statistics.csv')
+# One client for the whole cohort, reusing its keep-alive connections, and the model list requested once
+client = logic.inferenceClient or logic.serverClient(nvidia_server_address)
+model_version = logic.modelVersions(client).get('cochlear_duct', '')
+batcher = temporal_bone_batching.MicroBatcher(client, inference_batch_size, inference_batch_wait)
+inference_directory = tempfile.mkdtemp(prefix='TemporalBoneBatch-')
+## Read and decompress the next volume in the background, while the current one is segmented
+def load_volume(path):
+	# Per-stage metrics of each volume, one line per volume in metrics.jsonl
+	item = {'path': path, 'name': path.name[0:-5], 'array': None,
+		'metrics': temporal_bone_metrics.RunMetrics(volume=path.name[0:-5], path=str(path))}
+	with item['metrics'].stage('load'):
+		try:
+			# Mapped rather than decoded: the volumes waiting in the queue do not hold their voxels in memory
+			array, header = temporal_bone_mmap.openNrrd(str(path), logic.volumeCache)
+			item['ijkToRAS'] = temporal_bone_inference.nrrdIJKToRAS(header)
+			item['array'] = array
+		except (temporal_bone_inference.AIAAException, KeyError, ValueError):
+			# Files the reader does not handle are loaded by Slicer when they are segmented
+			pass
+	return item
+## Segment the volume with the model in the background, in batches with the other volumes in flight
+def infer_volume(item):
+	if item['array'] is None:
+		return item
+	with item['metrics'].stage('model:cochlear_duct'):
+		key = temporal_bone_cache.cacheKey(temporal_bone_cache.volumeArrayDigest(item['array'], item['ijkToRAS']),
+			'cochlear_duct', model_version)
+		cachedFile = logic.inferenceCache.get(key) if logic.inferenceCache else None
+		item['metrics'].increment('inferenceCacheHits' if cachedFile else 'inferenceCacheMisses')
+		if cachedFile:
+			item['labelmapFile'] = cachedFile
+		else:
+			labelmapFile = inference_directory + '/' + item['name'] + '.nrrd'
+			batcher.segmentation('cochlear_duct', item['array'], item['ijkToRAS'], labelmapFile, decode=False)
+			item['labelmapFile'] = logic.inferenceCache.put(key, labelmapFile, move=True) if logic.inferenceCache else labelmapFile
+	return item
+## Segment the volume on the main thread, the only one using the scene
+def segment_volume(item):
+	logic.metrics = item['metrics']
+	if item['array'] is not None:
+		masterVolumeNode = slicer.util.addVolumeFromArray(item['array'], ijkToRAS=item['ijkToRAS'], name=item['name'])
+	else:
+		with logic.metrics.stage('load'):
+			[success, masterVolumeNode] = slicer.util.loadVolume(str(item['path']), returnNode=True)
+		item['array'] = slicer.util.arrayFromVolume(masterVolumeNode).copy()
+		ijkToRAS = vtk.vtkMatrix4x4()
+		masterVolumeNode.GetIJKToRASMatrix(ijkToRAS)
+		item['ijkToRAS'] = slicer.util.arrayFromVTKMatrix(ijkToRAS)
+	item['spacing'] = masterVolumeNode.GetSpacing()
 	# Create segmentation
 	segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
 	segmentationNode.CreateDefaultDisplayNodes() # only needed for display
@@ -17,14 +87,13 @@ for path in Path(path_to_volumes).rglob('*.nrrd'):
 	segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
 	segmentEditorWidget.setSegmentationNode(segmentationNode)
 	segmentEditorWidget.setMasterVolumeNode(masterVolumeNode)
-	# NVIDIA auto segmentation
-	segmentEditorWidget.setActiveEffectByName("Nvidia AIAA")
-	effect = segmentEditorWidget.activeEffect()
-	serverUrl = nvidia_server_address
-	effect.self().ui.serverComboBox.currentText = serverUrl
-	effect.self().onClickFetchModels()
-	effect.self().ui.segmentationModelSelector.currentText = "cochlear_duct"
-	effect.self().onClickSegmentation()
+	# NVIDIA auto segmentation, already run by the inference stage unless Slicer loaded the volume
+	with logic.metrics.stage('inference'):
+		if 'labelmapFile' in item:
+			logic.importModelResult(segmentationNode, 'cochlear_duct', item['labelmapFile'])
+		else:
+			logic.runInference({"cochlear_duct": masterVolumeNode},
+				lambda modelName, labelmapFile: logic.importModelResult(segmentationNode, modelName, labelmapFile), nvidia_server_address)
 	cochlea = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName("cochlear_duct")
 	segmentationNode.GetSegmentation().GetSegment(cochlea).SetColor(1,0,0)
 	segmentEditorWidget.setCurrentSegmentID(cochlea)
@@ -35,7 +104,7 @@ for path in Path(path_to_volumes).rglob('*.nrrd'):
 	effect = segmentEditorWidget.activeEffect()
 	effect.setParameter("Operation", 'KEEP_LARGEST_ISLAND')	
 	effect.setParameter("MinimumSize", 100)
-	effect.self().onApply()	
+	logic.applyEffect(effect)
 	#Turn mask range on
 	segmentEditorNode.MasterVolumeIntensityMaskOn()
 	#smoothing the cochlea
@@ -44,34 +113,47 @@ for path in Path(path_to_volumes).rglob('*.nrrd'):
 	effect = segmentEditorWidget.activeEffect()
 	effect.setParameter("SmoothingMethod", "MEDIAN")
 	effect.setParameter("KernelSizeMm", 0.3)	
-	effect.self().onApply()
+	logic.applyEffect(effect)
 	#Turn mask range off
 	segmentEditorNode.MasterVolumeIntensityMaskOff()
-	## Create table	
-	resultsTableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode')
-	## Use segmentStatistics to calculate the volume and export	
-	import SegmentStatistics
-	segStatLogic = SegmentStatistics.SegmentStatisticsLogic()
-	segStatLogic.getParameterNode().SetParameter("Segmentation", segmentationNode.GetID())
-	segStatLogic.getParameterNode().SetParameter("ScalarVolume", masterVolumeNode.GetID())
-	segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.enabled","False")
-	segStatLogic.getParameterNode().SetParameter("ScalarVolumeSegmentStatisticsPlugin.voxel_count.enabled","False")
-	segStatLogic.computeStatistics()
-	segStatLogic.exportToTable(resultsTableNode)
-	segStatLogic.showTable(resultsTableNode)
-	#prepare and save the segmentation	
-	seg = getNode('Segmentation')
-	##Get the segment vtk representation 
-	segmentationNode = getNode("vtkMRMLSegmentationNode1")
-	cochlea_vtk = segmentationNode.GetSegmentation().GetSegment(cochlea)
-	##Create Model
-	modelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode')
-	##Export segment to model
-	slicer.modules.segmentations.logic().ExportSegmentToRepresentationNode(cochlea_vtk, modelNode)
-	##  save model
-	saveNode(modelNode, path_to_save_models +(path.name[0:-5])+ '.obj')
-	saveNode(seg, path_to_save_segmentations + (path.name[0:-5])+'.seg.nrrd')
-	##save the table as cvs file
-	saveNode(resultsTableNode, path_to_save_csv'+(path.name[0:-5])+'.csv')
+	item['cochlea'] = slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, cochlea, masterVolumeNode) > 0
+	if model_format == 'obj':
+		##  save model
+		with logic.metrics.stage('export'):
+			##Get the segment vtk representation 
+			cochlea_vtk = segmentationNode.GetSegmentation().GetSegment(cochlea)
+			##Create Model
+			modelNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLModelNode')
+			##Export segment to model
+			slicer.modules.segmentations.logic().ExportSegmentToRepresentationNode(cochlea_vtk, modelNode)
+			saveNode(modelNode, path_to_save_models +item['name']+ '.obj')
 	slicer.mrmlScene.Clear(0)
-
+	return item
+## Compress and write the outputs of the volume in the background, while the next one is segmented
+def write_outputs(item):
+	metrics = item['metrics']
+	## Compute the volume and intensity statistics from the mask and append them to the cohort file
+	with metrics.stage('statistics'):
+		statistics = temporal_bone_statistics.structureStatistics(item['cochlea'], item['spacing'], item['ijkToRAS'], item['array'])
+		statistics.update(volume=item['name'], structure='cochlear_duct')
+		statisticsWriter.write([statistics])
+	with metrics.stage('export'):
+		if model_format != 'obj':
+			## Mesh the mask of the cochlear duct, in the LPS coordinates of the OBJ files
+			polyData = temporal_bone_mesh.maskToPolyData(item['cochlea'], item['ijkToRAS'])
+			temporal_bone_mesh.writeMesh(polyData, path_to_save_models +item['name']+ '.' + model_format)
+		#save the segmentation
+		temporal_bone_inference.writeSegmentationNrrd(path_to_save_segmentations + item['name']+'.seg.nrrd',
+			item['cochlea'].astype(np.uint8), item['ijkToRAS'], [(1, 'cochlear_duct', (1, 0, 0))])
+	metrics.finish()
+	metrics.writeJsonLines(path_to_save_csv+'metrics.jsonl')
+	return item['name']
+pipeline = temporal_bone_prefetch.PrefetchPipeline([('load', load_volume, 1), ('infer', infer_volume, inference_batch_size),
+	('segment', segment_volume, 0), ('write', write_outputs, 1)], max(queue_size, inference_batch_size))
+pipeline.run(Path(path_to_volumes).rglob('*.nrrd'))
+batcher.close()
+shutil.rmtree(inference_directory, ignore_errors=True)
+statisticsWriter.close()
+print('Inference batches: %s' % batcher.statistics())
+## Queue depths and busy time of each stage, to tune queue_size
+pipeline.logStatistics()
@@ -0,0 +1,379 @@
+"""
+Headless batch segmentation of a directory of temporal bone CT volumes.
+
+Volumes are spread over a pool of headless Slicer processes, each running
+TemporalBoneAutosegmentationLogic.run on one volume. Every finished attempt is
+appended to a manifest in the output directory, so an interrupted cohort can be
+restarted with the same command and only the remaining volumes are processed.
+
+  python batch_segmentation.py --slicer /opt/Slicer/Slicer --workers 8 VOLUMES_DIR OUTPUT_DIR
+
+With --model-directory the models run on the CPU of each worker (see
+temporal_bone_local_inference) and no AIAA server is needed. With --service the volumes are
+sent to a running temporal_bone_service instead, which keeps Slicer, its segment editor and the
+model list warm between volumes, and the p50/p99 latency per volume is printed at the end.
+Urgent jobs submitted while a cohort sent with --priority research is queued run first.
+
+Each volume is written to OUTPUT_DIR/<relative directory>/<volume name>/, and its per-stage
+timings, memory and I/O are appended to OUTPUT_DIR/metrics.jsonl. The volume, surface area,
+bounding box, centroid and intensity statistics of every structure are appended to
+OUTPUT_DIR/statistics.csv; a --statistics-file ending in .parquet gets a part file per volume
+from the workers, merged into it at the end of the batch. The worker side of this script is run by Slicer itself:
+
+  Slicer --no-main-window --python-script batch_segmentation.py --worker VOLUME.nrrd OUTPUT_DIR/VOLUME
+
+A worker started with --progress-file appends a JSON line {"stage", "percent"} to it as each
+stage starts, and one started with --cancel-file stops at its next stage once that file exists.
+The module widget runs its background queue this way.
+"""
+
+import argparse
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+
+MANIFEST_NAME = 'manifest.jsonl'
+METRICS_NAME = 'metrics.jsonl'
+STATISTICS_NAME = 'statistics.csv'
+# Directory next to a Parquet statistics file receiving the part file of each volume
+STATISTICS_PARTS_SUFFIX = '.parts'
+
+# Exit code of a worker stopped through its cancel file
+CANCELLED_EXIT_CODE = 3
+
+
+def volumeName(path):
+  """
+  Name of a volume file without its (possibly double) extension.
+  """
+  name = path.name
+  for extension in ('.seg.nrrd', '.nii.gz', '.nrrd', '.nhdr', '.nii', '.mha', '.mhd'):
+    if name.endswith(extension):
+      return name[:-len(extension)]
+  return path.stem
+
+
+def readManifest(manifestPath):
+  """
+  Return the latest manifest record of each volume, keyed by volume path.
+  A truncated last line, left by a crash while writing, is ignored.
+  """
+  records = {}
+  if not manifestPath.exists():
+    return records
+  with open(manifestPath) as manifestFile:
+    for line in manifestFile:
+      try:
+        record = json.loads(line)
+      except ValueError:
+        continue
+      records[record['volume']] = record
+  return records
+
+
+class Manifest:
+  """
+  Append-only JSON lines log of segmentation attempts, safe to share between worker threads.
+  """
+
+  def __init__(self, manifestPath):
+    self.lock = threading.Lock()
+    self.file = open(manifestPath, 'a')
+
+  def write(self, record):
+    with self.lock:
+      self.file.write(json.dumps(record) + '\n')
+      self.file.flush()
+      os.fsync(self.file.fileno())
+
+  def close(self):
+    self.file.close()
+
+
+def statisticsPath(args):
+  return os.path.abspath(args.statistics_file or os.path.join(args.output_directory, STATISTICS_NAME))
+
+
+def statisticsPartPath(args, outputDirectory):
+  """
+  Parquet part file of the statistics of a volume, the same for every attempt at the volume so that
+  a retry replaces the rows of a failed attempt.
+  """
+  import hashlib
+  relativeDirectory = os.path.relpath(str(outputDirectory), args.output_directory)
+  digest = hashlib.blake2b(relativeDirectory.encode('utf-8'), digest_size=8).hexdigest()
+  return os.path.join(statisticsPath(args) + STATISTICS_PARTS_SUFFIX, '%s-%s.parquet' % (outputDirectory.name, digest))
+
+
+def runWorkerProcess(args, volumePath, outputDirectory):
+  """
+  Segment one volume in a new headless Slicer process.
+  :return: (success, error message)
+  """
+  command = [args.slicer, '--no-splash', '--no-main-window', '--python-script', os.path.abspath(__file__),
+    '--worker', str(volumePath), str(outputDirectory)]
+  for option in ('no_labelmaps', 'no_obj', 'no_median', 'no_dicom', 'crop_to_roi'):
+    if getattr(args, option):
+      command.append('--' + option.replace('_', '-'))
+  command += ['--metrics-file', os.path.abspath(args.metrics_file or os.path.join(args.output_directory, METRICS_NAME))]
+  command += ['--dicom-format', args.dicom_format] + (['--dicom-segmentation'] if args.dicom_segmentation else [])
+  command += ['--mesh-format', args.mesh_format, '--mesh-levels'] + [str(level) for level in args.mesh_levels]
+  # A Parquet file has a single writer, each worker writes the part file of its volume
+  command += ['--statistics-file', statisticsPartPath(args, outputDirectory) if statisticsPath(args).endswith('.parquet')
+    else statisticsPath(args)]
+  if args.prometheus_textfile:
+    command += ['--prometheus-textfile', os.path.abspath(args.prometheus_textfile)]
+  if args.model_directory:
+    command += ['--model-directory', os.path.abspath(args.model_directory), '--tile-overlap', str(args.tile_overlap),
+      '--tile-batch-size', str(args.tile_batch_size), '--threads-per-worker', str(args.threads_per_worker)]
+
+  # Keep each Slicer process to its own share of the cores so that throughput scales with the worker count
+  environment = dict(os.environ)
+  if args.threads_per_worker:
+    for variable in ('ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+      environment[variable] = str(args.threads_per_worker)
+
+  outputDirectory.mkdir(parents=True, exist_ok=True)
+  with open(outputDirectory / 'slicer.log', 'a') as logFile:
+    process = subprocess.Popen(command, stdout=logFile, stderr=subprocess.STDOUT, env=environment)
+    try:
+      returnCode = process.wait(timeout=args.timeout)
+    except subprocess.TimeoutExpired:
+      process.kill()
+      process.wait()
+      return False, 'timed out after %d s' % args.timeout
+  if returnCode != 0:
+    return False, 'Slicer exited with code %d, see %s' % (returnCode, outputDirectory / 'slicer.log')
+  return True, None
+
+
+def runServiceJob(args, volumePath, outputDirectory):
+  """
+  Segment one volume with a running temporal_bone_service.
+  :return: (success, error message)
+  """
+  import temporal_bone_service
+  client = temporal_bone_service.ServiceClient(args.service, timeout=args.timeout + 60)
+  options = {'exportlabelmaps': not args.no_labelmaps, 'exportOBJ': not args.no_obj, 'medianFilter': not args.no_median,
+    'exportDICOM': not args.no_dicom, 'dicomFormat': args.dicom_format, 'dicomSegmentation': args.dicom_segmentation,
+    'meshFormat': args.mesh_format, 'meshLevels': args.mesh_levels, 'priority': args.priority, 'cropToROI': args.crop_to_roi}
+  try:
+    job = client.submit(volumePath, outputDirectory, **options)
+    record = client.wait(job['id'], timeout=args.timeout)
+    if record['status'] in ('queued', 'running'):
+      client.cancel(job['id'])
+      return False, 'timed out after %d s' % args.timeout
+  except (OSError, RuntimeError) as error:
+    return False, 'service request failed: %s' % error
+  if record['status'] != 'done':
+    return False, record.get('error') or record['status']
+  return True, None
+
+
+def runBatch(args):
+  outputRoot = Path(args.output_directory)
+  outputRoot.mkdir(parents=True, exist_ok=True)
+  manifestPath = outputRoot / MANIFEST_NAME
+  previousRecords = readManifest(manifestPath)
+
+  inputRoot = Path(args.input_directory)
+  jobs = queue.Queue()
+  skipped = 0
+  for volumePath in sorted(inputRoot.rglob(args.pattern)):
+    record = previousRecords.get(str(volumePath))
+    if record and (record['status'] == 'done' or (record['status'] == 'failed' and not args.retry_failed)):
+      skipped += 1
+      continue
+    # A volume interrupted between retries keeps the attempts it already used
+    attempts = record['attempts'] if record and record['status'] == 'retrying' else 0
+    jobs.put((volumePath, attempts))
+  total = jobs.qsize()
+  print('%d volumes to segment, %d already in the manifest' % (total, skipped))
+
+  manifest = Manifest(manifestPath)
+  if not args.service:
+    import temporal_bone_statistics
+    if statisticsPath(args).endswith('.parquet'):
+      os.makedirs(statisticsPath(args) + STATISTICS_PARTS_SUFFIX, exist_ok=True)
+    else:
+      # The workers only append rows, the header is written before they start
+      temporal_bone_statistics.StatisticsWriter(statisticsPath(args))
+  counts = {'done': 0, 'failed': 0}
+  latencies = []
+  countsLock = threading.Lock()
+  startTime = time.time()
+
+  def worker():
+    while True:
+      try:
+        volumePath, attempts = jobs.get_nowait()
+      except queue.Empty:
+        return
+      attempts += 1
+      attemptStart = time.time()
+      outputDirectory = outputRoot / volumePath.parent.relative_to(inputRoot) / volumeName(volumePath)
+      if args.service:
+        success, error = runServiceJob(args, volumePath, outputDirectory)
+      else:
+        success, error = runWorkerProcess(args, volumePath, outputDirectory)
+      status = 'done' if success else ('retrying' if attempts <= args.retries else 'failed')
+      manifest.write({'volume': str(volumePath), 'status': status, 'attempts': attempts,
+        'seconds': round(time.time() - attemptStart, 2), 'error': error})
+      if status == 'retrying':
+        jobs.put((volumePath, attempts))
+        continue
+      with countsLock:
+        counts[status] += 1
+        if success:
+          latencies.append(time.time() - attemptStart)
+        finished = counts['done'] + counts['failed']
+        elapsedHours = (time.time() - startTime) / 3600
+      print('[%d/%d] %s %s%s (%.1f volumes/hour)' % (finished, total, status, volumePath.name,
+        ': ' + error if error else '', finished / elapsedHours if elapsedHours else 0))
+
+  threads = [threading.Thread(target=worker) for _ in range(args.workers)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  manifest.close()
+  if not args.service and statisticsPath(args).endswith('.parquet'):
+    # Parts left by an interrupted batch are merged too
+    partsDirectory = statisticsPath(args) + STATISTICS_PARTS_SUFFIX
+    temporal_bone_statistics.mergeParquetParts(statisticsPath(args),
+      sorted(os.path.join(partsDirectory, name) for name in os.listdir(partsDirectory) if name.endswith('.parquet')))
+
+  print('Finished: %d done, %d failed in %.1f min' % (counts['done'], counts['failed'], (time.time() - startTime) / 60))
+  if latencies:
+    import temporal_bone_service
+    print('Latency per volume: p50 %.1f s, p99 %.1f s' % (temporal_bone_service.percentile(latencies, 0.5),
+      temporal_bone_service.percentile(latencies, 0.99)))
+  return 0 if counts['failed'] == 0 else 1
+
+
+class CancelFile:
+  """
+  Cancellation flag of a worker, set by creating a file (see TemporalBoneAutosegmentationLogic.cancelEvent).
+  """
+
+  def __init__(self, path):
+    self.path = path
+
+  def is_set(self):
+    return os.path.exists(self.path)
+
+
+def runWorker(args):
+  """
+  Segment a single volume. Runs inside Slicer.
+  """
+  import slicer
+  sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+  from temporal_bone_slicer_module import TemporalBoneAutosegmentationLogic
+
+  logic = TemporalBoneAutosegmentationLogic()
+  logic.metricsJsonLinesPath = args.metrics_file
+  logic.metricsPrometheusPath = args.prometheus_textfile
+  logic.metricsLabels = {'path': args.input_directory}
+  logic.meshFormat = args.mesh_format
+  logic.dicomFormat = args.dicom_format
+  logic.dicomSegmentation = args.dicom_segmentation
+  logic.meshLevels = args.mesh_levels
+  if args.statistics_file:
+    import temporal_bone_statistics
+    logic.statisticsWriter = temporal_bone_statistics.StatisticsWriter(args.statistics_file)
+  if args.progress_file:
+    def reportProgress(stage, percent):
+      with open(args.progress_file, 'a') as progressFile:
+        progressFile.write(json.dumps({'stage': stage, 'percent': percent}) + '\n')
+    logic.progressCallback = reportProgress
+  if args.cancel_file:
+    logic.cancelEvent = CancelFile(args.cancel_file)
+  try:
+    crops = None
+    if args.crop_to_roi:
+      inputVolume, crops = logic.loadTemporalBoneCrops(args.input_directory)
+    else:
+      inputVolume = logic.loadVolume(args.input_directory)
+    if args.model_directory:
+      import temporal_bone_local_inference
+      logic.inferenceClient = temporal_bone_local_inference.LocalInferenceClient(args.model_directory,
+        threads=args.threads_per_worker or None, overlap=args.tile_overlap, batchSize=args.tile_batch_size)
+    logic.run(inputVolume, args.output_directory, exportlabelmaps=not args.no_labelmaps,
+      exportOBJ=not args.no_obj, medianFilter=not args.no_median, exportDICOM=not args.no_dicom, showResult=False,
+      cropToROI=args.crop_to_roi, crops=crops)
+  except Exception:
+    import traceback
+    traceback.print_exc()
+    if logic.metrics.labels.get('status') == 'cancelled':
+      return CANCELLED_EXIT_CODE
+    # Volumes that failed before run() started still get their record
+    if args.metrics_file and 'status' not in logic.metrics.labels:
+      import temporal_bone_metrics
+      metrics = temporal_bone_metrics.RunMetrics(path=args.input_directory, volume=volumeName(Path(args.input_directory)), status='failed')
+      metrics.finish()
+      metrics.writeJsonLines(args.metrics_file)
+    return 1
+  finally:
+    if logic.statisticsWriter:
+      logic.statisticsWriter.close()
+  return 0
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('input_directory', help='directory searched recursively for volumes (volume file with --worker)')
+  parser.add_argument('output_directory')
+  parser.add_argument('--slicer', default='Slicer', help='Slicer executable')
+  parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of concurrent Slicer processes')
+  parser.add_argument('--threads-per-worker', type=int, default=1, help='ITK/OpenMP threads per Slicer process, 0 to leave unset')
+  parser.add_argument('--timeout', type=int, default=1800, help='seconds allowed per volume before the worker is killed')
+  parser.add_argument('--retries', type=int, default=2, help='times a failed volume is retried')
+  parser.add_argument('--retry-failed', action='store_true', help='retry volumes that failed in a previous batch')
+  parser.add_argument('--pattern', default='*.nrrd', help='glob of the volume files')
+  parser.add_argument('--no-labelmaps', action='store_true')
+  parser.add_argument('--no-obj', action='store_true')
+  parser.add_argument('--no-median', action='store_true')
+  parser.add_argument('--crop-to-roi', action='store_true', help='segment only the crops of both temporal bones, '
+    'loaded from the memory-mapped NRRD files without reading the whole volume into memory')
+  parser.add_argument('--no-dicom', action='store_true')
+  parser.add_argument('--dicom-format', choices=['classic', 'enhanced', 'slicer'], default='slicer',
+    help='DICOM export of the volume: a file per slice or a single Enhanced CT file written with pydicom, or through '
+    'the Slicer DICOM module')
+  parser.add_argument('--dicom-segmentation', action='store_true', help='also export the structures as a DICOM Segmentation object')
+  parser.add_argument('--mesh-format', choices=['obj', 'ply', 'stl'], default='obj',
+    help='format of the structure surfaces; ply and stl are binary and meshed in parallel')
+  parser.add_argument('--mesh-levels', type=float, nargs='+', default=[0.0],
+    help='decimation target reduction of each level of detail of ply/stl meshes, for example 0 0.75 0.95')
+  parser.add_argument('--model-directory', help='run the models on the CPU from the ONNX/TorchScript files of this directory '
+    'instead of requesting the AIAA server')
+  parser.add_argument('--tile-overlap', type=float, default=0.25, help='overlap of the sliding window tiles of local inference')
+  parser.add_argument('--tile-batch-size', type=int, default=1, help='tiles evaluated together by local inference')
+  parser.add_argument('--metrics-file', help='JSON lines file receiving the per-stage metrics of every volume '
+    '(default OUTPUT_DIR/%s)' % METRICS_NAME)
+  parser.add_argument('--statistics-file', help='CSV or .parquet file receiving the statistics of the structures of every '
+    'volume (default OUTPUT_DIR/%s)' % STATISTICS_NAME)
+  parser.add_argument('--prometheus-textfile', help='Prometheus textfile rewritten with the metrics of each finished volume')
+  parser.add_argument('--service', help='send the volumes to a running temporal_bone_service at http://HOST:PORT or '
+    'unix:SOCKET_PATH instead of starting a Slicer process per volume; its own metrics and statistics files are used')
+  parser.add_argument('--priority', choices=['urgent', 'routine', 'research'], default='routine',
+    help='priority class of the jobs sent to the service; queued urgent jobs run before routine and research ones')
+  parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+  parser.add_argument('--progress-file', help=argparse.SUPPRESS)
+  parser.add_argument('--cancel-file', help=argparse.SUPPRESS)
+  args = parser.parse_args(argv)
+  return runWorker(args) if args.worker else runBatch(args)
+
+
+if __name__ == '__main__':
+  exitCode = main(sys.argv[1:])
+  if 'slicer' in sys.modules:
+    import slicer
+    slicer.util.exit(exitCode)
+  else:
+    sys.exit(exitCode)
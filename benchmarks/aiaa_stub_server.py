@@ -0,0 +1,222 @@
+"""
+Local stand-in for the NVIDIA AIAA server, for benchmarking the inference stage.
+
+It implements the parts of the v1 API used by TemporalBoneAutosegmentationLogic
+(model list, sessions and segmentation) and answers every segmentation request
+with a small cube in the centre of the uploaded volume after an artificial delay.
+With --per-volume-latency, segmentation requests go through a single simulated GPU
+that runs the requests arriving while it is busy as one batch, as the dynamic
+batching of Triton does, taking latency + per-volume latency x batch size.
+
+  python benchmarks/aiaa_stub_server.py --port 8000 --latency 2.0 [--per-volume-latency 0.2]
+"""
+
+import argparse
+import email.parser
+import gzip
+import json
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+MODELS = ["inner_ear", "ossicles", "cochlear_duct", "facial_nerve", "sigmoid_sinus"]
+
+
+def parseNrrdHeader(data):
+  """
+  Split an attached-header NRRD file into its header fields and the raw data bytes.
+  """
+  headerEnd = data.index(b'\n\n')
+  fields = {}
+  for line in data[:headerEnd].decode('latin-1').splitlines()[1:]:
+    if line.startswith('#') or ': ' not in line:
+      continue
+    key, value = line.split(': ', 1)
+    fields[key] = value
+  return fields, data[headerEnd+2:]
+
+
+def cubeMask(header, cubeSize=16):
+  """
+  Build a gzip-encoded uint8 NRRD with the geometry of header and a cube of ones in the centre.
+  """
+  sizes = [int(size) for size in header['sizes'].split()]
+  mask = bytearray(sizes[0]*sizes[1]*sizes[2])
+  start = [max(0, size//2 - cubeSize//2) for size in sizes]
+  for k in range(start[2], min(sizes[2], start[2]+cubeSize)):
+    for j in range(start[1], min(sizes[1], start[1]+cubeSize)):
+      offset = (k*sizes[1] + j)*sizes[0]
+      mask[offset+start[0]:offset+min(sizes[0], start[0]+cubeSize)] = b'\x01'*min(cubeSize, sizes[0]-start[0])
+  lines = ['NRRD0004', 'type: unsigned char', 'dimension: 3', 'sizes: ' + header['sizes'],
+    'kinds: domain domain domain', 'endian: little', 'encoding: gzip']
+  for key in ('space', 'space directions', 'space origin'):
+    if key in header:
+      lines.append(key + ': ' + header[key])
+  return ('\n'.join(lines) + '\n\n').encode('latin-1') + gzip.compress(bytes(mask), compresslevel=1)
+
+
+class BatchingDevice:
+  """
+  Single accelerator running the queued requests together.
+  """
+
+  def __init__(self, latency, perVolumeLatency, maxBatchSize=16):
+    self.latency = latency
+    self.perVolumeLatency = perVolumeLatency
+    self.maxBatchSize = maxBatchSize
+    self.batchSizes = []
+    self.queue = []
+    self.condition = threading.Condition()
+    threading.Thread(target=self.loop, daemon=True).start()
+
+  def loop(self):
+    while True:
+      with self.condition:
+        while not self.queue:
+          self.condition.wait()
+        batch, self.queue = self.queue[:self.maxBatchSize], self.queue[self.maxBatchSize:]
+      self.batchSizes.append(len(batch))
+      time.sleep(self.latency + self.perVolumeLatency * len(batch))
+      for event in batch:
+        event.set()
+
+  def run(self):
+    event = threading.Event()
+    with self.condition:
+      self.queue.append(event)
+      self.condition.notify()
+    event.wait()
+
+
+def parseMultipart(contentType, body):
+  """
+  Return the parts of a multipart/form-data request body as a dict of name to bytes.
+  """
+  message = email.parser.BytesParser().parsebytes(b'Content-Type: ' + contentType.encode('latin-1') + b'\r\n\r\n' + body)
+  return {part.get_param('name', header='content-disposition'): part.get_payload(decode=True)
+    for part in message.get_payload()}
+
+
+class AIAAStubHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  # Headers and body are written separately, which stalls keep-alive connections on delayed acknowledgements otherwise
+  disable_nagle_algorithm = True
+  sessions = {}
+  sessionsLock = threading.Lock()
+  latency = 0.0
+  # BatchingDevice running the segmentation requests, None to sleep latency in every request thread
+  device = None
+  connections = 0
+
+  def setup(self):
+    BaseHTTPRequestHandler.setup(self)
+    with self.sessionsLock:
+      AIAAStubHandler.connections += 1
+
+  def log_message(self, format, *args):
+    pass
+
+  def readBody(self):
+    if self.headers.get('Transfer-Encoding', '').lower() != 'chunked':
+      return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    chunks = []
+    while True:
+      size = int(self.rfile.readline().split(b';')[0], 16)
+      if size == 0:
+        self.rfile.readline()
+        return b''.join(chunks)
+      chunks.append(self.rfile.read(size))
+      self.rfile.readline()
+
+  def sendJson(self, value, status=200):
+    body = json.dumps(value).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    url = urlparse(self.path)
+    if url.path.rstrip('/') == '/v1/models':
+      self.sendJson([{"name": name, "labels": [name], "type": "segmentation", "version": "stub"} for name in MODELS])
+    else:
+      self.sendJson({"error": "not found"}, 404)
+
+  def do_PUT(self):
+    url = urlparse(self.path)
+    if not url.path.startswith('/session'):
+      self.sendJson({"error": "not found"}, 404)
+      return
+    parts = parseMultipart(self.headers['Content-Type'], self.readBody())
+    image = next(iter(parts.values()))
+    sessionId = uuid.uuid4().hex
+    with self.sessionsLock:
+      self.sessions[sessionId] = parseNrrdHeader(image)[0]
+    self.sendJson({"session_id": sessionId})
+
+  def do_DELETE(self):
+    sessionId = urlparse(self.path).path.rstrip('/').split('/')[-1]
+    with self.sessionsLock:
+      self.sessions.pop(sessionId, None)
+    self.sendJson({})
+
+  def do_POST(self):
+    url = urlparse(self.path)
+    query = parse_qs(url.query)
+    if url.path.rstrip('/') != '/v1/segmentation' or query.get('model', [None])[0] not in MODELS:
+      self.sendJson({"error": "not found"}, 404)
+      return
+    body = self.readBody()
+    if 'session_id' in query:
+      with self.sessionsLock:
+        header = self.sessions.get(query['session_id'][0])
+      if header is None:
+        self.sendJson({"error": "session expired"}, 440)
+        return
+    else:
+      parts = parseMultipart(self.headers['Content-Type'], body)
+      header = parseNrrdHeader(parts['datapoint'])[0]
+    if self.device:
+      self.device.run()
+    else:
+      time.sleep(self.latency)
+
+    boundary = uuid.uuid4().hex
+    response = b''.join([
+      b'--' + boundary.encode() + b'\r\n',
+      b'Content-Disposition: form-data; name="params"\r\n',
+      b'Content-Type: application/json\r\n\r\n',
+      json.dumps({}).encode('utf-8') + b'\r\n',
+      b'--' + boundary.encode() + b'\r\n',
+      b'Content-Disposition: form-data; name="image"; filename="image.nrrd"\r\n',
+      b'Content-Type: application/octet-stream\r\n\r\n',
+      cubeMask(header) + b'\r\n',
+      b'--' + boundary.encode() + b'--\r\n'])
+    self.send_response(200)
+    self.send_header('Content-Type', 'multipart/form-data; boundary=' + boundary)
+    self.send_header('Content-Length', str(len(response)))
+    self.end_headers()
+    self.wfile.write(response)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=8000)
+  parser.add_argument('--latency', type=float, default=1.0, help='seconds added to every segmentation request')
+  parser.add_argument('--per-volume-latency', type=float, help='run the segmentation requests in batches on one simulated GPU, '
+    'taking this many seconds per volume on top of --latency per batch')
+  args = parser.parse_args()
+  AIAAStubHandler.latency = args.latency
+  if args.per_volume_latency is not None:
+    AIAAStubHandler.device = BatchingDevice(args.latency, args.per_volume_latency)
+  server = ThreadingHTTPServer((args.host, args.port), AIAAStubHandler)
+  print('AIAA stub server on http://%s:%d (latency %.2f s)' % (args.host, args.port, args.latency))
+  server.serve_forever()
+
+
+if __name__ == '__main__':
+  main()
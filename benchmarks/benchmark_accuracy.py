@@ -0,0 +1,66 @@
+"""
+Time to compare a cohort of segmentation outputs with temporal_bone_accuracy.
+
+Writes the structures of phantoms as the labelmap files of a reference run, and of a
+candidate run where one structure per volume is grown by a voxel, then times
+compareDirectories on the two runs with every worker count.
+
+  python benchmarks/benchmark_accuracy.py [--volumes 8] [--shape 240 240 144] [--workers 1 4]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from scipy import ndimage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import temporal_bone_accuracy
+import temporal_bone_inference
+from phantoms import makePhantom
+
+# Labelmap file of each model, as TemporalBoneAutosegmentationLogic exports them
+LABELMAP_NAMES = {"inner_ear": "oticcapsule_labelmap", "ossicles": "ossicles_labelmap",
+  "cochlear_duct": "cochlear_duct_labelmap", "facial_nerve": "facial_labelmap", "sigmoid_sinus": "sigmoid_labelmap"}
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--volumes', type=int, default=8)
+  parser.add_argument('--shape', type=int, nargs=3, default=[240, 240, 144], help='phantom size, IJK order')
+  parser.add_argument('--workers', type=int, nargs='+', default=sorted({1, os.cpu_count() or 1}))
+  args = parser.parse_args(argv)
+
+  directory = tempfile.mkdtemp(prefix='TemporalBoneAccuracy-')
+  ijkToRAS = [[-0.25, 0, 0, 0], [0, -0.25, 0, 0], [0, 0, 0.25, 0], [0, 0, 0, 1]]
+  try:
+    for index in range(args.volumes):
+      # Post-processed structures have no islands left
+      masks = makePhantom(args.shape, (0.25, 0.25, 0.25), seed=index, islands=0)[1]
+      changedModel = list(LABELMAP_NAMES)[index % len(LABELMAP_NAMES)]
+      for run in ('reference', 'candidate'):
+        volumeDirectory = os.path.join(directory, run, 'volume%d' % index)
+        os.makedirs(volumeDirectory)
+        for modelName, labelmapName in LABELMAP_NAMES.items():
+          mask = masks[modelName]
+          if run == 'candidate' and modelName == changedModel:
+            mask = ndimage.binary_dilation(mask)
+          temporal_bone_inference.writeNrrd(os.path.join(volumeDirectory, labelmapName + '.nrrd'), mask.astype(np.uint8), ijkToRAS)
+    print('%d volumes of %s voxels, %d labelmaps per run' % (args.volumes, 'x'.join(map(str, args.shape)), args.volumes * len(LABELMAP_NAMES)))
+    print('%8s %9s %8s %8s' % ('workers', 'time (s)', 'passed', 'failed'))
+    for workers in args.workers:
+      startTime = time.perf_counter()
+      rows = temporal_bone_accuracy.compareDirectories(os.path.join(directory, 'reference'), os.path.join(directory, 'candidate'),
+        workers=workers)
+      passed = sum(1 for row in rows if row['passed'])
+      print('%8d %9.2f %8d %8d' % (workers, time.perf_counter() - startTime, passed, len(rows) - passed))
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,77 @@
+"""
+Throughput of cohort inference against the stub AIAA server, across micro-batch sizes.
+
+The stub server runs segmentation requests on one simulated GPU with dynamic batching
+(see aiaa_stub_server.BatchingDevice). Phantom volumes are segmented one after the
+other with a new connection per request, as the client used to, then through
+temporal_bone_batching.MicroBatcher and the pooled keep-alive connections of
+AIAAStreamingClient with increasing batch sizes.
+
+  python benchmarks/benchmark_batching.py [--volumes 16] [--batch-sizes 1 2 4 8] [--latency 0.5] [--per-volume-latency 0.1]
+"""
+
+import argparse
+import concurrent.futures
+import os
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import temporal_bone_batching
+import temporal_bone_inference
+from aiaa_stub_server import AIAAStubHandler, BatchingDevice
+from phantoms import makePhantom
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--volumes', type=int, default=16)
+  parser.add_argument('--shape', type=int, nargs=3, default=[96, 96, 64], help='phantom (crop) size, IJK order')
+  parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8])
+  parser.add_argument('--max-wait', type=float, default=0.05, help='seconds the first request of a batch waits for others')
+  parser.add_argument('--latency', type=float, default=0.5, help='seconds per batch on the simulated GPU')
+  parser.add_argument('--per-volume-latency', type=float, default=0.1, help='seconds per volume of a batch on the simulated GPU')
+  args = parser.parse_args(argv)
+
+  AIAAStubHandler.device = BatchingDevice(args.latency, args.per_volume_latency)
+  server = ThreadingHTTPServer(('127.0.0.1', 0), AIAAStubHandler)
+  server.daemon_threads = True
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  serverUrl = 'http://127.0.0.1:%d' % server.server_address[1]
+
+  volume, masks = makePhantom(args.shape, (0.25, 0.25, 0.25))
+  ijkToRAS = [[0.25, 0, 0, 0], [0, 0.25, 0, 0], [0, 0, 0.25, 0], [0, 0, 0, 1]]
+  print('%d volumes of %s voxels, simulated GPU %.2f s per batch + %.2f s per volume' % (args.volumes,
+    'x'.join(str(size) for size in args.shape), args.latency, args.per_volume_latency))
+  print('%-28s %9s %11s %12s %12s' % ('client', 'time (s)', 'volumes/s', 'connections', 'GPU batches'))
+
+  def report(label, seconds, connections, batches):
+    print('%-28s %9.2f %11.2f %12d %12d' % (label, seconds, args.volumes / seconds, connections, batches))
+
+  # One request at a time on a new connection each
+  client = temporal_bone_inference.AIAAStreamingClient(serverUrl, poolSize=0)
+  AIAAStubHandler.connections, AIAAStubHandler.device.batchSizes = 0, []
+  startTime = time.perf_counter()
+  for _ in range(args.volumes):
+    client.segmentationBatch('cochlear_duct', [(volume, ijkToRAS)])
+  report('serial, no keep-alive', time.perf_counter() - startTime, AIAAStubHandler.connections,
+    len(AIAAStubHandler.device.batchSizes))
+
+  for batchSize in args.batch_sizes:
+    client = temporal_bone_inference.AIAAStreamingClient(serverUrl, poolSize=4 * batchSize)
+    AIAAStubHandler.connections, AIAAStubHandler.device.batchSizes = 0, []
+    startTime = time.perf_counter()
+    # As many volumes in flight as the batch holds, as the inference stage of a cohort pipeline does
+    with temporal_bone_batching.MicroBatcher(client, batchSize, args.max_wait) as batcher:
+      with concurrent.futures.ThreadPoolExecutor(max_workers=batchSize) as executor:
+        list(executor.map(lambda index: batcher.segmentation('cochlear_duct', volume, ijkToRAS), range(args.volumes)))
+    report('batch size %d' % batchSize, time.perf_counter() - startTime, AIAAStubHandler.connections,
+      len(AIAAStubHandler.device.batchSizes))
+    client.close()
+  server.shutdown()
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
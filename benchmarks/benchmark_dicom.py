@@ -0,0 +1,107 @@
+"""
+File count, size and time of the DICOM export of a phantom.
+
+Writes the volume with temporal_bone_dicom as a classic CT series (one file per
+slice, written by a thread pool) and as a single Enhanced CT file, and its
+structures as a DICOM Segmentation object.
+
+  python benchmarks/benchmark_dicom.py [--shape 320 320 200]
+
+Run in Slicer to also time the export through the subject hierarchy and the
+DICOMScalarVolumePlugin, as exportVolumeDICOM used to:
+
+  Slicer --no-main-window --python-script benchmarks/benchmark_dicom.py
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+from pydicom.uid import generate_uid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import temporal_bone_dicom
+from phantoms import makePhantom
+from temporal_bone_postprocessing import _boundingBox
+
+try:
+  import slicer
+except ImportError:
+  slicer = None
+
+
+def exportSlicer(volume, ijkToRAS, directory):
+  volumeNode = slicer.util.addVolumeFromArray(volume, ijkToRAS=ijkToRAS)
+  startTime = time.perf_counter()
+  shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
+  patientItemID = shNode.CreateSubjectItem(shNode.GetSceneItemID(), 'phantom')
+  studyItemID = shNode.CreateStudyItem(patientItemID, "Auto-segmentation Study")
+  volumeShItemID = shNode.GetItemByDataNode(volumeNode)
+  shNode.SetItemParent(volumeShItemID, studyItemID)
+  import DICOMScalarVolumePlugin
+  exporter = DICOMScalarVolumePlugin.DICOMScalarVolumePluginClass()
+  exportables = exporter.examineForExport(volumeShItemID)
+  for exp in exportables:
+    exp.directory = directory
+  exporter.export(exportables)
+  seconds = time.perf_counter() - startTime
+  slicer.mrmlScene.Clear(0)
+  return seconds
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--shape', type=int, nargs=3, default=[320, 320, 200], help='phantom size, IJK order')
+  parser.add_argument('--spacing', type=float, nargs=3, default=[0.25, 0.25, 0.25])
+  parser.add_argument('--workers', type=int, help='threads of the classic series export')
+  args = parser.parse_args(argv)
+
+  volume, masks = makePhantom(args.shape, args.spacing)
+  ijkToRAS = np.diag(list(args.spacing) + [1.0])
+  segments = []
+  for structure, mask in masks.items():
+    box = _boundingBox(mask, (0, 0, 0)) or (slice(0, 0),) * 3
+    segments.append((structure, mask[box], box))
+  study = temporal_bone_dicom.newStudy('phantom')
+  # The Segmentation references the instances of a classic series of the volume
+  referencedVolume = {'seriesInstanceUID': generate_uid(), 'sopClassUID': temporal_bone_dicom.CT_IMAGE_STORAGE,
+    'sopInstanceUIDs': [generate_uid() for k in range(volume.shape[0])]}
+
+  def classic(directory):
+    return temporal_bone_dicom.writeClassicSeries(volume, ijkToRAS, directory, study, workers=args.workers)
+
+  def enhanced(directory):
+    return temporal_bone_dicom.writeEnhancedCT(volume, ijkToRAS, os.path.join(directory, 'EnhancedCT.dcm'), study)
+
+  def segmentation(directory):
+    return temporal_bone_dicom.writeSegmentation(segments, volume.shape, ijkToRAS,
+      os.path.join(directory, 'Segmentation.dcm'), study, referencedVolume)
+
+  cases = []
+  if slicer is not None:
+    cases.append(('Slicer DICOM module', None))
+  cases += [('classic series', classic), ('Enhanced CT', enhanced), ('Segmentation, %d segments' % len(segments), segmentation)]
+  print('%-28s %7s %10s %9s' % ('export', 'files', 'size (MB)', 'time (s)'))
+  for label, export in cases:
+    directory = tempfile.mkdtemp(prefix='TemporalBoneDICOM-')
+    try:
+      if export is None:
+        seconds = exportSlicer(volume, ijkToRAS, directory)
+      else:
+        startTime = time.perf_counter()
+        export(directory)
+        seconds = time.perf_counter() - startTime
+      files = [entry.stat().st_size for entry in os.scandir(directory) if entry.is_file()]
+      print('%-28s %7d %10.1f %9.2f' % (label, len(files), sum(files) / 1e6, seconds))
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
+  if slicer is not None:
+    slicer.util.exit(0)
@@ -0,0 +1,35 @@
+"""
+Compare sequential and concurrent AIAA inference of the five temporal bone models.
+
+Start the stub server, then run this script in Slicer:
+
+  python benchmarks/aiaa_stub_server.py --port 8000 --latency 2.0
+  Slicer --no-main-window --python-script benchmarks/benchmark_inference.py VOLUME.nrrd http://127.0.0.1:8000
+"""
+
+import os
+import sys
+import time
+
+import slicer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from temporal_bone_slicer_module import AIAA_MODEL_EXPORTS, TemporalBoneAutosegmentationLogic
+
+volumePath = sys.argv[1]
+serverUrl = sys.argv[2] if len(sys.argv) > 2 else 'http://127.0.0.1:8000'
+repeats = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+
+logic = TemporalBoneAutosegmentationLogic()
+inputVolume = slicer.util.loadVolume(volumePath)
+volumeByModel = dict.fromkeys(AIAA_MODEL_EXPORTS, inputVolume)
+
+for label, maxWorkers in [('sequential', 1), ('concurrent', len(volumeByModel))]:
+  timings = []
+  for repeat in range(repeats):
+    startTime = time.perf_counter()
+    logic.runInference(volumeByModel, lambda modelName, labelmapFile: None, serverUrl, maxWorkers)
+    timings.append(time.perf_counter() - startTime)
+  print('%-10s workers=%d  best %.2f s  mean %.2f s' % (label, maxWorkers, min(timings), sum(timings)/len(timings)))
+
+sys.exit(0)
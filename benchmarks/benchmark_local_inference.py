@@ -0,0 +1,52 @@
+"""
+Throughput of local CPU inference of the temporal bone models, per model and per thread.
+
+Segments a phantom with each model of a directory (see temporal_bone_local_inference)
+for every combination of thread count and tile batch size, to size machines for
+air-gapped cohorts from the measured voxels per second per core.
+
+  python benchmarks/benchmark_local_inference.py MODEL_DIR [--threads 1 2 4 8] [--batch-sizes 1 2 4]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import temporal_bone_local_inference
+from phantoms import makePhantom
+
+IJK_TO_RAS = [[-0.25, 0, 0, 0], [0, -0.25, 0, 0], [0, 0, 0.25, 0], [0, 0, 0, 1]]
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('model_directory')
+  parser.add_argument('--shape', type=int, nargs=3, default=[240, 240, 200], help='phantom size, IJK order')
+  parser.add_argument('--threads', type=int, nargs='+', default=[1, os.cpu_count()])
+  parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1])
+  parser.add_argument('--overlap', type=float, default=0.25)
+  args = parser.parse_args(argv)
+
+  volume = makePhantom(args.shape)[0]
+  print('Phantom %s, %.1f Mvoxels' % ('x'.join(map(str, args.shape)), volume.size / 1e6))
+  print('%-14s %7s %6s %9s %12s %18s' % ('model', 'threads', 'batch', 'time (s)', 'Mvoxels/s', 'Mvoxels/s/thread'))
+  for threads in args.threads:
+    for batchSize in args.batch_sizes:
+      # A new client per configuration, since the engines fix their thread count when loading a model
+      client = temporal_bone_local_inference.LocalInferenceClient(args.model_directory, threads, args.overlap, batchSize)
+      sessionId = client.createSession(volume, IJK_TO_RAS)
+      for model in client.modelList():
+        # The first call loads the model and is not timed
+        client.segmentation(model['name'], sessionId, decode=False)
+        startTime = time.perf_counter()
+        client.segmentation(model['name'], sessionId, decode=False)
+        seconds = time.perf_counter() - startTime
+        print('%-14s %7d %6d %9.2f %12.2f %18.3f' % (model['name'], threads, batchSize, seconds,
+          volume.size / 1e6 / seconds, volume.size / 1e6 / seconds / threads))
+      client.closeSession(sessionId)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,125 @@
+"""
+Time and peak memory of the median filter stage on a head-sized phantom.
+
+Compares filtering a full copy of the volume, as the clone and medianimagefilter
+CLI stage did, with the stage of TemporalBoneAutosegmentationLogic: the volume
+filtered once by temporal_bone_postprocessing.medianFilterVolume into a new array
+(the sigmoid sinus input), and a copy of its temporal bone region found by
+temporal_bone_roi (the facial nerve input).
+
+  python benchmarks/benchmark_median.py [--shape 480 480 300] [--workers 8] [--scipy]
+
+Run in Slicer to also time the CLI on a clone and the logic stage on a volume node:
+
+  Slicer --no-main-window --python-script benchmarks/benchmark_median.py
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+from scipy import ndimage
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import temporal_bone_postprocessing
+import temporal_bone_roi
+from phantoms import makePhantom
+
+try:
+  import slicer
+except ImportError:
+  slicer = None
+
+
+def measure(function, *args, **kwargs):
+  """
+  :return: (result, seconds, peak traced memory in MB)
+  """
+  tracemalloc.start()
+  startTime = time.perf_counter()
+  result = function(*args, **kwargs)
+  seconds = time.perf_counter() - startTime
+  peak = tracemalloc.get_traced_memory()[1] / 1e6
+  tracemalloc.stop()
+  return result, seconds, peak
+
+
+def fullClone(volume, workers):
+  clone = volume.copy()
+  temporal_bone_postprocessing.medianFilterVolume(volume, out=clone, workers=workers)
+  return clone
+
+
+def fullCloneScipy(volume):
+  clone = volume.copy()
+  ndimage.median_filter(volume, size=3, mode='nearest', output=clone)
+  return clone
+
+
+def medianStage(volume, spacing, workers):
+  """
+  :return: (filtered volume, its temporal bone region)
+  """
+  median = temporal_bone_postprocessing.medianFilterVolume(volume, workers=workers)
+  boxes = temporal_bone_roi.findTemporalBoneBoxes(volume, spacing)
+  if not boxes:
+    return median, median
+  box = tuple(slice(min(b[axis].start for b in boxes), max(b[axis].stop for b in boxes)) for axis in range(3))
+  return median, median[box].copy()
+
+
+def runSlicer(volume, spacing):
+  from temporal_bone_slicer_module import TemporalBoneAutosegmentationLogic
+  logic = TemporalBoneAutosegmentationLogic()
+  inputVolume = slicer.util.addVolumeFromArray(volume, ijkToRAS=np.diag(list(spacing) + [1.0]))
+  startTime = time.perf_counter()
+  median = slicer.modules.volumes.logic().CloneVolume(slicer.mrmlScene, inputVolume, 'Volume_median_filter')
+  slicer.cli.runSync(slicer.modules.medianimagefilter, None,
+    {"neighborhood": "1,1,1", "inputVolume": inputVolume, "outputVolume": median})
+  cliSeconds = time.perf_counter() - startTime
+  cliArray = slicer.util.arrayFromVolume(median).copy()
+  slicer.mrmlScene.RemoveNode(median)
+  startTime = time.perf_counter()
+  median = logic.medianFilterVolume(inputVolume)
+  region = logic.temporalBoneRegionVolume(median, inputVolume)
+  logicSeconds = time.perf_counter() - startTime
+  print('%-28s %9.2f' % ('Slicer: clone + CLI', cliSeconds))
+  print('%-28s %9.2f' % ('Slicer: logic stage', logicSeconds))
+  # The logic must match the CLI result, and its region the CLI result there
+  print('Differing voxels: %d' % np.count_nonzero(cliArray != slicer.util.arrayFromVolume(median)))
+  start = [int(round(o / s)) for o, s in zip(region.GetOrigin(), spacing)][::-1]
+  regionArray = slicer.util.arrayFromVolume(region)
+  reference = cliArray[tuple(slice(s, s + size) for s, size in zip(start, regionArray.shape))]
+  print('Differing voxels in the region: %d' % np.count_nonzero(reference != regionArray))
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--shape', type=int, nargs=3, default=[480, 480, 300], help='phantom size, IJK order')
+  parser.add_argument('--spacing', type=float, nargs=3, default=[0.25, 0.25, 0.25])
+  parser.add_argument('--workers', type=int, default=None, help='threads of the NumPy filter, all cores by default')
+  parser.add_argument('--scipy', action='store_true', help='also time scipy.ndimage.median_filter on the full volume (slow)')
+  args = parser.parse_args(argv)
+
+  volume = makePhantom(args.shape, args.spacing, islands=0)[0]
+  print('Phantom %s, %.1f Mvoxels, %.0f MB' % ('x'.join(map(str, args.shape)), volume.size / 1e6, volume.nbytes / 1e6))
+  print('%-28s %9s %14s %12s' % ('median filter', 'time (s)', 'peak mem (MB)', 'Mvoxels'))
+  full, seconds, peak = measure(fullClone, volume, args.workers)
+  print('%-28s %9.2f %14.0f %12.1f' % ('full volume clone', seconds, peak, full.size / 1e6))
+  if args.scipy:
+    fullScipy, seconds, peak = measure(fullCloneScipy, volume)
+    print('%-28s %9.2f %14.0f %12.1f' % ('full volume clone (scipy)', seconds, peak, fullScipy.size / 1e6))
+  (median, region), seconds, peak = measure(medianStage, volume, args.spacing, args.workers)
+  print('%-28s %9.2f %14.0f %12.1f' % ('full volume + region copy', seconds, peak, (median.size + region.size) / 1e6))
+  print('Differing voxels: %d' % np.count_nonzero(median != full))
+  if slicer is not None:
+    runSlicer(volume, args.spacing)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
+  if slicer is not None:
+    slicer.util.exit(0)
@@ -0,0 +1,81 @@
+"""
+Export time and file size of the structure surfaces of a phantom.
+
+Compares the OBJ export of the Segmentations module (one structure after the other,
+as exportStructure does) with temporal_bone_mesh meshing all structures in parallel
+into binary PLY and STL files, with and without levels of detail.
+
+  Slicer --no-main-window --python-script benchmarks/benchmark_mesh.py [--shape 320 320 200] [--levels 0 0.75 0.95]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import slicer
+import vtk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import temporal_bone_mesh
+from phantoms import makePhantom
+
+
+def directorySize(directory):
+  return sum(entry.stat().st_size for entry in os.scandir(directory) if entry.is_file())
+
+
+def exportObj(masks, volumeNode, directory):
+  segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+  segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(volumeNode)
+  for structure, mask in masks.items():
+    segmentID = segmentationNode.GetSegmentation().AddEmptySegment(structure)
+    slicer.util.updateSegmentBinaryLabelmapFromArray(mask.astype(np.uint8), segmentationNode, segmentID, volumeNode)
+  startTime = time.perf_counter()
+  for structure in masks:
+    segmentIDs = vtk.vtkStringArray()
+    segmentIDs.InsertNextValue(segmentationNode.GetSegmentation().GetSegmentIdBySegmentName(structure))
+    slicer.modules.segmentations.logic().ExportSegmentsClosedSurfaceRepresentationToFiles(directory,
+      segmentationNode, segmentIDs, "OBJ", True, 1.0, False)
+    # The surface of each structure is built again for the next export, as in exportStructure
+    segmentationNode.RemoveClosedSurfaceRepresentation()
+  seconds = time.perf_counter() - startTime
+  slicer.mrmlScene.RemoveNode(segmentationNode)
+  return seconds
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--shape', type=int, nargs=3, default=[320, 320, 200], help='phantom size, IJK order')
+  parser.add_argument('--spacing', type=float, nargs=3, default=[0.25, 0.25, 0.25])
+  parser.add_argument('--levels', type=float, nargs='+', default=[0.0, 0.75, 0.95], help='decimation of the levels of detail')
+  args = parser.parse_args(argv)
+
+  volume, masks = makePhantom(args.shape, args.spacing)
+  ijkToRAS = np.diag(list(args.spacing) + [1.0])
+  volumeNode = slicer.util.addVolumeFromArray(volume, ijkToRAS=ijkToRAS)
+  structures = {structure: (mask, (0, 0, 0)) for structure, mask in masks.items()}
+  print('%-28s %9s %12s' % ('surfaces', 'time (s)', 'size (MB)'))
+  cases = [('OBJ, one at a time', None, None)]
+  cases += [('%s, parallel' % fileFormat.upper(), fileFormat, (0.0,)) for fileFormat in ('ply', 'stl')]
+  cases += [('PLY, parallel, %d levels' % len(args.levels), 'ply', args.levels)]
+  for label, fileFormat, levels in cases:
+    directory = tempfile.mkdtemp(prefix='TemporalBoneMesh-')
+    try:
+      if fileFormat is None:
+        seconds = exportObj(masks, volumeNode, directory)
+      else:
+        startTime = time.perf_counter()
+        temporal_bone_mesh.exportStructureMeshes(structures, ijkToRAS, directory, 'phantom', fileFormat, levels=levels)
+        seconds = time.perf_counter() - startTime
+      print('%-28s %9.2f %12.1f' % (label, seconds, directorySize(directory) / 1e6))
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
+  slicer.util.exit(0)
@@ -0,0 +1,69 @@
+"""
+Load time and peak memory of whole-volume decoding against memory-mapped loading.
+
+A phantom is written as a gzip NRRD file, then localized (temporal_bone_roi) and
+cropped around the temporal bones after each loader:
+- temporal_bone_inference.readNrrdArray decodes the whole file into memory.
+- temporal_bone_mmap.openNrrd decompresses it into a raw file of a FileCache on first access.
+- Later accesses map the cached file, reading only the pages they touch.
+
+Peak memory is the peak of the allocations traced by tracemalloc: mapped pages are
+in the page cache, not allocated by the process.
+
+  python benchmarks/benchmark_mmap.py [--shape 512 512 300]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import temporal_bone_cache
+import temporal_bone_inference
+import temporal_bone_mmap
+import temporal_bone_roi
+from phantoms import makePhantom
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--shape', type=int, nargs=3, default=[512, 512, 300], help='phantom size, IJK order')
+  parser.add_argument('--spacing', type=float, nargs=3, default=[0.4, 0.4, 0.4])
+  args = parser.parse_args(argv)
+
+  directory = tempfile.mkdtemp(prefix='TemporalBoneMmap-')
+  try:
+    volume, masks = makePhantom(args.shape, args.spacing)
+    path = os.path.join(directory, 'phantom.nrrd')
+    temporal_bone_inference.writeNrrd(path, volume, [[-args.spacing[0], 0, 0, 0], [0, -args.spacing[1], 0, 0],
+      [0, 0, args.spacing[2], 0], [0, 0, 0, 1]])
+    del volume, masks
+    cache = temporal_bone_cache.FileCache(os.path.join(directory, 'cache'))
+    print('%.0f MB volume, %.0f MB gzip file' % (args.shape[0] * args.shape[1] * args.shape[2] * 2 / 1e6, os.path.getsize(path) / 1e6))
+    print('%-28s %9s %9s %14s' % ('loader', 'load (s)', 'crop (s)', 'peak (MB)'))
+
+    cases = [('decode whole file', lambda: temporal_bone_inference.readNrrdArray(path)),
+      ('mmap, first access', lambda: temporal_bone_mmap.openNrrd(path, cache)),
+      ('mmap, cached', lambda: temporal_bone_mmap.openNrrd(path, cache))]
+    for label, load in cases:
+      tracemalloc.start()
+      startTime = time.perf_counter()
+      volumeArray, header = load()
+      loadSeconds = time.perf_counter() - startTime
+      boxes = temporal_bone_roi.findTemporalBoneBoxes(volumeArray, args.spacing)
+      crops = [volumeArray[box].copy() for box in boxes]
+      cropSeconds = time.perf_counter() - startTime - loadSeconds
+      peak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+      print('%-28s %9.2f %9.2f %14.0f' % (label, loadSeconds, cropSeconds, peak / 1e6))
+      del volumeArray, crops
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
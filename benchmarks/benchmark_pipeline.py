@@ -0,0 +1,205 @@
+"""
+End-to-end benchmark of the segmentation pipeline on synthetic phantoms.
+
+Every case (phantom size and spacing) goes through each stage of
+TemporalBoneAutosegmentationLogic: resampling, median filter, inference answered
+by PhantomInferenceClient, the post-processing of every model with both engines,
+each export path, and finally a whole run(). Wall time and peak resident memory
+of every stage are appended to --output as JSON lines. With --baseline, stages
+slower than the baseline by more than --tolerance are listed and the exit code
+is 1, so the script can gate releases.
+
+A case is SIZE:SPACING in IJK order. The default cases cover both resampling
+branches (linear for z spacing <= 0.25 mm, bspline above):
+
+  Slicer --no-main-window --python-script benchmarks/benchmark_pipeline.py --output timings.jsonl
+    [--case 240,240,150:0.3,0.3,0.2 --case 240,240,50:0.3,0.3,0.6] [--baseline previous.jsonl --tolerance 0.25]
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import slicer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import temporal_bone_inference
+import temporal_bone_metrics
+from phantoms import PhantomInferenceClient, makePhantom
+from temporal_bone_slicer_module import AIAA_MODEL_EXPORTS, TemporalBoneAutosegmentationLogic
+
+DEFAULT_CASES = ['240,240,150:0.3,0.3,0.2', '240,240,50:0.3,0.3,0.6']
+
+# Stages shorter than this are not reported as regressions, their timings are mostly noise
+MINIMUM_REGRESSION_SECONDS = 0.05
+
+
+class StageRecorder:
+  """
+  Measure stages of one case and write a JSON record per stage.
+  """
+
+  def __init__(self, case, outputFile):
+    self.case = case
+    self.outputFile = outputFile
+    self.records = []
+
+  @contextlib.contextmanager
+  def stage(self, name, **fields):
+    perStage = temporal_bone_metrics.resetPeakMemory()
+    startTime = time.perf_counter()
+    yield fields
+    record = {'case': self.case, 'stage': name, 'seconds': round(time.perf_counter() - startTime, 4),
+      'peakMemoryMB': round((temporal_bone_metrics.peakMemoryBytes() or 0) / 1024.0**2, 1), 'peakPerStage': perStage}
+    record.update(fields)
+    self.records.append(record)
+    self.outputFile.write(json.dumps(record) + '\n')
+    self.outputFile.flush()
+    print('%-28s %-26s %8.2f s %9.0f MB' % (self.case, name, record['seconds'], record['peakMemoryMB']))
+
+
+def parseCase(case):
+  shape, spacing = case.split(':')
+  return [int(size) for size in shape.split(',')], [float(axisSpacing) for axisSpacing in spacing.split(',')]
+
+
+def addPhantomVolume(volume, spacing, name):
+  ijkToRAS = np.diag(list(spacing) + [1.0])
+  return slicer.util.addVolumeFromArray(volume, ijkToRAS=ijkToRAS, name=name)
+
+
+def benchmarkCase(case, outputFile, directory):
+  shape, spacing = parseCase(case)
+  recorder = StageRecorder(case, outputFile)
+  logic = TemporalBoneAutosegmentationLogic()
+  logic.inferenceCache = None
+  logic.resampleCache = None
+  logic.pipelineCache = None
+
+  with recorder.stage('phantom'):
+    volume, masks = makePhantom(shape, spacing)
+  logic.inferenceClient = PhantomInferenceClient(masks, spacing)
+  with recorder.stage('load'):
+    inputVolume = addPhantomVolume(volume, spacing, 'phantom')
+  with recorder.stage('resample', interpolation='linear' if spacing[2] <= 0.25 else 'bspline') as fields:
+    logic.resampleVolume(inputVolume)
+    fields['voxels'] = int(np.prod(inputVolume.GetImageData().GetDimensions()))
+  with recorder.stage('median'):
+    median = logic.medianFilterVolume(inputVolume)
+
+  volumeByModel = dict.fromkeys(AIAA_MODEL_EXPORTS, inputVolume)
+  volumeByModel["facial_nerve"] = median
+  volumeByModel["sigmoid_sinus"] = median
+  resultDirectory = os.path.join(directory, 'results')
+  os.makedirs(resultDirectory)
+  resultFiles = {}
+
+  def keepResult(modelName, labelmapFile):
+    resultFiles[modelName] = shutil.copy(labelmapFile, os.path.join(resultDirectory, modelName + '.nrrd'))
+
+  with recorder.stage('inference'):
+    logic.runInference(volumeByModel, keepResult)
+
+  segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+  segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(inputVolume)
+  segmentEditorWidget, segmentEditorNode = logic.createSegmentEditor(segmentationNode, inputVolume)
+  numpySegmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+  numpySegmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(inputVolume)
+  for modelName in AIAA_MODEL_EXPORTS:
+    with recorder.stage('effects:' + modelName):
+      modelMask = temporal_bone_inference.readNrrdArray(resultFiles[modelName])[0] > 0
+      structureName, mask, key = logic.postprocessModelResult(modelName, modelMask, volumeByModel[modelName],
+        (segmentEditorWidget, segmentEditorNode, segmentationNode))
+      segmentID = segmentationNode.GetSegmentation().AddEmptySegment(structureName)
+      slicer.util.updateSegmentBinaryLabelmapFromArray(mask.astype(np.uint8), segmentationNode, segmentID,
+        volumeByModel[modelName])
+    with recorder.stage('numpy:' + modelName):
+      modelMask = temporal_bone_inference.readNrrdArray(resultFiles[modelName])[0] > 0
+      structureName, mask, key = logic.postprocessModelResult(modelName, modelMask, volumeByModel[modelName])
+      segmentID = numpySegmentationNode.GetSegmentation().AddEmptySegment(structureName)
+      slicer.util.updateSegmentBinaryLabelmapFromArray(mask.astype(np.uint8), numpySegmentationNode, segmentID,
+        volumeByModel[modelName])
+
+  exportDirectory = os.path.join(directory, 'export')
+  os.makedirs(exportDirectory)
+  with recorder.stage('export:labelmaps-separate'):
+    logic.exportStructureLabelmaps([segmentationNode], inputVolume, exportDirectory, "separate")
+  with recorder.stage('export:labelmaps-combined'):
+    logic.exportStructureLabelmaps([segmentationNode], inputVolume, exportDirectory, "combined")
+  with recorder.stage('export:obj-separate'):
+    logic.exportStructure(segmentationNode, inputVolume, exportDirectory, None, 'phantom', False, True)
+  with recorder.stage('export:obj-combined'):
+    logic.exportStructureModels(segmentationNode, exportDirectory, 'phantom_structures')
+  with recorder.stage('export:volume-nrrd'):
+    slicer.util.saveNode(inputVolume, os.path.join(exportDirectory, 'Volume.nrrd'))
+  with recorder.stage('export:dicom'):
+    logic.exportVolumeDICOM(inputVolume, exportDirectory)
+  slicer.mrmlScene.Clear(0)
+
+  runDirectory = os.path.join(directory, 'run')
+  os.makedirs(runDirectory)
+  inputVolume = addPhantomVolume(volume, spacing, 'phantom')
+  with recorder.stage('run'):
+    logic.run(inputVolume, runDirectory, showResult=False)
+  slicer.mrmlScene.Clear(0)
+  return recorder.records
+
+
+def readRecords(path):
+  with open(path) as recordsFile:
+    return [json.loads(line) for line in recordsFile if line.strip()]
+
+
+def findRegressions(records, baselineRecords, tolerance):
+  """
+  Stages of records slower than the same case and stage of the baseline by more than tolerance (a fraction).
+  When the baseline has several runs of a stage, the fastest is the reference.
+  """
+  baseline = {}
+  for record in baselineRecords:
+    key = (record['case'], record['stage'])
+    baseline[key] = min(baseline.get(key, record['seconds']), record['seconds'])
+  regressions = []
+  for record in records:
+    reference = baseline.get((record['case'], record['stage']))
+    if reference is None:
+      continue
+    if record['seconds'] > max(reference * (1 + tolerance), reference + MINIMUM_REGRESSION_SECONDS):
+      regressions.append((record, reference))
+  return regressions
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--case', action='append', help='SIZE:SPACING of a phantom, for example 240,240,150:0.3,0.3,0.2')
+  parser.add_argument('--output', default='pipeline_timings.jsonl', help='JSON lines file the stage records are appended to')
+  parser.add_argument('--baseline', help='JSON lines file of a previous run to compare with')
+  parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown over the baseline, as a fraction')
+  args = parser.parse_args(argv)
+
+  records = []
+  with open(args.output, 'a') as outputFile:
+    for case in args.case or DEFAULT_CASES:
+      directory = tempfile.mkdtemp(prefix='TemporalBoneBenchmark-')
+      try:
+        records += benchmarkCase(case, outputFile, directory)
+      finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+  if not args.baseline:
+    return 0
+  regressions = findRegressions(records, readRecords(args.baseline), args.tolerance)
+  for record, reference in regressions:
+    print('REGRESSION %s %s: %.2f s (baseline %.2f s)' % (record['case'], record['stage'], record['seconds'], reference))
+  print('%d stages compared, %d regressions' % (len(records), len(regressions)))
+  return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+  slicer.util.exit(main(sys.argv[1:]))
@@ -0,0 +1,80 @@
+"""
+Micro-benchmark of the NumPy post-processing engine on a synthetic phantom.
+
+  python benchmarks/benchmark_postprocessing.py [--shape 320 320 192]
+
+Run in Slicer to also time the Segment Editor effects on the same masks and
+count the voxels where the two engines differ:
+
+  Slicer --no-main-window --python-script benchmarks/benchmark_postprocessing.py
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import temporal_bone_postprocessing
+from phantoms import makePhantom
+
+try:
+  import slicer
+except ImportError:
+  slicer = None
+
+
+def timed(function, *args):
+  startTime = time.perf_counter()
+  result = function(*args)
+  return result, time.perf_counter() - startTime
+
+
+def runEffects(modelName, mask, volume, spacing):
+  """
+  Post-process a mask with the Segment Editor effects of the post-processing stages, as
+  TemporalBoneAutosegmentationLogic.run does.
+  :return: (resulting mask array, seconds spent in the effects)
+  """
+  from temporal_bone_slicer_module import TemporalBoneAutosegmentationLogic
+  logic = TemporalBoneAutosegmentationLogic()
+  logic.pipelineCache = None
+  masterVolume = slicer.util.addVolumeFromArray(volume)
+  masterVolume.SetSpacing(spacing)
+  segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+  segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(masterVolume)
+  segmentEditorWidget, segmentEditorNode = logic.createSegmentEditor(segmentationNode, masterVolume)
+  (structureName, result, key), seconds = timed(logic.postprocessModelResult, modelName, mask.astype(bool), masterVolume,
+    (segmentEditorWidget, segmentEditorNode, segmentationNode))
+  for node in (segmentationNode, segmentEditorNode, masterVolume):
+    slicer.mrmlScene.RemoveNode(node)
+  return result, seconds
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--shape', type=int, nargs=3, default=[320, 320, 192], help='phantom size, IJK order')
+  parser.add_argument('--spacing', type=float, nargs=3, default=[0.25, 0.25, 0.25])
+  parser.add_argument('--repeats', type=int, default=3)
+  args = parser.parse_args(argv)
+
+  volume, masks = makePhantom(args.shape, args.spacing)
+  print('Phantom %s, %.1f Mvoxels' % ('x'.join(map(str, args.shape)), volume.size / 1e6))
+  print('%-14s %10s %10s %9s %10s' % ('model', 'numpy (s)', 'effects (s)', 'speedup', 'diff vox'))
+  for modelName, postprocess in temporal_bone_postprocessing.POSTPROCESSING_BY_MODEL.items():
+    seconds = min(timed(postprocess, masks[modelName], volume, args.spacing)[1] for _ in range(args.repeats))
+    if slicer is None:
+      print('%-14s %10.3f' % (modelName, seconds))
+      continue
+    result = postprocess(masks[modelName], volume, args.spacing)
+    effectsResult, effectsSeconds = runEffects(modelName, masks[modelName], volume, args.spacing)
+    print('%-14s %10.3f %10.3f %8.1fx %10d' % (modelName, seconds, effectsSeconds, effectsSeconds / seconds,
+      np.count_nonzero(result != effectsResult)))
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
+  if slicer is not None:
+    slicer.util.exit(0)
@@ -0,0 +1,82 @@
+"""
+Cohort time of a serial loop against the prefetching pipeline of the cochlear duct script.
+
+Phantom volumes are written as gzip NRRD files, then each one is read and decompressed,
+"segmented" (inference waits --latency seconds, as for a remote server, then the mask is
+post-processed with the NumPy engine) and its segmentation written as a .seg.nrrd file.
+The loop does it one volume after the other; temporal_bone_prefetch overlaps the reading
+of the next volume and the writing of the previous one with the segmentation.
+
+  python benchmarks/benchmark_prefetch.py [--volumes 8] [--shape 256 256 160] [--latency 1.0] [--queue-size 2]
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import temporal_bone_inference
+import temporal_bone_postprocessing
+import temporal_bone_prefetch
+from phantoms import makePhantom
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--volumes', type=int, default=8)
+  parser.add_argument('--shape', type=int, nargs=3, default=[256, 256, 160], help='phantom size, IJK order')
+  parser.add_argument('--spacing', type=float, nargs=3, default=[0.25, 0.25, 0.25])
+  parser.add_argument('--latency', type=float, default=1.0, help='seconds of inference per volume')
+  parser.add_argument('--queue-size', type=int, default=2)
+  args = parser.parse_args(argv)
+  logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+  directory = tempfile.mkdtemp(prefix='TemporalBonePrefetch-')
+  ijkToRAS = np.diag(list(args.spacing) + [1.0]).tolist()
+  try:
+    volume, masks = makePhantom(args.shape, args.spacing)
+    paths = []
+    for index in range(args.volumes):
+      paths.append(os.path.join(directory, 'phantom%03d.nrrd' % index))
+      temporal_bone_inference.writeNrrd(paths[-1], volume, ijkToRAS)
+
+    def load(path):
+      array, header = temporal_bone_inference.readNrrdArray(path)
+      return path, array, temporal_bone_inference.nrrdIJKToRAS(header)
+
+    def segment(item):
+      path, array, volumeIJKToRAS = item
+      time.sleep(args.latency)
+      mask = temporal_bone_postprocessing.postprocessCochlearDuctScript(masks['cochlear_duct'], array, args.spacing)
+      return path, mask, volumeIJKToRAS
+
+    def write(item):
+      path, mask, volumeIJKToRAS = item
+      temporal_bone_inference.writeSegmentationNrrd(path[:-5] + '.seg.nrrd', mask.astype(np.uint8), volumeIJKToRAS,
+        [(1, 'cochlear_duct', (1, 0, 0))])
+      return path
+
+    startTime = time.perf_counter()
+    for path in paths:
+      write(segment(load(path)))
+    serialSeconds = time.perf_counter() - startTime
+
+    pipeline = temporal_bone_prefetch.PrefetchPipeline([('load', load, 1), ('segment', segment, 0), ('write', write, 1)],
+      args.queue_size)
+    pipeline.run(paths)
+    print('%d volumes of %.1f Mvoxels, %.1f s inference latency' % (args.volumes, volume.size / 1e6, args.latency))
+    print('%-24s %9.2f s' % ('serial loop', serialSeconds))
+    print('%-24s %9.2f s' % ('prefetching pipeline', pipeline.wallSeconds))
+    pipeline.logStatistics()
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
@@ -0,0 +1,102 @@
+"""
+Time of the structure statistics of a cohort of phantoms.
+
+Computes the statistics of the five structures of each phantom with
+temporal_bone_statistics and appends them to one cohort file, as the segmentation
+runs do.
+
+  python benchmarks/benchmark_statistics.py [--volumes 10] [--shape 320 320 200] [--output statistics.csv]
+
+Run in Slicer to also time SegmentStatisticsLogic on the same structures, with the
+table export and one CSV file per volume, as the cochlear duct script used to:
+
+  Slicer --no-main-window --python-script benchmarks/benchmark_statistics.py
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import temporal_bone_statistics
+from phantoms import makePhantom
+
+try:
+  import slicer
+except ImportError:
+  slicer = None
+
+
+def numpyStatistics(volume, masks, spacing, name, writer):
+  ijkToRAS = np.diag(list(spacing) + [1.0])
+  rows = []
+  for structure, mask in masks.items():
+    row = temporal_bone_statistics.structureStatistics(mask, spacing, ijkToRAS, volume)
+    row.update(volume=name, structure=structure)
+    rows.append(row)
+  writer.write(rows)
+  return rows
+
+
+def segmentStatistics(volume, masks, spacing, name, directory):
+  import SegmentStatistics
+  masterVolumeNode = slicer.util.addVolumeFromArray(volume, ijkToRAS=np.diag(list(spacing) + [1.0]), name=name)
+  segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+  segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(masterVolumeNode)
+  for structure, mask in masks.items():
+    segmentID = segmentationNode.GetSegmentation().AddEmptySegment(structure)
+    slicer.util.updateSegmentBinaryLabelmapFromArray(mask.astype(np.uint8), segmentationNode, segmentID, masterVolumeNode)
+  startTime = time.perf_counter()
+  resultsTableNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTableNode')
+  segStatLogic = SegmentStatistics.SegmentStatisticsLogic()
+  segStatLogic.getParameterNode().SetParameter("Segmentation", segmentationNode.GetID())
+  segStatLogic.getParameterNode().SetParameter("ScalarVolume", masterVolumeNode.GetID())
+  segStatLogic.computeStatistics()
+  segStatLogic.exportToTable(resultsTableNode)
+  slicer.util.saveNode(resultsTableNode, os.path.join(directory, name + '.csv'))
+  seconds = time.perf_counter() - startTime
+  slicer.mrmlScene.Clear(0)
+  return seconds
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--volumes', type=int, default=10, help='number of phantoms of the cohort')
+  parser.add_argument('--shape', type=int, nargs=3, default=[320, 320, 200], help='phantom size, IJK order')
+  parser.add_argument('--spacing', type=float, nargs=3, default=[0.25, 0.25, 0.25])
+  parser.add_argument('--output', help='cohort statistics file (.csv or .parquet), a temporary CSV by default')
+  args = parser.parse_args(argv)
+
+  directory = tempfile.mkdtemp(prefix='TemporalBoneStatistics-')
+  writer = temporal_bone_statistics.StatisticsWriter(args.output or os.path.join(directory, 'statistics.csv'))
+  numpySeconds = slicerSeconds = 0.0
+  try:
+    for index in range(args.volumes):
+      volume, masks = makePhantom(args.shape, args.spacing, seed=index)
+      name = 'phantom%03d' % index
+      startTime = time.perf_counter()
+      numpyStatistics(volume, masks, args.spacing, name, writer)
+      numpySeconds += time.perf_counter() - startTime
+      if slicer is not None:
+        slicerSeconds += segmentStatistics(volume, masks, args.spacing, name, directory)
+    writer.close()
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
+
+  structures = args.volumes * len(masks)
+  print('%d volumes, %d structures, %.1f Mvoxels each' % (args.volumes, structures, volume.size / 1e6))
+  print('%-28s %9s %16s' % ('statistics', 'time (s)', 'ms per structure'))
+  print('%-28s %9.2f %16.1f' % ('NumPy, one cohort file', numpySeconds, 1000 * numpySeconds / structures))
+  if slicer is not None:
+    print('%-28s %9.2f %16.1f' % ('SegmentStatistics + CSV', slicerSeconds, 1000 * slicerSeconds / structures))
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
+  if slicer is not None:
+    slicer.util.exit(0)
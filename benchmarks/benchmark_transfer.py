@@ -0,0 +1,100 @@
+"""
+Bytes on the wire and peak memory of the streaming AIAA client against the stub server.
+
+Segments a phantom with the five models, first with whole-buffer transfers as the
+AIAA effect does through NvidiaAIAAClientAPI (the volume serialized in memory and
+uploaded with every model call, each response held in memory), then with
+temporal_bone_inference.AIAAStreamingClient (one streamed upload into a session).
+
+  python benchmarks/benchmark_transfer.py [--shape 512 512 256]
+"""
+
+import argparse
+import gzip
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import temporal_bone_inference
+from aiaa_stub_server import MODELS, parseMultipart
+from phantoms import makePhantom
+
+IJK_TO_RAS = [[-0.25, 0, 0, 0], [0, -0.25, 0, 0], [0, 0, 0.25, 0], [0, 0, 0, 1]]
+
+
+def wholeBufferTransfer(port, volume):
+  """
+  Call every model as the AIAA Segment Editor effect does: each call serializes the whole
+  volume in memory, uploads it with the request and reads the response whole.
+  :return: (bytes sent, bytes received)
+  """
+  sent = received = 0
+  for model in MODELS:
+    nrrd = temporal_bone_inference.nrrdHeader(volume, IJK_TO_RAS) + gzip.compress(volume.tobytes(), compresslevel=1)
+    boundary = uuid.uuid4().hex
+    body = (('--%s\r\nContent-Disposition: form-data; name="params"\r\n\r\n{}\r\n' % boundary).encode()
+      + ('--%s\r\nContent-Disposition: form-data; name="datapoint"; filename="image.nrrd"\r\n\r\n' % boundary).encode()
+      + nrrd + ('\r\n--%s--\r\n' % boundary).encode())
+    del nrrd
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    connection.request('POST', '/v1/segmentation?model=%s' % model, body, {'Content-Type': 'multipart/form-data; boundary=' + boundary})
+    sent += len(body)
+    del body
+    response = connection.getresponse()
+    content = response.read()
+    received += len(content)
+    mask = parseMultipart(response.getheader('Content-Type'), content)['image']
+    temporal_bone_inference.NrrdStreamDecoder().feed(mask)
+    connection.close()
+  return sent, received
+
+
+def streamingTransfer(port, volume):
+  client = temporal_bone_inference.AIAAStreamingClient('http://127.0.0.1:%d' % port)
+  sessionId = client.createSession(volume, IJK_TO_RAS)
+  for model in MODELS:
+    client.segmentation(model, sessionId)
+  client.closeSession(sessionId)
+  return client.bytesSent, client.bytesReceived
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--shape', type=int, nargs=3, default=[400, 400, 240], help='phantom size, IJK order')
+  args = parser.parse_args(argv)
+
+  volume = makePhantom(args.shape)[0]
+  # The server runs in its own process so that only the client memory is traced
+  with socket.socket() as probe:
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+  server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aiaa_stub_server.py'),
+    '--port', str(port), '--latency', '0'], stdout=subprocess.DEVNULL)
+  for attempt in range(50):
+    try:
+      socket.create_connection(('127.0.0.1', port)).close()
+      break
+    except OSError:
+      time.sleep(0.1)
+  print('Phantom %s, %.0f MB of voxels' % ('x'.join(map(str, args.shape)), volume.nbytes / 1e6))
+  print('%-14s %10s %14s %14s %8s' % ('client', 'sent (MB)', 'received (MB)', 'peak mem (MB)', 'time (s)'))
+  for name, transfer in (('whole buffer', wholeBufferTransfer), ('streaming', streamingTransfer)):
+    tracemalloc.start()
+    startTime = time.perf_counter()
+    sent, received = transfer(port, volume)
+    seconds = time.perf_counter() - startTime
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print('%-14s %10.1f %14.1f %14.1f %8.2f' % (name, sent / 1e6, received / 1e6, peak / 1e6, seconds))
+  server.terminate()
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
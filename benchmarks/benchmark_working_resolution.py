@@ -0,0 +1,92 @@
+"""
+Runtime and accuracy of segmenting each structure at a coarser working resolution.
+
+A phantom at the reference spacing (0.25 mm) is resampled once per working spacing,
+every model segments each level (PhantomInferenceClient, or the models of
+--model-directory with temporal_bone_local_inference), its mask is post-processed
+with the NumPy engine at that spacing (temporal_bone_postprocessing.stagesAtSpacing)
+and upsampled back to the reference grid (temporal_bone_resample.upsampleMask), as
+TemporalBoneAutosegmentationLogic does for logic.workingSpacing. Per structure, the
+time of the model, post-processing and upsampling, and the Dice coefficient against
+the structure segmented at the reference spacing are reported; the resampling of
+each level is shared by all structures and reported separately.
+
+  python benchmarks/benchmark_working_resolution.py [--shape 320 320 192] [--spacings 0.25 0.5 0.75] [--model-directory MODEL_DIR]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import temporal_bone_pipeline
+import temporal_bone_postprocessing
+import temporal_bone_resample
+from phantoms import PhantomInferenceClient, makePhantom
+
+REFERENCE_SPACING_MM = 0.25
+
+
+def dice(mask, reference):
+  total = np.count_nonzero(mask) + np.count_nonzero(reference)
+  return 2.0 * np.count_nonzero(mask & reference) / total if total else 1.0
+
+
+def segmentLevel(client, levelArray, spacing, shape):
+  """
+  Segment a level with every model and bring the structures back to the reference grid.
+  :return: dict of model name to (structure mask on the reference grid, seconds)
+  """
+  ijkToRAS = [[spacing, 0, 0, 0], [0, spacing, 0, 0], [0, 0, spacing, 0], [0, 0, 0, 1]]
+  stages = temporal_bone_postprocessing.stagesAtSpacing(temporal_bone_postprocessing.postprocessingStages(),
+    dict.fromkeys(temporal_bone_postprocessing.POSTPROCESSING_TARGETS, spacing), REFERENCE_SPACING_MM)
+  pipeline = temporal_bone_pipeline.Pipeline(stages, temporal_bone_postprocessing.POSTPROCESSING_OPERATIONS)
+  sessionId = client.createSession(levelArray, ijkToRAS)
+  results = {}
+  for modelName, structureName in temporal_bone_postprocessing.POSTPROCESSING_TARGETS.items():
+    startTime = time.perf_counter()
+    modelMask = client.segmentation(modelName, sessionId)[0] > 0
+    sources = {"model:" + modelName: modelMask, "master:" + modelName: (levelArray, (spacing,)*3)}
+    mask = pipeline.evaluate([structureName], sources, dict.fromkeys(sources, ''))[0][structureName]
+    if spacing != REFERENCE_SPACING_MM:
+      mask = temporal_bone_resample.upsampleMask(mask, (spacing / REFERENCE_SPACING_MM,)*3, (0, 0, 0), shape)
+    results[modelName] = (mask, time.perf_counter() - startTime)
+  client.closeSession(sessionId)
+  return results
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--shape', type=int, nargs=3, default=[320, 320, 192], help='phantom size at 0.25 mm, IJK order')
+  parser.add_argument('--spacings', type=float, nargs='+', default=[0.5, 0.75], help='working spacings compared to 0.25 mm')
+  parser.add_argument('--model-directory', help='segment with the local models of this directory instead of the phantom masks')
+  args = parser.parse_args(argv)
+
+  volume, masks = makePhantom(args.shape, (REFERENCE_SPACING_MM,)*3)
+  if args.model_directory:
+    import temporal_bone_local_inference
+    client = temporal_bone_local_inference.LocalInferenceClient(args.model_directory)
+  else:
+    client = PhantomInferenceClient(masks, (REFERENCE_SPACING_MM,)*3)
+  print('Phantom %s at %.2f mm, %.1f Mvoxels' % ('x'.join(map(str, args.shape)), REFERENCE_SPACING_MM, volume.size / 1e6))
+
+  reference = segmentLevel(client, volume, REFERENCE_SPACING_MM, volume.shape)
+  print('%-14s %8s %10s %9s %9s %8s' % ('model', 'spacing', 'Mvoxels', 'time (s)', 'speedup', 'Dice'))
+  for modelName, (mask, seconds) in reference.items():
+    print('%-14s %8.2f %10.1f %9.3f %9s %8s' % (modelName, REFERENCE_SPACING_MM, volume.size / 1e6, seconds, '', ''))
+  for spacing in sorted(set(args.spacings) - {REFERENCE_SPACING_MM}):
+    # Each level is resampled once and shared by all the structures segmented at its spacing
+    startTime = time.perf_counter()
+    levelArray = temporal_bone_resample.resampleArray(volume, (REFERENCE_SPACING_MM,)*3, (spacing,)*3, 'bspline')
+    print('%-14s %8.2f %10.1f %9.3f' % ('(resample)', spacing, levelArray.size / 1e6, time.perf_counter() - startTime))
+    for modelName, (mask, seconds) in segmentLevel(client, levelArray, spacing, volume.shape).items():
+      referenceMask, referenceSeconds = reference[modelName]
+      print('%-14s %8.2f %10.1f %9.3f %8.1fx %8.3f' % (modelName, spacing, levelArray.size / 1e6, seconds,
+        referenceSeconds / seconds, dice(mask, referenceMask)))
+
+
+if __name__ == '__main__':
+  main(sys.argv[1:])
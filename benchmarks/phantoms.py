@@ -0,0 +1,140 @@
+"""
+Synthetic temporal bone CT phantoms for benchmarks.
+
+A phantom is a head-sized cylinder of soft tissue with a skull shell and, on
+each side, a dense temporal bone block containing the structures segmented by
+the AIAA models. Arrays are in KJI order like slicer.util.arrayFromVolume and
+spacing is in IJK order like GetSpacing(). The IJK to RAS matrix of a phantom is
+diagonal with its spacing and the origin at the first voxel.
+"""
+
+import os
+import sys
+import uuid
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import temporal_bone_inference
+
+
+def _ellipsoid(grid, center, radii):
+  return sum(((axis - c) / r)**2 for axis, c, r in zip(grid, center, radii)) <= 1.0
+
+
+def _tube(grid, start, end, radius):
+  """
+  Voxels within radius of the segment from start to end (mm, xyz).
+  """
+  start = np.asarray(start, dtype=float)
+  direction = np.asarray(end, dtype=float) - start
+  length2 = float(direction @ direction)
+  relative = [axis - s for axis, s in zip(grid, start)]
+  t = np.clip(sum(r*d for r, d in zip(relative, direction)) / length2, 0, 1)
+  return sum((r - t*d)**2 for r, d in zip(relative, direction)) <= radius**2
+
+
+def makePhantom(shape=(160, 160, 96), spacing=(0.25, 0.25, 0.25), seed=0, islands=20):
+  """
+  Build a phantom volume and the raw model outputs of its structures.
+  :param shape: volume size in IJK order
+  :param spacing: voxel spacing in mm, IJK order
+  :param islands: number of small spurious islands added to every model output
+  :return: (int16 master volume array, dict of model name to bool mask array)
+  """
+  rng = np.random.default_rng(seed)
+  shape = tuple(shape)
+  extent = [size*axisSpacing for size, axisSpacing in zip(shape, spacing)]
+  # Physical coordinates in mm, one array per axis in xyz order, broadcast over KJI
+  grid = [np.arange(shape[axis], dtype=np.float32).reshape([-1 if a == 2 - axis else 1 for a in range(3)]) * spacing[axis]
+    for axis in range(3)]
+  center = [e / 2 for e in extent]
+
+  volume = np.full(shape[::-1], -1000, dtype=np.int16)
+  head = _ellipsoid(grid[:2], center[:2], [extent[0]*0.48, extent[1]*0.48])
+  skull = head & ~_ellipsoid(grid[:2], center[:2], [extent[0]*0.44, extent[1]*0.44])
+  volume[np.broadcast_to(head, volume.shape)] = 40
+  volume[np.broadcast_to(skull, volume.shape)] = 1500
+
+  masks = {name: np.zeros(volume.shape, dtype=bool) for name in
+    ("inner_ear", "ossicles", "cochlear_duct", "facial_nerve", "sigmoid_sinus")}
+  for side in (-1, 1):
+    boneCenter = [center[0] + side*extent[0]*0.3, center[1], center[2]]
+    size = min(extent) * 0.18
+    volume[_ellipsoid(grid, boneCenter, [size, size*1.2, size])] = 1800
+    # Middle ear cavity with the ossicles
+    cavityCenter = [boneCenter[0] - side*size*0.45, boneCenter[1], boneCenter[2]]
+    volume[_ellipsoid(grid, cavityCenter, [size*0.3]*3)] = -1000
+    ossicles = _ellipsoid(grid, cavityCenter, [size*0.1, size*0.18, size*0.1])
+    volume[ossicles] = 1300
+    masks["ossicles"] |= ossicles
+    # Fluid filled labyrinth, the cochlear duct is its lower part
+    labyrinthCenter = [boneCenter[0] + side*size*0.2, boneCenter[1], boneCenter[2]]
+    labyrinth = _ellipsoid(grid, labyrinthCenter, [size*0.25, size*0.35, size*0.2])
+    volume[labyrinth] = 20
+    masks["inner_ear"] |= _ellipsoid(grid, labyrinthCenter, [size*0.22, size*0.32, size*0.17])
+    masks["cochlear_duct"] |= labyrinth & (grid[2] < labyrinthCenter[2] - size*0.05)
+    # Facial nerve canal and sigmoid sinus
+    nerve = _tube(grid, [boneCenter[0], boneCenter[1] - size*0.6, boneCenter[2] + size*0.3],
+      [boneCenter[0] - side*size*0.3, boneCenter[1] + size*0.5, boneCenter[2] - size*0.2], size*0.06)
+    volume[nerve] = 40
+    masks["facial_nerve"] |= nerve
+    sinus = _tube(grid, [boneCenter[0] + side*size*0.7, boneCenter[1] - size, boneCenter[2] + size*0.6],
+      [boneCenter[0] + side*size*0.8, boneCenter[1] + size*0.2, boneCenter[2] - size*0.8], size*0.15)
+    volume[sinus] = 60
+    masks["sigmoid_sinus"] |= sinus
+
+  volume += rng.normal(0, 30, volume.shape).astype(np.int16)
+  for mask in masks.values():
+    for k, j, i in zip(*[rng.integers(1, size - 2, islands) for size in mask.shape]):
+      mask[k:k+2, j:j+2, i:i+2] = True
+  return volume, masks
+
+
+class PhantomInferenceClient:
+  """
+  Stand-in for the inference clients of temporal_bone_inference that answers with the phantom masks,
+  sampled (nearest neighbour) on the grid of the uploaded volume, so the pipeline can be run
+  without models or a server.
+  """
+
+  maxConcurrentRequests = None
+
+  def __init__(self, masks, spacing):
+    """
+    :param masks: dict of model name to bool mask array, as returned by makePhantom
+    :param spacing: spacing of the phantom, IJK order
+    """
+    self.masks = masks
+    self.spacing = spacing
+    self.sessions = {}
+    self.bytesSent = 0
+    self.bytesReceived = 0
+
+  def modelList(self):
+    return [{"name": name, "labels": [name], "type": "segmentation", "version": "phantom"} for name in self.masks]
+
+  def createSession(self, volumeArray, ijkToRAS, expiry=0):
+    sessionId = uuid.uuid4().hex
+    self.sessions[sessionId] = (volumeArray.shape, ijkToRAS)
+    return sessionId
+
+  def closeSession(self, sessionId):
+    self.sessions.pop(sessionId, None)
+    return {}
+
+  def segmentation(self, model, sessionId, outputFile=None, decode=True):
+    shape, ijkToRAS = self.sessions[sessionId]
+    mask = self.masks[model]
+    # Index of the phantom voxel nearest to each voxel of the session grid, per axis (IJK)
+    indices = []
+    for axis in range(3):
+      size = shape[2 - axis]
+      position = ijkToRAS[axis][axis] * np.arange(size) + ijkToRAS[axis][3]
+      indices.append(np.clip(np.round(position / self.spacing[axis]).astype(int), 0, mask.shape[2 - axis] - 1))
+    result = mask[np.ix_(indices[2], indices[1], indices[0])].astype(np.uint8)
+    if outputFile:
+      with open(outputFile, 'wb') as output:
+        for chunk in temporal_bone_inference.iterNrrd(result, ijkToRAS):
+          output.write(chunk)
+    return (result if decode else None), None, {}
@@ -0,0 +1,269 @@
+"""
+Accuracy regression of segmentation outputs against a reference run.
+
+Compares the labelmaps a version of the pipeline wrote (oticcapsule_labelmap.nrrd,
+cochlear_duct_labelmap.nrrd, ..., the bit-packed structures_labelmap.nrrd and .seg.nrrd
+files) with those of a reference run, so that a faster post-processing, resampling or
+export path can be shown not to change the masks. For every structure it gives the
+Dice coefficient, the relative volume difference and the 95th percentile and maximum
+symmetric Hausdorff distances in mm, and checks them against tolerances.
+
+Distances are computed with Euclidean distance transforms of the surface voxels,
+restricted to the bounding box of both masks: the nearest surface voxel of one mask
+to a surface voxel of the other always lies in that box. Identical masks skip the
+distance transforms altogether, so a cohort whose outputs did not change is compared
+in about the time it takes to read it. Files are compared in parallel processes.
+
+  python temporal_bone_accuracy.py REFERENCE_DIR CANDIDATE_DIR [--min-dice 0.99] [--max-hd95 0.25]
+    [--max-hausdorff 1.0] [--max-volume-difference 0.01] [--workers 8] [--report accuracy.csv]
+
+The exit code is 1 when a structure is out of tolerance or missing from the candidate run,
+or when a reference file has no structure to compare.
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import os
+import sys
+
+import numpy as np
+
+from temporal_bone_postprocessing import POSTPROCESSING_TARGETS, _boundingBox
+
+# Default tolerances: a voxel of 0.25 mm on the 95th percentile surface distance, one mm at worst
+ACCURACY_TOLERANCES = {
+  "minimumDice": 0.99,
+  "maximumVolumeDifference": 0.01,
+  "maximumHausdorff95Mm": 0.25,
+  "maximumHausdorffMm": 1.0,
+}
+
+# Columns of the report, keys of the rows of compareDirectories
+ACCURACY_COLUMNS = ['file', 'structure', 'reference_voxels', 'candidate_voxels', 'dice', 'volume_difference',
+  'hausdorff95_mm', 'hausdorff_mm', 'passed', 'failures']
+
+# Structure of each bit of structures_labelmap.nrrd, in the order of the models
+COMBINED_LABELMAP_NAME = 'structures_labelmap.nrrd'
+COMBINED_LABELMAP_STRUCTURES = tuple(POSTPROCESSING_TARGETS.values())
+
+
+def _surface(mask):
+  # Voxels of the mask with a 6-neighbour outside it
+  from scipy import ndimage
+  return mask & ~ndimage.binary_erosion(mask, border_value=0)
+
+
+def compareMasks(mask, reference, spacing):
+  """
+  Overlap and surface distances of a mask to a reference mask of the same geometry.
+  :param spacing: IJK spacing in mm
+  :return: dict of reference_voxels, candidate_voxels, dice, volume_difference (relative to the reference),
+    hausdorff95_mm and hausdorff_mm (infinite when only one of the masks is empty)
+  """
+  from scipy import ndimage
+  mask = np.asarray(mask, dtype=bool)
+  reference = np.asarray(reference, dtype=bool)
+  if mask.shape != reference.shape:
+    raise ValueError('Masks of different shapes: %s and %s' % (mask.shape, reference.shape))
+  # Padding keeps the surface of masks touching the box border inside the box
+  box = _boundingBox(mask | reference, (1, 1, 1))
+  if box is None:
+    return dict(reference_voxels=0, candidate_voxels=0, dice=1.0, volume_difference=0.0, hausdorff95_mm=0.0, hausdorff_mm=0.0)
+  mask, reference = np.pad(mask[box], 1), np.pad(reference[box], 1)
+  maskVoxels, referenceVoxels = int(np.count_nonzero(mask)), int(np.count_nonzero(reference))
+  result = dict(reference_voxels=referenceVoxels, candidate_voxels=maskVoxels,
+    dice=2.0 * int(np.count_nonzero(mask & reference)) / (maskVoxels + referenceVoxels),
+    volume_difference=(maskVoxels - referenceVoxels) / referenceVoxels if referenceVoxels else float('inf'))
+  if np.array_equal(mask, reference):
+    result.update(hausdorff95_mm=0.0, hausdorff_mm=0.0)
+    return result
+  if not maskVoxels or not referenceVoxels:
+    result.update(hausdorff95_mm=float('inf'), hausdorff_mm=float('inf'))
+    return result
+
+  sampling = np.asarray(spacing, dtype=float)[::-1]
+  maskSurface, referenceSurface = _surface(mask), _surface(reference)
+  # Distance of the surface voxels of each mask to the nearest surface voxel of the other
+  distances = np.concatenate([
+    ndimage.distance_transform_edt(~referenceSurface, sampling=sampling)[maskSurface],
+    ndimage.distance_transform_edt(~maskSurface, sampling=sampling)[referenceSurface]])
+  result.update(hausdorff95_mm=float(np.percentile(distances, 95)), hausdorff_mm=float(distances.max()))
+  return result
+
+
+def checkTolerances(result, tolerances=None):
+  """
+  Names of the measures of a compareMasks result that are out of tolerance, empty if it passes.
+  :param tolerances: dict of the keys of ACCURACY_TOLERANCES, the defaults for the missing ones
+  """
+  tolerances = dict(ACCURACY_TOLERANCES, **(tolerances or {}))
+  failures = []
+  if result['dice'] < tolerances['minimumDice']:
+    failures.append('dice')
+  if abs(result['volume_difference']) > tolerances['maximumVolumeDifference']:
+    failures.append('volume_difference')
+  if result['hausdorff95_mm'] > tolerances['maximumHausdorff95Mm']:
+    failures.append('hausdorff95_mm')
+  if result['hausdorff_mm'] > tolerances['maximumHausdorffMm']:
+    failures.append('hausdorff_mm')
+  return failures
+
+
+def readStructures(path):
+  """
+  Structure masks of a labelmap file, memory-mapped when the file is raw.
+  A .seg.nrrd file gives one structure per segment, from the layer of its segment in layered (4D) files,
+  structures_labelmap.nrrd one per bit and any other labelmap a single structure named after the file.
+  :return: (dict of structure name to boolean KJI mask, IJK spacing)
+  """
+  import temporal_bone_inference
+  import temporal_bone_mmap
+  lines, header, offset = temporal_bone_mmap.readNrrdHeader(path)
+  name = os.path.basename(path)
+  layered = int(header.get('dimension', 3)) == 4
+  if layered:
+    if not name.endswith('.seg.nrrd'):
+      raise ValueError('4D labelmaps are only supported as layered .seg.nrrd files: ' + path)
+    # Layers are the first, fastest axis, without a space direction
+    labelmap, header = temporal_bone_inference.readNrrdArray(path)
+    header = dict(header, **{'space directions': ' '.join(direction for direction in header['space directions'].split()
+      if direction != 'none')})
+  else:
+    labelmap, header = temporal_bone_mmap.openNrrd(path)
+  ijkToRAS = np.asarray(temporal_bone_inference.nrrdIJKToRAS(header))
+  spacing = tuple(np.linalg.norm(ijkToRAS[:3, :3], axis=0))
+  if name.endswith('.seg.nrrd'):
+    # Segments are described by "key:=value" lines
+    keyValues = temporal_bone_mmap.nrrdKeyValues(lines)
+    structures = {}
+    index = 0
+    while 'Segment%d_Name' % index in keyValues:
+      labelValue = int(keyValues.get('Segment%d_LabelValue' % index, index + 1))
+      layer = int(keyValues.get('Segment%d_Layer' % index, 0))
+      if layered and layer >= labelmap.shape[-1]:
+        raise ValueError('Segment %d of %s is in layer %d of %d' % (index, path, layer, labelmap.shape[-1]))
+      structures[keyValues['Segment%d_Name' % index]] = (labelmap[..., layer] if layered else labelmap) == labelValue
+      index += 1
+    return structures, spacing
+  if name == COMBINED_LABELMAP_NAME:
+    return {structure: (labelmap & (1 << bit)) > 0 for bit, structure in enumerate(COMBINED_LABELMAP_STRUCTURES)}, spacing
+  return {name[:-len('.nrrd')]: labelmap > 0}, spacing
+
+
+def compareFiles(referencePath, candidatePath, tolerances=None):
+  """
+  Compare the structures of two labelmap files.
+  :return: list of report rows (ACCURACY_COLUMNS) without the file column, one per structure of the reference
+  """
+  references, spacing = readStructures(referencePath)
+  if not references:
+    # Nothing to compare is a failure, not a pass
+    return [dict(structure='', passed=False, failures='no structures in the reference')]
+  candidates, candidateSpacing = readStructures(candidatePath)
+  if not np.allclose(spacing, candidateSpacing):
+    raise ValueError('Spacing %s of %s differs from the reference %s' % (candidateSpacing, candidatePath, spacing))
+  rows = []
+  for structure, reference in references.items():
+    if structure not in candidates:
+      rows.append(dict(structure=structure, passed=False, failures='missing'))
+      continue
+    result = compareMasks(candidates[structure], reference, spacing)
+    failures = checkTolerances(result, tolerances)
+    result.update(structure=structure, passed=not failures, failures=' '.join(failures))
+    rows.append(result)
+  return rows
+
+
+def labelmapFiles(directory):
+  """
+  Paths of the labelmap files of a run, relative to its directory, sorted.
+  """
+  paths = []
+  for root, directories, files in os.walk(directory):
+    for name in files:
+      if name.endswith('.nrrd') and ('labelmap' in name or name.endswith('.seg.nrrd')):
+        paths.append(os.path.relpath(os.path.join(root, name), directory))
+  return sorted(paths)
+
+
+def compareDirectories(referenceDirectory, candidateDirectory, tolerances=None, workers=None):
+  """
+  Compare every labelmap file of a reference run with the file of the same relative path in a candidate run,
+  one process per file at a time.
+  :param workers: number of processes, os.cpu_count() by default
+  :return: list of report rows (ACCURACY_COLUMNS)
+  """
+  files = labelmapFiles(referenceDirectory)
+  workers = min(workers or os.cpu_count() or 1, max(1, len(files)))
+  rows = []
+  executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+  try:
+    futures = {}
+    for relativePath in files:
+      candidatePath = os.path.join(candidateDirectory, relativePath)
+      if not os.path.exists(candidatePath):
+        futures[relativePath] = None
+        continue
+      arguments = (os.path.join(referenceDirectory, relativePath), candidatePath, tolerances)
+      futures[relativePath] = executor.submit(compareFiles, *arguments) if executor else arguments
+    for relativePath, future in futures.items():
+      if future is None:
+        fileRows = [dict(structure='', passed=False, failures='missing file')]
+      else:
+        try:
+          fileRows = future.result() if executor else compareFiles(*future)
+        except Exception as error:
+          fileRows = [dict(structure='', passed=False, failures='error: %s' % error)]
+      for row in fileRows:
+        rows.append(dict(dict.fromkeys(ACCURACY_COLUMNS), file=relativePath, **row))
+  finally:
+    if executor:
+      executor.shutdown()
+  return rows
+
+
+def writeReport(rows, path):
+  """
+  Write the report rows as a CSV file.
+  """
+  with open(path, 'w', newline='') as reportFile:
+    writer = csv.DictWriter(reportFile, ACCURACY_COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('reference_directory')
+  parser.add_argument('candidate_directory')
+  parser.add_argument('--min-dice', type=float, default=ACCURACY_TOLERANCES['minimumDice'])
+  parser.add_argument('--max-volume-difference', type=float, default=ACCURACY_TOLERANCES['maximumVolumeDifference'],
+    help='largest relative volume difference')
+  parser.add_argument('--max-hd95', type=float, default=ACCURACY_TOLERANCES['maximumHausdorff95Mm'],
+    help='largest 95th percentile Hausdorff distance (mm)')
+  parser.add_argument('--max-hausdorff', type=float, default=ACCURACY_TOLERANCES['maximumHausdorffMm'],
+    help='largest Hausdorff distance (mm)')
+  parser.add_argument('--workers', type=int, help='processes comparing files, all cores by default')
+  parser.add_argument('--report', help='write the comparison of every structure to this CSV file')
+  args = parser.parse_args(argv)
+  tolerances = {"minimumDice": args.min_dice, "maximumVolumeDifference": args.max_volume_difference,
+    "maximumHausdorff95Mm": args.max_hd95, "maximumHausdorffMm": args.max_hausdorff}
+
+  rows = compareDirectories(args.reference_directory, args.candidate_directory, tolerances, args.workers)
+  if args.report:
+    writeReport(rows, args.report)
+  failed = [row for row in rows if not row['passed']]
+  for row in failed:
+    if row['dice'] is None:
+      print('FAIL %s %s: %s' % (row['file'], row['structure'], row['failures']))
+    else:
+      print('FAIL %s %s: %s (Dice %.4f, volume %+.2f%%, HD95 %.2f mm, HD %.2f mm)' % (row['file'], row['structure'],
+        row['failures'], row['dice'], 100 * row['volume_difference'], row['hausdorff95_mm'], row['hausdorff_mm']))
+  print('%d structures of %d files compared, %d passed, %d failed' % (len(rows), len({row['file'] for row in rows}),
+    len(rows) - len(failed), len(failed)))
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
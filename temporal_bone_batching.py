@@ -0,0 +1,132 @@
+"""
+Micro-batching of inference requests across volumes.
+
+Requests for the same model coming from several volumes (or ROI crops) in flight at the
+same time, for example the inference stage of a cohort pipeline running on several
+threads, are collected into one batch: a batch is sent as soon as it holds
+maxBatchSize requests, or when its oldest request has waited maxWaitSeconds. The
+batch goes to the segmentationBatch method of the inference client:
+LocalInferenceClient evaluates the tiles of all the volumes in the same network calls,
+and AIAAStreamingClient sends the requests together over its keep-alive connections.
+"""
+
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
+
+class MicroBatcher:
+  """
+  Collects segmentation requests per model into batches for an inference client.
+  """
+
+  def __init__(self, client, maxBatchSize=4, maxWaitSeconds=0.1, maxConcurrentBatches=1):
+    """
+    :param client: inference client with a segmentationBatch method
+    :param maxBatchSize: requests of a batch, sent as soon as it is full
+    :param maxWaitSeconds: time the first request of a batch waits for more requests
+    :param maxConcurrentBatches: batches requested at the same time
+    """
+    self.client = client
+    self.maxBatchSize = maxBatchSize
+    self.maxWaitSeconds = maxWaitSeconds
+    # Number of batches sent of each size
+    self.batchSizes = collections.Counter()
+    self._pending = collections.OrderedDict()
+    self._condition = threading.Condition()
+    self._closed = False
+    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=maxConcurrentBatches, thread_name_prefix='MicroBatcher')
+    self._dispatcher = threading.Thread(target=self._dispatch, name='MicroBatcher-dispatch', daemon=True)
+    self._dispatcher.start()
+
+  def submit(self, model, volumeArray, ijkToRAS, outputFile=None, decode=True):
+    """
+    Queue the segmentation of a volume.
+    :param ijkToRAS: 4x4 IJK to RAS matrix as nested lists
+    :return: concurrent.futures.Future of the client segmentation result (mask, header, params)
+    """
+    future = concurrent.futures.Future()
+    with self._condition:
+      if self._closed:
+        raise RuntimeError('MicroBatcher is closed')
+      self._pending.setdefault((model, decode), []).append((time.monotonic(), (volumeArray, ijkToRAS), outputFile, future))
+      self._condition.notify()
+    return future
+
+  def segmentation(self, model, volumeArray, ijkToRAS, outputFile=None, decode=True):
+    """
+    Segment a volume in the next batch of its model, blocking until its result arrives.
+    """
+    return self.submit(model, volumeArray, ijkToRAS, outputFile, decode).result()
+
+  def _nextBatch(self):
+    # Full batch, or batch whose first request waited long enough, else the time until one is due
+    now = time.monotonic()
+    wait = None
+    for key, requests in self._pending.items():
+      due = requests[0][0] + self.maxWaitSeconds
+      if len(requests) >= self.maxBatchSize or due <= now or self._closed:
+        batch = requests[:self.maxBatchSize]
+        del requests[:self.maxBatchSize]
+        if not requests:
+          del self._pending[key]
+        return key, batch, None
+      wait = due - now if wait is None else min(wait, due - now)
+    return None, None, wait
+
+  def _dispatch(self):
+    while True:
+      with self._condition:
+        while True:
+          key, batch, wait = self._nextBatch()
+          if batch or (self._closed and not self._pending):
+            break
+          self._condition.wait(wait)
+      if not batch:
+        return
+      self.batchSizes[len(batch)] += 1
+      self._executor.submit(self._run, key, batch)
+
+  def _run(self, key, batch):
+    model, decode = key
+    # Requests cancelled while they waited are left out
+    batch = [request for request in batch if request[3].set_running_or_notify_cancel()]
+    if not batch:
+      return
+    futures = [future for _, _, _, future in batch]
+    try:
+      results = self.client.segmentationBatch(model, [volume for _, volume, _, _ in batch],
+        [outputFile for _, _, outputFile, _ in batch], decode)
+    except Exception as error:
+      logging.warning('Batch of %d %s requests failed: %s' % (len(batch), model, error))
+      for future in futures:
+        future.set_exception(error)
+      return
+    for future, result in zip(futures, results):
+      future.set_result(result)
+
+  def statistics(self):
+    """
+    :return: dict of batches, requests and meanBatchSize
+    """
+    batches = sum(self.batchSizes.values())
+    requests = sum(size * count for size, count in self.batchSizes.items())
+    return {'batches': batches, 'requests': requests, 'meanBatchSize': requests / batches if batches else 0.0}
+
+  def close(self):
+    """
+    Send the pending requests and wait for every batch to finish.
+    """
+    with self._condition:
+      self._closed = True
+      self._condition.notify()
+    self._dispatcher.join()
+    self._executor.shutdown(wait=True)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *excInfo):
+    self.close()
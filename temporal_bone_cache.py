@@ -0,0 +1,120 @@
+"""
+Size-bounded, content-addressed on-disk file cache.
+
+Files are stored under a key derived from the content they were computed from,
+so results can be reused across runs and across processes sharing the cache
+directory. The least recently used files are evicted when the cache grows over
+its size limit.
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+
+
+def arrayDigest(array, *metadata):
+  """
+  Hex digest of the voxels of a NumPy array, its type and shape, and any extra metadata
+  (for example the volume geometry).
+  """
+  digest = hashlib.blake2b(digest_size=20)
+  digest.update(repr((str(array.dtype), array.shape, metadata)).encode('utf-8'))
+  digest.update(memoryview(array.reshape(-1) if array.flags.c_contiguous else array.ravel()))
+  return digest.hexdigest()
+
+
+def volumeArrayDigest(volumeArray, ijkToRAS):
+  """
+  Digest of the voxels and geometry of a volume given as a KJI array and its 4x4 IJK to RAS matrix.
+  """
+  return arrayDigest(volumeArray, tuple(round(float(ijkToRAS[row][column]), 6) for row in range(3) for column in range(4)))
+
+
+def cacheKey(*parts):
+  """
+  Key of a cache entry computed from its parts (content digests, names, versions, parameters).
+  """
+  return hashlib.blake2b('\0'.join(str(part) for part in parts).encode('utf-8'), digest_size=20).hexdigest()
+
+
+class FileCache:
+  """
+  Directory of cached files with LRU eviction. Safe to use from several threads and processes:
+  entries are written to a temporary name and renamed into place.
+  """
+
+  def __init__(self, directory, maximumSizeBytes=10*1024**3, extension='.nrrd'):
+    self.directory = directory
+    self.maximumSizeBytes = maximumSizeBytes
+    self.extension = extension
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._lock = threading.Lock()
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+
+  def path(self, key):
+    return os.path.join(self.directory, key + self.extension)
+
+  def get(self, key):
+    """
+    Path of the cached file of key, or None. A hit marks the entry as recently used.
+    """
+    path = self.path(key)
+    try:
+      os.utime(path)
+    except OSError:
+      with self._lock:
+        self.misses += 1
+      return None
+    with self._lock:
+      self.hits += 1
+    return path
+
+  def put(self, key, sourcePath, move=False):
+    """
+    Store a copy of sourcePath (or move it) under key.
+    :return: path of the cached file
+    """
+    temporaryPath = os.path.join(self.directory, '.' + uuid.uuid4().hex + '.tmp')
+    if move:
+      shutil.move(sourcePath, temporaryPath)
+    else:
+      shutil.copyfile(sourcePath, temporaryPath)
+    os.replace(temporaryPath, self.path(key))
+    self.evict(keep=self.path(key))
+    return self.path(key)
+
+  def evict(self, keep=None):
+    """
+    Remove the least recently used entries until the cache fits in maximumSizeBytes.
+    :param keep: path of an entry that is never evicted, such as the one just stored
+    """
+    entries = []
+    for entry in os.scandir(self.directory):
+      if entry.name.endswith(self.extension):
+        try:
+          stat = entry.stat()
+        except OSError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+    totalSize = sum(size for mtime, size, path in entries)
+    for mtime, size, path in sorted(entries):
+      if totalSize <= self.maximumSizeBytes:
+        break
+      if path == keep:
+        continue
+      try:
+        os.remove(path)
+      except OSError:
+        continue
+      totalSize -= size
+      with self._lock:
+        self.evictions += 1
+
+  def statistics(self):
+    with self._lock:
+      return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
@@ -0,0 +1,390 @@
+"""
+DICOM export of volumes and segmentations straight from their voxel arrays, with pydicom.
+
+A volume is written either as a classic CT series, one file per slice written by a
+thread pool, or as a single Enhanced CT multi-frame object. Structures are written
+as one binary DICOM Segmentation object referencing the instances of the volume, with
+frames only for the slices each structure covers, each frame deriving from its slice.
+
+Arrays are in KJI order and ijkToRAS is the 4x4 IJK to RAS matrix of the volume;
+DICOM geometry is in LPS. Voxel values are written unscaled as 16-bit integers, so
+CT volumes keep their Hounsfield units.
+"""
+
+import concurrent.futures
+import datetime
+import os
+
+import numpy as np
+
+CT_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.2'
+ENHANCED_CT_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.2.1'
+SEGMENTATION_STORAGE = '1.2.840.10008.5.1.4.1.1.66.4'
+
+# Segmented property category and type of every structure: (code value, coding scheme, meaning)
+ANATOMICAL_STRUCTURE_CODE = ('123037004', 'SCT', 'Anatomical Structure')
+# Anatomic region of Enhanced CT frames
+TEMPORAL_BONE_CODE = ('60911003', 'SCT', 'Temporal bone')
+# Derivation of Segmentation frames from their slice of the volume
+SEGMENTATION_DERIVATION_CODE = ('113076', 'DCM', 'Segmentation')
+SOURCE_IMAGE_PURPOSE_CODE = ('121322', 'DCM', 'Source image for image processing operation')
+
+# Enhanced General Equipment, Type 1 in Enhanced CT and Segmentation objects
+MANUFACTURER = 'TemporalBoneAutosegmentation'
+MANUFACTURER_MODEL_NAME = 'SlicerTemporalBoneAutosegmentation'
+DEVICE_SERIAL_NUMBER = '1'
+SOFTWARE_VERSIONS = '1'
+
+
+def newStudy(patientName, patientID=None, studyDescription='Auto-segmentation Study'):
+  """
+  Patient and study attributes shared by the series of one export, with new UIDs.
+  """
+  from pydicom.uid import generate_uid
+  now = datetime.datetime.now()
+  return {
+    'PatientName': patientName,
+    'PatientID': patientID or patientName,
+    'PatientBirthDate': '',
+    'PatientSex': '',
+    'StudyInstanceUID': generate_uid(),
+    'StudyID': '1',
+    'StudyDate': now.strftime('%Y%m%d'),
+    'StudyTime': now.strftime('%H%M%S'),
+    'StudyDescription': studyDescription,
+    'AccessionNumber': '',
+    'ReferringPhysicianName': '',
+    'FrameOfReferenceUID': generate_uid(),
+  }
+
+
+def sliceGeometry(ijkToRAS, sliceCount):
+  """
+  DICOM geometry of the slices of a volume.
+  :return: (ImageOrientationPatient, PixelSpacing, slice spacing, ImagePositionPatient of each slice)
+  """
+  ijkToLPS = np.diag([-1.0, -1.0, 1.0, 1.0]).dot(np.asarray(ijkToRAS, dtype=float))
+  spacing = np.linalg.norm(ijkToLPS[:3, :3], axis=0)
+  orientation = list(ijkToLPS[:3, 0] / spacing[0]) + list(ijkToLPS[:3, 1] / spacing[1])
+  positions = [list(ijkToLPS.dot([0, 0, k, 1])[:3]) for k in range(sliceCount)]
+  # PixelSpacing is the spacing between rows (J), then between columns (I)
+  return [round(value, 8) for value in orientation], [float(spacing[1]), float(spacing[0])], float(spacing[2]), positions
+
+
+def _pixelArray(volumeArray):
+  if volumeArray.dtype == np.int16:
+    return volumeArray
+  if volumeArray.size and (volumeArray.min() < -32768 or volumeArray.max() > 32767):
+    raise ValueError('Voxel values out of the 16-bit range')
+  return np.rint(volumeArray).astype(np.int16) if volumeArray.dtype.kind == 'f' else volumeArray.astype(np.int16)
+
+
+def _dataset(sopClassUID, study, seriesInstanceUID, seriesNumber, modality, seriesDescription, sopInstanceUID=None):
+  from pydicom.dataset import Dataset, FileMetaDataset
+  from pydicom.uid import ExplicitVRLittleEndian, PYDICOM_IMPLEMENTATION_UID, generate_uid
+  dataset = Dataset()
+  dataset.file_meta = FileMetaDataset()
+  dataset.file_meta.MediaStorageSOPClassUID = sopClassUID
+  dataset.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+  dataset.file_meta.ImplementationClassUID = PYDICOM_IMPLEMENTATION_UID
+  dataset.SOPClassUID = sopClassUID
+  dataset.SOPInstanceUID = sopInstanceUID or generate_uid()
+  dataset.file_meta.MediaStorageSOPInstanceUID = dataset.SOPInstanceUID
+  for keyword, value in study.items():
+    setattr(dataset, keyword, value)
+  now = datetime.datetime.now()
+  dataset.SeriesInstanceUID = seriesInstanceUID
+  dataset.SeriesNumber = seriesNumber
+  dataset.SeriesDescription = seriesDescription
+  dataset.SeriesDate = dataset.ContentDate = now.strftime('%Y%m%d')
+  dataset.SeriesTime = dataset.ContentTime = now.strftime('%H%M%S')
+  dataset.Modality = modality
+  dataset.Manufacturer = MANUFACTURER
+  dataset.ManufacturerModelName = MANUFACTURER_MODEL_NAME
+  dataset.DeviceSerialNumber = DEVICE_SERIAL_NUMBER
+  dataset.SoftwareVersions = SOFTWARE_VERSIONS
+  dataset.PositionReferenceIndicator = ''
+  dataset.SpecificCharacterSet = 'ISO_IR 100'
+  return dataset
+
+
+def _imagePixelAttributes(dataset, rows, columns, bitsAllocated=16, signed=True):
+  dataset.SamplesPerPixel = 1
+  dataset.PhotometricInterpretation = 'MONOCHROME2'
+  dataset.Rows = rows
+  dataset.Columns = columns
+  dataset.BitsAllocated = bitsAllocated
+  dataset.BitsStored = bitsAllocated
+  dataset.HighBit = bitsAllocated - 1
+  dataset.PixelRepresentation = 1 if signed else 0
+
+
+def saveDataset(dataset, path):
+  """
+  Write a dataset as a DICOM file, with pydicom 2 or 3.
+  """
+  import pydicom
+  if int(pydicom.__version__.split('.')[0]) < 3:
+    dataset.is_little_endian = True
+    dataset.is_implicit_VR = False
+    dataset.save_as(path, write_like_original=False)
+  else:
+    dataset.save_as(path, enforce_file_format=True)
+  return os.path.getsize(path)
+
+
+def writeClassicSeries(volumeArray, ijkToRAS, directory, study, seriesDescription='Isotropic volume', workers=None):
+  """
+  Write a volume as a CT series of single-frame files IMG0001.dcm, IMG0002.dcm... in directory.
+  :return: dict of the number of files, bytes written, SeriesInstanceUID, SOPClassUID and the
+    SOPInstanceUID of each slice, in K order
+  """
+  from pydicom.uid import generate_uid
+  pixels = _pixelArray(volumeArray)
+  orientation, pixelSpacing, sliceSpacing, positions = sliceGeometry(ijkToRAS, pixels.shape[0])
+  seriesInstanceUID = generate_uid()
+  sopInstanceUIDs = [generate_uid() for k in range(pixels.shape[0])]
+  windowCenter, windowWidth = 400, 4000
+
+  def writeSlice(k):
+    dataset = _dataset(CT_IMAGE_STORAGE, study, seriesInstanceUID, 1, 'CT', seriesDescription, sopInstanceUIDs[k])
+    dataset.ImageType = ['DERIVED', 'SECONDARY', 'AXIAL']
+    dataset.InstanceNumber = k + 1
+    dataset.ImagePositionPatient = positions[k]
+    dataset.ImageOrientationPatient = orientation
+    dataset.PixelSpacing = pixelSpacing
+    dataset.SliceThickness = sliceSpacing
+    dataset.SliceLocation = positions[k][2]
+    dataset.RescaleIntercept = 0
+    dataset.RescaleSlope = 1
+    dataset.RescaleType = 'HU'
+    dataset.WindowCenter = windowCenter
+    dataset.WindowWidth = windowWidth
+    dataset.KVP = ''
+    _imagePixelAttributes(dataset, pixels.shape[1], pixels.shape[2])
+    dataset.PixelData = np.ascontiguousarray(pixels[k]).astype('<i2', copy=False).tobytes()
+    return saveDataset(dataset, os.path.join(directory, 'IMG%04d.dcm' % (k + 1)))
+
+  # Encoding is in Python, but the file writes of the threads overlap
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers or min(8, (os.cpu_count() or 1) * 2)) as executor:
+    sizes = list(executor.map(writeSlice, range(pixels.shape[0])))
+  return {'files': len(sizes), 'bytes': sum(sizes), 'seriesInstanceUID': seriesInstanceUID,
+    'sopClassUID': CT_IMAGE_STORAGE, 'sopInstanceUIDs': sopInstanceUIDs}
+
+
+def writeEnhancedCT(volumeArray, ijkToRAS, path, study, seriesDescription='Isotropic volume'):
+  """
+  Write a volume as a single Enhanced CT multi-frame file, one frame per slice.
+  :return: dict of the number of files, bytes written, SeriesInstanceUID, SOPClassUID and the
+    SOPInstanceUID of the file, as a one-item list
+  """
+  from pydicom.dataset import Dataset
+  from pydicom.tag import Tag
+  from pydicom.uid import generate_uid
+  pixels = _pixelArray(volumeArray)
+  orientation, pixelSpacing, sliceSpacing, positions = sliceGeometry(ijkToRAS, pixels.shape[0])
+  seriesInstanceUID = generate_uid()
+  dataset = _dataset(ENHANCED_CT_IMAGE_STORAGE, study, seriesInstanceUID, 1, 'CT', seriesDescription)
+  dataset.ImageType = ['DERIVED', 'PRIMARY', 'VOLUME', 'NONE']
+  dataset.InstanceNumber = 1
+  dataset.AcquisitionDateTime = dataset.ContentDate + dataset.ContentTime
+  dataset.ContentQualification = 'RESEARCH'
+  dataset.BurnedInAnnotation = 'NO'
+  dataset.PresentationLUTShape = 'IDENTITY'
+  dataset.PixelPresentation = 'MONOCHROME'
+  dataset.VolumetricProperties = 'VOLUME'
+  dataset.VolumeBasedCalculationTechnique = 'NONE'
+  dataset.LossyImageCompression = '00'
+  _imagePixelAttributes(dataset, pixels.shape[1], pixels.shape[2])
+  dataset.NumberOfFrames = pixels.shape[0]
+
+  dimensionOrganizationUID = generate_uid()
+  organization = Dataset()
+  organization.DimensionOrganizationUID = dimensionOrganizationUID
+  dataset.DimensionOrganizationSequence = [organization]
+  dimension = Dataset()
+  dimension.DimensionOrganizationUID = dimensionOrganizationUID
+  dimension.DimensionIndexPointer = Tag('InStackPositionNumber')
+  dimension.FunctionalGroupPointer = Tag('FrameContentSequence')
+  dataset.DimensionIndexSequence = [dimension]
+
+  shared = Dataset()
+  shared.PixelMeasuresSequence = [_pixelMeasures(pixelSpacing, sliceSpacing)]
+  shared.PlaneOrientationSequence = [_planeOrientation(orientation)]
+  transformation = Dataset()
+  transformation.RescaleIntercept = 0
+  transformation.RescaleSlope = 1
+  transformation.RescaleType = 'HU'
+  shared.PixelValueTransformationSequence = [transformation]
+  frameType = Dataset()
+  frameType.FrameType = ['DERIVED', 'PRIMARY', 'VOLUME', 'NONE']
+  shared.CTImageFrameTypeSequence = [frameType]
+  anatomy = Dataset()
+  anatomy.FrameLaterality = 'B'
+  anatomy.AnatomicRegionSequence = [_code(TEMPORAL_BONE_CODE)]
+  shared.FrameAnatomySequence = [anatomy]
+  irradiation = Dataset()
+  irradiation.IrradiationEventUID = generate_uid()
+  shared.IrradiationEventIdentificationSequence = [irradiation]
+  dataset.SharedFunctionalGroupsSequence = [shared]
+
+  perFrame = []
+  for k, position in enumerate(positions):
+    frame = Dataset()
+    frame.PlanePositionSequence = [_planePosition(position)]
+    content = Dataset()
+    content.StackID = '1'
+    content.InStackPositionNumber = k + 1
+    content.DimensionIndexValues = [k + 1]
+    frame.FrameContentSequence = [content]
+    perFrame.append(frame)
+  dataset.PerFrameFunctionalGroupsSequence = perFrame
+  dataset.PixelData = np.ascontiguousarray(pixels).astype('<i2', copy=False).tobytes()
+  return {'files': 1, 'bytes': saveDataset(dataset, path), 'seriesInstanceUID': seriesInstanceUID,
+    'sopClassUID': ENHANCED_CT_IMAGE_STORAGE, 'sopInstanceUIDs': [dataset.SOPInstanceUID]}
+
+
+def _pixelMeasures(pixelSpacing, sliceSpacing):
+  from pydicom.dataset import Dataset
+  measures = Dataset()
+  measures.PixelSpacing = pixelSpacing
+  measures.SliceThickness = sliceSpacing
+  measures.SpacingBetweenSlices = sliceSpacing
+  return measures
+
+
+def _planeOrientation(orientation):
+  from pydicom.dataset import Dataset
+  planeOrientation = Dataset()
+  planeOrientation.ImageOrientationPatient = orientation
+  return planeOrientation
+
+
+def _planePosition(position):
+  from pydicom.dataset import Dataset
+  planePosition = Dataset()
+  planePosition.ImagePositionPatient = position
+  return planePosition
+
+
+def _code(code):
+  from pydicom.dataset import Dataset
+  item = Dataset()
+  item.CodeValue, item.CodingSchemeDesignator, item.CodeMeaning = code
+  return item
+
+
+def _referencedInstance(sopClassUID, sopInstanceUID, frameNumber=None):
+  from pydicom.dataset import Dataset
+  instance = Dataset()
+  instance.ReferencedSOPClassUID = sopClassUID
+  instance.ReferencedSOPInstanceUID = sopInstanceUID
+  if frameNumber is not None:
+    instance.ReferencedFrameNumber = frameNumber
+  return instance
+
+
+def _derivationImage(volume, k):
+  """
+  Derivation Image item of a Segmentation frame on slice k of volume, a classic series or an
+  Enhanced CT file with one frame per slice.
+  """
+  from pydicom.dataset import Dataset
+  if len(volume['sopInstanceUIDs']) == 1:
+    source = _referencedInstance(volume['sopClassUID'], volume['sopInstanceUIDs'][0], k + 1)
+  else:
+    source = _referencedInstance(volume['sopClassUID'], volume['sopInstanceUIDs'][k])
+  source.PurposeOfReferenceCodeSequence = [_code(SOURCE_IMAGE_PURPOSE_CODE)]
+  # Frames are on the slices of the volume
+  source.SpatialLocationsPreserved = 'YES'
+  derivation = Dataset()
+  derivation.DerivationCodeSequence = [_code(SEGMENTATION_DERIVATION_CODE)]
+  derivation.SourceImageSequence = [source]
+  return derivation
+
+
+def writeSegmentation(segments, shape, ijkToRAS, path, study, volume, seriesDescription='Temporal bone structures'):
+  """
+  Write structures as a binary DICOM Segmentation object on the geometry of a volume.
+  :param segments: list of (label, cropped boolean mask, KJI box of the crop), for example from
+    a temporal_bone_segmentation_store.SegmentationStore. Empty structures are left out.
+  :param shape: KJI shape of the volume
+  :param volume: segmented volume, as writeClassicSeries or writeEnhancedCT return it
+  :return: dict of the number of files, bytes written and SeriesInstanceUID
+  """
+  from pydicom.dataset import Dataset
+  from pydicom.tag import Tag
+  from pydicom.uid import generate_uid
+  orientation, pixelSpacing, sliceSpacing, positions = sliceGeometry(ijkToRAS, shape[0])
+  seriesInstanceUID = generate_uid()
+  dataset = _dataset(SEGMENTATION_STORAGE, study, seriesInstanceUID, 2, 'SEG', seriesDescription)
+  dataset.ImageType = ['DERIVED', 'PRIMARY']
+  dataset.InstanceNumber = 1
+  dataset.ContentLabel = 'SEGMENTATION'
+  dataset.ContentDescription = seriesDescription
+  dataset.ContentCreatorName = MANUFACTURER
+  dataset.SegmentationType = 'BINARY'
+  dataset.LossyImageCompression = '00'
+  _imagePixelAttributes(dataset, shape[1], shape[2], bitsAllocated=1, signed=False)
+  referencedSeries = Dataset()
+  referencedSeries.SeriesInstanceUID = volume['seriesInstanceUID']
+  referencedSeries.ReferencedInstanceSequence = [_referencedInstance(volume['sopClassUID'], sopInstanceUID)
+    for sopInstanceUID in volume['sopInstanceUIDs']]
+  dataset.ReferencedSeriesSequence = [referencedSeries]
+
+  dimensionOrganizationUID = generate_uid()
+  organization = Dataset()
+  organization.DimensionOrganizationUID = dimensionOrganizationUID
+  dataset.DimensionOrganizationSequence = [organization]
+  dimensions = []
+  for pointer, groupPointer in (('ReferencedSegmentNumber', 'SegmentIdentificationSequence'),
+      ('ImagePositionPatient', 'PlanePositionSequence')):
+    dimension = Dataset()
+    dimension.DimensionOrganizationUID = dimensionOrganizationUID
+    dimension.DimensionIndexPointer = Tag(pointer)
+    dimension.FunctionalGroupPointer = Tag(groupPointer)
+    dimensions.append(dimension)
+  dataset.DimensionIndexSequence = dimensions
+
+  shared = Dataset()
+  shared.PixelMeasuresSequence = [_pixelMeasures(pixelSpacing, sliceSpacing)]
+  shared.PlaneOrientationSequence = [_planeOrientation(orientation)]
+  dataset.SharedFunctionalGroupsSequence = [shared]
+
+  segmentSequence = []
+  perFrame = []
+  frames = []
+  for label, mask, box in segments:
+    if not mask.any():
+      continue
+    segmentNumber = len(segmentSequence) + 1
+    segment = Dataset()
+    segment.SegmentNumber = segmentNumber
+    segment.SegmentLabel = label
+    segment.SegmentAlgorithmType = 'AUTOMATIC'
+    segment.SegmentAlgorithmName = MANUFACTURER
+    segment.SegmentedPropertyCategoryCodeSequence = [_code(ANATOMICAL_STRUCTURE_CODE)]
+    segment.SegmentedPropertyTypeCodeSequence = [_code(ANATOMICAL_STRUCTURE_CODE)]
+    segmentSequence.append(segment)
+    # One frame per slice the structure covers
+    for localK, k in enumerate(range(box[0].start, box[0].stop)):
+      frameMask = np.zeros(shape[1:], dtype=bool)
+      frameMask[box[1], box[2]] = mask[localK]
+      frames.append(frameMask)
+      frame = Dataset()
+      frame.PlanePositionSequence = [_planePosition(positions[k])]
+      frame.DerivationImageSequence = [_derivationImage(volume, k)]
+      identification = Dataset()
+      identification.ReferencedSegmentNumber = segmentNumber
+      frame.SegmentIdentificationSequence = [identification]
+      content = Dataset()
+      content.DimensionIndexValues = [segmentNumber, k + 1]
+      frame.FrameContentSequence = [content]
+      perFrame.append(frame)
+  dataset.SegmentSequence = segmentSequence
+  dataset.PerFrameFunctionalGroupsSequence = perFrame
+  dataset.NumberOfFrames = len(frames)
+  # Frames are packed bit after bit, without padding between frames
+  pixelData = np.packbits(np.stack(frames).reshape(-1) if frames else np.zeros(0, dtype=bool), bitorder='little').tobytes()
+  dataset.PixelData = pixelData + b'\0' * (len(pixelData) % 2)
+  return {'files': 1, 'bytes': saveDataset(dataset, path), 'seriesInstanceUID': seriesInstanceUID}
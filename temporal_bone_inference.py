@@ -0,0 +1,498 @@
+"""
+Streaming client for the NVIDIA AIAA v1 segmentation API.
+
+Speaks the same protocol as NvidiaAIAAClientAPI.client_api.AIAAClient, but never
+holds a serialized volume or mask in memory: volumes are uploaded as gzip NRRD
+compressed slab by slab straight from the voxel array, and masks are streamed to
+disk and/or decoded chunk by chunk directly into a NumPy buffer.
+"""
+
+import collections
+import http.client
+import json
+import os
+import socket
+import tempfile
+import threading
+import uuid
+import zlib
+from urllib.parse import quote_plus, urlparse
+
+import numpy as np
+
+NRRD_TYPES = {
+  np.dtype('int8'): 'signed char', np.dtype('uint8'): 'unsigned char',
+  np.dtype('int16'): 'short', np.dtype('uint16'): 'unsigned short',
+  np.dtype('int32'): 'int', np.dtype('uint32'): 'unsigned int',
+  np.dtype('float32'): 'float', np.dtype('float64'): 'double',
+}
+NRRD_DTYPES = {name: dtype for dtype, name in NRRD_TYPES.items()}
+NRRD_DTYPES.update({'uchar': np.dtype('uint8'), 'uint8': np.dtype('uint8'), 'int16': np.dtype('int16'),
+  'ushort': np.dtype('uint16'), 'uint16': np.dtype('uint16'), 'int32': np.dtype('int32'), 'uint': np.dtype('uint32')})
+
+
+class AIAAException(Exception):
+  pass
+
+
+def nrrdHeader(volumeArray, ijkToRAS, encoding='gzip', fields=None):
+  """
+  Attached NRRD header of a KJI volume array with the given 4x4 IJK to RAS matrix (nested lists).
+  :param fields: dict of extra key/value pairs, written as key:=value
+  """
+  # NRRD files are written in LPS like Slicer does
+  directions = ['(%s)' % ','.join('%.17g' % (ijkToRAS[row][column] * (-1 if row < 2 else 1)) for row in range(3))
+    for column in range(3)]
+  origin = '(%s)' % ','.join('%.17g' % (ijkToRAS[row][3] * (-1 if row < 2 else 1)) for row in range(3))
+  lines = ['NRRD0004', 'type: ' + NRRD_TYPES[volumeArray.dtype], 'dimension: 3', 'space: left-posterior-superior',
+    'sizes: %d %d %d' % volumeArray.shape[::-1], 'space directions: ' + ' '.join(directions),
+    'kinds: domain domain domain', 'endian: little', 'encoding: ' + encoding, 'space origin: ' + origin]
+  lines += ['%s:=%s' % (key, value) for key, value in (fields or {}).items()]
+  return ('\n'.join(lines) + '\n\n').encode('latin-1')
+
+
+def iterNrrd(volumeArray, ijkToRAS, compressLevel=1, slabBytes=1 << 22, fields=None):
+  """
+  Generate a gzip NRRD file of the volume in chunks, compressing a slab of slices at a time.
+  """
+  yield nrrdHeader(volumeArray, ijkToRAS, fields=fields)
+  compressor = zlib.compressobj(compressLevel, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+  littleEndian = volumeArray.astype(volumeArray.dtype.newbyteorder('<'), copy=False)
+  sliceBytes = max(1, littleEndian[0].nbytes)
+  slabSlices = max(1, slabBytes // sliceBytes)
+  for start in range(0, littleEndian.shape[0], slabSlices):
+    chunk = compressor.compress(np.ascontiguousarray(littleEndian[start:start+slabSlices]))
+    if chunk:
+      yield chunk
+  yield compressor.flush()
+
+
+def writeNrrd(path, volumeArray, ijkToRAS, fields=None, compressLevel=1):
+  """
+  Write a volume as a gzip NRRD file. zlib releases the GIL, so files can be written by background threads.
+  """
+  with open(path, 'wb') as nrrdFile:
+    for chunk in iterNrrd(volumeArray, ijkToRAS, compressLevel, fields=fields):
+      nrrdFile.write(chunk)
+
+
+def writeSegmentationNrrd(path, labelmap, ijkToRAS, segments):
+  """
+  Write a labelmap as a .seg.nrrd file that Slicer loads as a segmentation with one segment per label.
+  :param segments: list of (label value, segment name, RGB color)
+  """
+  fields = {
+    'Segmentation_MasterRepresentation': 'Binary labelmap',
+    'Segmentation_ContainedRepresentationNames': 'Binary labelmap|',
+    'Segmentation_ReferenceImageExtentOffset': '0 0 0',
+  }
+  extent = '0 %d 0 %d 0 %d' % (labelmap.shape[2] - 1, labelmap.shape[1] - 1, labelmap.shape[0] - 1)
+  for index, (labelValue, name, color) in enumerate(segments):
+    fields.update({
+      'Segment%d_ID' % index: name,
+      'Segment%d_Name' % index: name,
+      'Segment%d_Color' % index: ' '.join('%g' % component for component in color),
+      'Segment%d_LabelValue' % index: labelValue,
+      'Segment%d_Layer' % index: 0,
+      'Segment%d_Extent' % index: extent,
+    })
+  writeNrrd(path, labelmap, ijkToRAS, fields)
+
+
+def nrrdIJKToRAS(header):
+  """
+  4x4 IJK to RAS matrix (nested lists) of the fields of a 3D NRRD header.
+  """
+  space = header.get('space', '')
+  if space in ('left-posterior-superior', 'LPS'):
+    flip = [-1.0, -1.0, 1.0]
+  elif space in ('right-anterior-superior', 'RAS'):
+    flip = [1.0, 1.0, 1.0]
+  else:
+    raise AIAAException('Unsupported NRRD space: ' + space)
+  try:
+    directions = [[float(value) for value in direction.strip('()').split(',')] for direction in header['space directions'].split()]
+    origin = [float(value) for value in header.get('space origin', '(0,0,0)').strip('()').split(',')]
+  except (KeyError, ValueError):
+    raise AIAAException('Unsupported NRRD space directions')
+  if len(directions) != 3 or any(len(direction) != 3 for direction in directions):
+    raise AIAAException('Unsupported NRRD space directions')
+  return [[flip[row] * directions[column][row] for column in range(3)] + [flip[row] * origin[row]] for row in range(3)] + [[0, 0, 0, 1]]
+
+
+def parseNrrdHeader(headerBytes):
+  """
+  Fields of an NRRD header, given the bytes before the blank line that ends it.
+  """
+  fields = {}
+  for line in headerBytes.decode('latin-1').splitlines()[1:]:
+    if line.startswith('#') or ': ' not in line:
+      continue
+    key, value = line.split(': ', 1)
+    fields[key.strip()] = value.strip()
+  return fields
+
+
+class NrrdStreamDecoder:
+  """
+  Incremental NRRD decoder writing the voxels directly into a preallocated NumPy array.
+  Feed it the bytes of an attached-header NRRD file in any chunking.
+  """
+
+  def __init__(self, maximumChunkBytes=1 << 22):
+    self.header = None
+    self.array = None
+    self._headerBytes = b''
+    self._target = None
+    self._offset = 0
+    self._decompressor = None
+    self._maximumChunkBytes = maximumChunkBytes
+
+  def feed(self, data):
+    if self.header is None:
+      self._headerBytes += data
+      headerEnd = self._headerBytes.find(b'\n\n')
+      if headerEnd < 0:
+        return
+      self._startData(self._headerBytes[:headerEnd])
+      data = self._headerBytes[headerEnd+2:]
+      self._headerBytes = None
+    if self._decompressor is None:
+      self._write(data)
+      return
+    while data:
+      self._write(self._decompressor.decompress(data, self._maximumChunkBytes))
+      data = self._decompressor.unconsumed_tail
+
+  def _startData(self, headerBytes):
+    fields = parseNrrdHeader(headerBytes)
+    self.header = fields
+    dtype = NRRD_DTYPES[fields['type']]
+    if dtype.itemsize > 1:
+      dtype = dtype.newbyteorder('>' if fields.get('endian') == 'big' else '<')
+    sizes = [int(size) for size in fields['sizes'].split()]
+    self.array = np.empty(sizes[::-1], dtype=dtype)
+    self._target = self.array.reshape(-1).view(np.uint8)
+    encoding = fields.get('encoding', 'raw')
+    if encoding in ('gzip', 'gz'):
+      # Accept both gzip and zlib framing
+      self._decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32)
+    elif encoding != 'raw':
+      raise AIAAException('Unsupported NRRD encoding: ' + encoding)
+
+  def _write(self, data):
+    if not data:
+      return
+    size = min(len(data), len(self._target) - self._offset)
+    self._target[self._offset:self._offset+size] = np.frombuffer(data, dtype=np.uint8, count=size)
+    self._offset += size
+
+  def finish(self):
+    """
+    :return: the decoded array, in native byte order
+    """
+    if self.array is None or self._offset != len(self._target):
+      raise AIAAException('Truncated NRRD data')
+    if not self.array.dtype.isnative:
+      self.array = self.array.byteswap().view(self.array.dtype.newbyteorder('='))
+    return self.array
+
+
+def readNrrdArray(path, chunkSize=1 << 20):
+  """
+  Decode an attached-header NRRD file into a NumPy array (KJI order) without intermediate copies.
+  :return: (array, header fields)
+  """
+  decoder = NrrdStreamDecoder()
+  with open(path, 'rb') as nrrdFile:
+    for chunk in iter(lambda: nrrdFile.read(chunkSize), b''):
+      decoder.feed(chunk)
+  return decoder.finish(), decoder.header
+
+
+def iterMultipart(read, boundary, chunkSize=1 << 20):
+  """
+  Parse a multipart body incrementally.
+  Yields ('headers', dict) at the start of each part, then ('data', bytes) for its content.
+  """
+  delimiter = b'\r\n--' + boundary.encode('latin-1')
+  buffer = b'\r\n'
+  state = 'preamble'
+  eof = False
+  while True:
+    if state in ('preamble', 'body'):
+      index = buffer.find(delimiter)
+      if index >= 0:
+        if state == 'body' and index:
+          yield 'data', buffer[:index]
+        buffer = buffer[index+len(delimiter):]
+        state = 'delimiter'
+        continue
+      keep = len(delimiter) - 1
+      if state == 'body' and len(buffer) > keep:
+        yield 'data', buffer[:-keep]
+        buffer = buffer[-keep:]
+    elif state == 'delimiter':
+      if len(buffer) >= 2:
+        if buffer.startswith(b'--'):
+          return
+        buffer = buffer[buffer.find(b'\r\n')+2:] if b'\r\n' in buffer else buffer
+        state = 'headers'
+        continue
+    elif state == 'headers':
+      headerEnd = buffer.find(b'\r\n\r\n')
+      if headerEnd >= 0:
+        headers = {}
+        for line in buffer[:headerEnd].decode('latin-1').split('\r\n'):
+          if ':' in line:
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+        yield 'headers', headers
+        buffer = buffer[headerEnd+4:]
+        state = 'body'
+        continue
+    if eof:
+      raise AIAAException('Truncated multipart response')
+    data = read(chunkSize)
+    if not data:
+      eof = True
+    buffer += data
+
+
+def _dispositionParameter(headers, name):
+  for item in headers.get('content-disposition', '').split(';'):
+    key, _, value = item.strip().partition('=')
+    if key == name:
+      return value.strip('"')
+  return None
+
+
+class AIAAStreamingClient:
+  """
+  Client of the AIAA v1 API with streamed, compressed transfers.
+  bytesSent and bytesReceived count the request and response bodies of all calls.
+  Connections are kept alive and reused by later requests, up to poolSize idle connections;
+  connectionsOpened and connectionsReused count them. The client is safe to use from several threads.
+  """
+
+  def __init__(self, serverUrl, timeout=600, chunkSize=1 << 20, compressLevel=1, chunkedUpload=False, poolSize=4):
+    """
+    :param chunkedUpload: send uploads with chunked transfer encoding as they are compressed. Otherwise the
+      compressed volume is spooled to a temporary file first, for servers that require a Content-Length.
+    :param poolSize: idle keep-alive connections kept for later requests, 0 to open one per request
+    """
+    url = urlparse(serverUrl if '://' in serverUrl else 'http://' + serverUrl)
+    self.scheme = url.scheme
+    self.netloc = url.netloc
+    self.basePath = url.path.rstrip('/')
+    # Some configurations point at the model list endpoint, the API paths are added here
+    if self.basePath.endswith('/v1/models'):
+      self.basePath = self.basePath[:-len('/v1/models')]
+    self.timeout = timeout
+    self.chunkSize = chunkSize
+    self.compressLevel = compressLevel
+    self.chunkedUpload = chunkedUpload
+    self.poolSize = poolSize
+    self.bytesSent = 0
+    self.bytesReceived = 0
+    self.connectionsOpened = 0
+    self.connectionsReused = 0
+    self._idle = collections.deque()
+    self._lock = threading.Lock()
+
+  def _connection(self):
+    """
+    :return: (connection, whether it was reused from the pool)
+    """
+    with self._lock:
+      if self._idle:
+        self.connectionsReused += 1
+        return self._idle.pop(), True
+      self.connectionsOpened += 1
+    connectionClass = http.client.HTTPSConnection if self.scheme == 'https' else http.client.HTTPConnection
+    connection = connectionClass(self.netloc, timeout=self.timeout)
+    connection.connect()
+    # Requests are written as headers then body: without this, a reused connection waits for the
+    # delayed acknowledgement of the headers before sending the body
+    connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return connection, False
+
+  def _release(self, connection, response):
+    # Only a connection whose response was read to the end can carry the next request
+    if response.isclosed() and not response.will_close:
+      with self._lock:
+        if len(self._idle) < self.poolSize:
+          self._idle.append(connection)
+          return
+    connection.close()
+
+  def close(self):
+    """
+    Close the idle connections.
+    """
+    with self._lock:
+      connections, self._idle = list(self._idle), collections.deque()
+    for connection in connections:
+      connection.close()
+
+  def _request(self, method, selector, body=None, headers=None):
+    headers = headers or {}
+    # Generated bodies of unknown length are sent with chunked transfer encoding
+    chunked = body is not None and not isinstance(body, bytes) and 'Content-Length' not in headers
+    # A request failing on a pooled connection the server closed meanwhile is sent again on a new one,
+    # when its body can be sent again
+    bodyPosition = body.tell() if hasattr(body, 'seek') else None
+    replayable = body is None or isinstance(body, bytes) or bodyPosition is not None
+    while True:
+      connection, reused = self._connection()
+      try:
+        connection.request(method, self.basePath + selector, body=body, headers=headers, encode_chunked=chunked)
+        response = connection.getresponse()
+        break
+      except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+        connection.close()
+        if not (reused and replayable):
+          raise
+        if bodyPosition is not None:
+          body.seek(bodyPosition)
+    if response.status >= 400:
+      message = response.read()
+      self._release(connection, response)
+      raise AIAAException('%s %s failed with status %d: %s' % (method, selector, response.status, message[:200]))
+    return connection, response
+
+  def _json(self, method, selector):
+    connection, response = self._request(method, selector)
+    try:
+      body = response.read()
+      with self._lock:
+        self.bytesReceived += len(body)
+      return json.loads(body) if body else {}
+    finally:
+      self._release(connection, response)
+
+  def modelList(self):
+    return self._json('GET', '/v1/models')
+
+  def closeSession(self, sessionId):
+    return self._json('DELETE', '/session/' + quote_plus(sessionId))
+
+  def createSession(self, volumeArray, ijkToRAS, expiry=0):
+    """
+    Upload a volume once; later segmentation calls refer to it by the returned session ID.
+    :param volumeArray: KJI voxel array, as returned by slicer.util.arrayFromVolume
+    :param ijkToRAS: 4x4 IJK to RAS matrix as nested lists
+    """
+    boundary = uuid.uuid4().hex
+    preamble = ('--%s\r\nContent-Disposition: form-data; name="image"; filename="image.nrrd"\r\n'
+      'Content-Type: application/octet-stream\r\n\r\n' % boundary).encode('latin-1')
+    epilogue = ('\r\n--%s--\r\n' % boundary).encode('latin-1')
+    headers = {'Content-Type': 'multipart/form-data; boundary=' + boundary}
+
+    def iterBody():
+      yield preamble
+      for chunk in iterNrrd(volumeArray, ijkToRAS, self.compressLevel):
+        if chunk:
+          with self._lock:
+            self.bytesSent += len(chunk)
+          yield chunk
+      yield epilogue
+
+    selector = '/session/?expiry=%d' % expiry
+    if self.chunkedUpload:
+      connection, response = self._request('PUT', selector, iterBody(), headers)
+    else:
+      spooled = tempfile.SpooledTemporaryFile(max_size=64 << 20)
+      for chunk in iterBody():
+        spooled.write(chunk)
+      headers['Content-Length'] = str(spooled.tell())
+      spooled.seek(0)
+      connection, response = self._request('PUT', selector, spooled, headers)
+      spooled.close()
+    try:
+      body = response.read()
+      with self._lock:
+        self.bytesReceived += len(body)
+    finally:
+      self._release(connection, response)
+    return json.loads(body)['session_id']
+
+  def segmentation(self, model, sessionId, outputFile=None, decode=True):
+    """
+    Segment the volume of a session with a model.
+    The mask is streamed to outputFile as received (if given) and decoded into a NumPy array
+    while it downloads (if decode is set), so neither needs the whole response in memory.
+    :return: (mask array or None, NRRD header fields or None, response params)
+    """
+    selector = '/v1/segmentation?model=%s&session_id=%s' % (quote_plus(model), quote_plus(sessionId))
+    boundary = uuid.uuid4().hex
+    body = ('--%s\r\nContent-Disposition: form-data; name="params"\r\n\r\n{}\r\n--%s--\r\n' % (boundary, boundary)).encode('latin-1')
+    connection, response = self._request('POST', selector, body,
+      {'Content-Type': 'multipart/form-data; boundary=' + boundary, 'Content-Length': str(len(body))})
+    try:
+      contentType = response.getheader('Content-Type', '')
+      responseBoundary = contentType.split('boundary=', 1)[1].strip('"') if 'boundary=' in contentType else None
+      if responseBoundary is None:
+        raise AIAAException('Unexpected segmentation response type: ' + contentType)
+
+      def read(size):
+        data = response.read(size)
+        with self._lock:
+          self.bytesReceived += len(data)
+        return data
+
+      paramsBytes = b''
+      decoder = NrrdStreamDecoder() if decode else None
+      output = None
+      part = None
+      try:
+        for event, value in iterMultipart(read, responseBoundary, self.chunkSize):
+          if event == 'headers':
+            part = 'file' if _dispositionParameter(value, 'filename') else _dispositionParameter(value, 'name')
+            if part == 'file' and outputFile and output is None:
+              output = open(outputFile + '.part', 'wb')
+          elif part == 'file':
+            if output:
+              output.write(value)
+            if decoder:
+              decoder.feed(value)
+          elif part == 'params':
+            paramsBytes += value
+      finally:
+        if output:
+          output.close()
+      if output:
+        os.replace(outputFile + '.part', outputFile)
+      params = json.loads(paramsBytes) if paramsBytes.strip() else {}
+      # Read the end of the response, so that the connection can be reused
+      while read(self.chunkSize):
+        pass
+      if decoder:
+        return decoder.finish(), decoder.header, params
+      return None, None, params
+    finally:
+      self._release(connection, response)
+
+  def segmentationBatch(self, model, volumes, outputFiles=None, decode=True):
+    """
+    Segment several volumes with a model (see temporal_bone_batching.MicroBatcher). The v1 API segments
+    one session per request, so the volumes are uploaded and segmented concurrently over the pooled
+    connections; a server batching concurrent requests on its side (as Triton does) runs them together.
+    :param volumes: list of (KJI voxel array, 4x4 IJK to RAS matrix as nested lists)
+    :param outputFiles: list of mask files, one per volume, or None
+    :return: list of segmentation() results, in the order of volumes
+    """
+    import concurrent.futures
+    outputFiles = outputFiles or [None] * len(volumes)
+
+    def segment(volume, outputFile):
+      sessionId = self.createSession(*volume)
+      try:
+        return self.segmentation(model, sessionId, outputFile, decode)
+      finally:
+        self.closeSession(sessionId)
+
+    if len(volumes) == 1:
+      return [segment(volumes[0], outputFiles[0])]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(volumes)) as executor:
+      return list(executor.map(segment, volumes, outputFiles))
@@ -0,0 +1,412 @@
+"""
+Watch-folder ingestion of temporal bone CT volumes.
+
+Volumes copied into an inbox directory are segmented without anyone opening the
+module: once a file has stopped changing for --stable seconds, it is fingerprinted
+and submitted to a temporal_bone_service, which runs
+TemporalBoneAutosegmentationLogic.run on it. Volumes whose fingerprint was already
+segmented or is queued, under any name, are skipped. The fingerprint of an NRRD
+volume is the digest of its voxels and geometry (temporal_bone_cache.volumeArrayDigest),
+so a scan written again with another name or compression is still a duplicate;
+other formats are fingerprinted by their bytes.
+
+The first directory of the path of a volume under the inbox gives its priority class
+(temporal_bone_service.PRIORITIES): volumes in INBOX/urgent/ run before the queued
+volumes of INBOX/routine/ and INBOX/research/; volumes elsewhere get --default-priority.
+
+The inbox is scanned every --poll seconds; with the optional inotify_simple package,
+file events wake the scan up as soon as a copy finishes. Every submission, duplicate
+and finished job is appended to OUTPUT_DIR/ingest.jsonl, which also lets a restarted
+daemon skip the volumes it already handled without reading them again. Finished jobs
+carry their queue wait and their end-to-end latency, from the arrival of the file to
+the end of its segmentation; the p50/p99 of both per priority class are logged and,
+with --prometheus-textfile, exported for the node exporter.
+
+  python temporal_bone_ingest.py --service unix:/tmp/temporal_bone.sock INBOX_DIR OUTPUT_DIR [--poll 2] [--stable 10]
+    [--prometheus-textfile /var/lib/node_exporter/temporal_bone_ingest.prom]
+
+The paths of the inbox and output directories must be the same for the service. The
+service can also watch an inbox itself, see temporal_bone_service.py --watch.
+"""
+
+import argparse
+import collections
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from temporal_bone_service import DEFAULT_PRIORITY, LATENCY_WINDOW, PRIORITIES, ServiceClient, ServiceError, percentile
+
+# Extensions of the volume files picked up in the inbox
+VOLUME_EXTENSIONS = ('.nrrd', '.nhdr', '.nii.gz', '.nii', '.mha', '.mhd')
+
+LEDGER_NAME = 'ingest.jsonl'
+
+# Job states during which the fingerprint of a volume counts as taken
+ACTIVE_STATUSES = ('queued', 'running', 'done')
+
+
+def isVolumeFile(name):
+  """
+  Whether a file of the inbox is a volume to segment. Hidden files, such as partial copies, and
+  segmentations are not.
+  """
+  return not name.startswith('.') and name.endswith(VOLUME_EXTENSIONS) and not name.endswith('.seg.nrrd')
+
+
+def volumeFingerprint(path):
+  """
+  Fingerprint of a volume file: digest of the voxels and geometry of NRRD volumes, of the file bytes otherwise.
+  """
+  import temporal_bone_cache
+  import temporal_bone_inference
+  if path.endswith(('.nrrd', '.nhdr')):
+    import temporal_bone_mmap
+    try:
+      volumeArray, header = temporal_bone_mmap.openNrrd(path)
+      return 'voxels:' + temporal_bone_cache.volumeArrayDigest(volumeArray, temporal_bone_inference.nrrdIJKToRAS(header))
+    except (temporal_bone_inference.AIAAException, KeyError, ValueError):
+      pass
+  digest = hashlib.blake2b(digest_size=20)
+  with open(path, 'rb') as volumeFile:
+    for chunk in iter(lambda: volumeFile.read(1 << 22), b''):
+      digest.update(chunk)
+  return 'file:' + digest.hexdigest()
+
+
+class DirectoryWatcher:
+  """
+  New and changed volume files of a directory tree, reported once they have stopped changing.
+  """
+
+  def __init__(self, directory, stableSeconds=10.0, pollSeconds=2.0):
+    self.directory = directory
+    self.stableSeconds = stableSeconds
+    self.pollSeconds = pollSeconds
+    # Path to (size, mtime, first seen, last change) of the files not reported yet
+    self.pending = {}
+    # Path to (size, mtime) of the reported files
+    self.reported = {}
+    # inotify_simple.INotify waking up wait() on file events, None to poll
+    self.inotify = None
+    self._watched = set()
+    try:
+      import inotify_simple
+      self.inotify = inotify_simple.INotify()
+      self._inotifyFlags = (inotify_simple.flags.CREATE | inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO
+        | inotify_simple.flags.DELETE)
+    except (ImportError, OSError):
+      pass
+
+  def scan(self):
+    """
+    :return: list of (path, size, mtime_ns, arrival time) of the files that became stable since the last scan
+    """
+    now = time.time()
+    present = set()
+    stable = []
+    for root, directories, files in os.walk(self.directory):
+      directories[:] = [name for name in directories if not name.startswith('.')]
+      if self.inotify and root not in self._watched:
+        self.inotify.add_watch(root, self._inotifyFlags)
+        self._watched.add(root)
+      for name in files:
+        if not isVolumeFile(name):
+          continue
+        path = os.path.join(root, name)
+        try:
+          stat = os.stat(path)
+        except OSError:
+          continue
+        present.add(path)
+        signature = (stat.st_size, stat.st_mtime_ns)
+        if self.reported.get(path) == signature:
+          continue
+        size, mtime, firstSeen, lastChange = self.pending.get(path, signature + (now, now))
+        if (size, mtime) != signature:
+          lastChange = now
+        self.pending[path] = signature + (firstSeen, lastChange)
+        # Copies that keep the modification time of the source are only seen growing, so the file
+        # must be observed unchanged for stableSeconds
+        if now - lastChange >= self.stableSeconds:
+          del self.pending[path]
+          self.reported[path] = signature
+          stable.append((path, stat.st_size, stat.st_mtime_ns, firstSeen))
+    for path in set(self.pending) - present:
+      del self.pending[path]
+    for path in set(self.reported) - present:
+      del self.reported[path]
+    return stable
+
+  def wait(self, seconds=None):
+    """
+    Wait for the next scan: seconds, pollSeconds by default, or until a file event with inotify.
+    """
+    seconds = self.pollSeconds if seconds is None else seconds
+    if self.inotify:
+      self.inotify.read(timeout=int(seconds * 1000), read_delay=100)
+    else:
+      time.sleep(seconds)
+
+
+class IngestLedger:
+  """
+  Append-only JSON lines log of the volumes handled by the ingestion, keeping the latest record of each fingerprint.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.records = {}
+    # Latest record of each volume path
+    self._byPath = {}
+    if os.path.exists(path):
+      with open(path) as ledgerFile:
+        for line in ledgerFile:
+          try:
+            record = json.loads(line)
+          except ValueError:
+            continue
+          if record.get('status') != 'duplicate':
+            self.records[record['fingerprint']] = record
+          self._byPath[record['path']] = record
+
+  def write(self, record):
+    """
+    Append a record, written with a single call so that the file stays readable after a crash.
+    """
+    if record['status'] != 'duplicate':
+      self.records[record['fingerprint']] = record
+    self._byPath[record['path']] = record
+    line = (json.dumps(record) + '\n').encode('utf-8')
+    fileDescriptor = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+      os.write(fileDescriptor, line)
+    finally:
+      os.close(fileDescriptor)
+
+  def known(self, path, size, mtime):
+    """
+    Record of a volume file already handled with the same size and modification time, None otherwise.
+    A volume whose job was lost by the service is not.
+    """
+    record = self._byPath.get(path)
+    if record and record['status'] != 'lost' and record.get('size') == size and record.get('mtime') == mtime:
+      return record
+    return None
+
+
+class RemoteService:
+  """
+  Submission interface of SegmentationService for a service running in another process.
+  """
+
+  def __init__(self, address, timeout=60):
+    self.client = ServiceClient(address, timeout)
+
+  def submit(self, request):
+    options = {name: value for name, value in request.items() if name not in ('input', 'output')}
+    return self.client.submit(request['input'], request['output'], **options)
+
+  def job(self, jobId, wait=0):
+    return self.client.job(jobId, wait)
+
+
+class Ingestor:
+  """
+  Submit the volumes arriving in a directory to a segmentation service, by priority class, skipping duplicates.
+  """
+
+  def __init__(self, service, inputDirectory, outputDirectory, defaultPriority=DEFAULT_PRIORITY, options=None,
+      stableSeconds=10.0, pollSeconds=2.0):
+    """
+    :param service: temporal_bone_service.SegmentationService, or RemoteService of a running one
+    :param options: JOB_OPTIONS and JOB_SETTINGS of every job
+    """
+    if defaultPriority not in PRIORITIES:
+      raise ValueError('Unknown priority %r' % defaultPriority)
+    self.service = service
+    self.inputDirectory = os.path.abspath(inputDirectory)
+    self.outputDirectory = os.path.abspath(outputDirectory)
+    self.defaultPriority = defaultPriority
+    self.options = dict(options or {})
+    self.watcher = DirectoryWatcher(self.inputDirectory, stableSeconds, pollSeconds)
+    os.makedirs(self.outputDirectory, exist_ok=True)
+    self.ledger = IngestLedger(os.path.join(self.outputDirectory, LEDGER_NAME))
+    self.prometheusPath = None
+    self.stopping = threading.Event()
+    self.counts = collections.Counter()
+    self.latencies = {priority: collections.deque(maxlen=LATENCY_WINDOW) for priority in PRIORITIES}
+    # Job ID to the ledger record of the submitted volumes not finished yet, including those of a previous run
+    self.inFlight = {record['job']: record for record in self.ledger.records.values() if record['status'] in ('queued', 'running')}
+    # Volumes to submit again at the next cycle, after the service could not be reached
+    self.retry = []
+
+  def priorityOf(self, path):
+    """
+    Priority class of a volume: the first directory of its path in the inbox, when it names one.
+    """
+    first = os.path.relpath(path, self.inputDirectory).split(os.sep)[0]
+    return first if first in PRIORITIES else self.defaultPriority
+
+  def outputDirectoryOf(self, path):
+    import batch_segmentation
+    from pathlib import Path
+    relativePath = Path(os.path.relpath(path, self.inputDirectory))
+    return os.path.join(self.outputDirectory, str(relativePath.parent), batch_segmentation.volumeName(relativePath))
+
+  def ingest(self, path, size, mtime, arrival):
+    """
+    Fingerprint a stable volume file and submit it, unless it is a duplicate.
+    :return: the job ID, None for a duplicate
+    """
+    if self.ledger.known(path, size, mtime):
+      # Already handled before a restart
+      return None
+    startTime = time.time()
+    fingerprint = volumeFingerprint(path)
+    record = {'fingerprint': fingerprint, 'path': path, 'size': size, 'mtime': mtime, 'priority': self.priorityOf(path),
+      'arrived': arrival, 'fingerprintSeconds': round(time.time() - startTime, 3)}
+    previous = self.ledger.records.get(fingerprint)
+    if previous and previous['status'] in ACTIVE_STATUSES:
+      self.counts['duplicate'] += 1
+      self.ledger.write(dict(record, status='duplicate', duplicateOf=previous['path'], job=previous['job']))
+      logging.info('%s is a duplicate of %s, skipped' % (path, previous['path']))
+      return None
+    request = dict(self.options, input=path, output=self.outputDirectoryOf(path), priority=record['priority'])
+    job = self.service.submit(request)
+    record.update(status='queued', job=job['id'], output=request['output'], submitted=job['submitted'])
+    self.ledger.write(record)
+    self.inFlight[job['id']] = record
+    self.counts['submitted'] += 1
+    logging.info('%s submitted as %s job %s' % (path, record['priority'], job['id']))
+    return job['id']
+
+  def poll(self):
+    """
+    Record the jobs that finished since the last poll.
+    """
+    for jobId, record in list(self.inFlight.items()):
+      job = self.service.job(jobId)
+      if job is not None and job['status'] in ('queued', 'running'):
+        continue
+      del self.inFlight[jobId]
+      if job is None:
+        # Submitted to a service that restarted since, submitted again
+        self.ledger.write(dict(record, status='lost'))
+        self.retry.append((record['path'], record['size'], record['mtime'], record['arrived']))
+        continue
+      finished = job.get('finished') or time.time()
+      record = dict(record, status=job['status'], error=job.get('error'), queueSeconds=job.get('queueSeconds'),
+        runSeconds=job.get('runSeconds'), endToEndSeconds=round(finished - record['arrived'], 3))
+      self.ledger.write(record)
+      self.counts[job['status']] += 1
+      if job['status'] == 'done':
+        self.latencies[record['priority']].append(record)
+      statistics = self.statistics()[record['priority']]
+      logging.info('%s %s (%s): queued %.1f s, %.1f s from arrival; %s end-to-end p50 %.1f s, p99 %.1f s over %d volumes' % (
+        record['path'], job['status'], record['priority'], record['queueSeconds'] or 0, record['endToEndSeconds'],
+        record['priority'], statistics['endToEndSeconds']['p50'] or 0, statistics['endToEndSeconds']['p99'] or 0,
+        statistics['endToEndSeconds']['count']))
+
+  def statistics(self):
+    """
+    p50/p99 of the queue wait and end-to-end latency (seconds) of the last LATENCY_WINDOW segmented volumes
+    of each priority class.
+    """
+    statistics = {}
+    for priority, records in self.latencies.items():
+      statistics[priority] = {}
+      for name in ('queueSeconds', 'endToEndSeconds'):
+        values = [record[name] for record in records if record[name] is not None]
+        statistics[priority][name] = {'p50': percentile(values, 0.5), 'p99': percentile(values, 0.99), 'count': len(values)}
+    return statistics
+
+  def writePrometheus(self, path, prefix='temporal_bone_ingest'):
+    """
+    Write the counts and latency percentiles per priority class as a Prometheus textfile, replacing the previous one atomically.
+    """
+    lines = ['# HELP %s_volumes Volumes handled by the ingestion since it started, by outcome' % prefix,
+      '# TYPE %s_volumes counter' % prefix]
+    lines += ['%s_volumes{outcome="%s"} %d' % (prefix, outcome, count) for outcome, count in sorted(self.counts.items())]
+    lines += ['# HELP %s_in_flight Volumes submitted and not finished' % prefix, '# TYPE %s_in_flight gauge' % prefix,
+      '%s_in_flight %d' % (prefix, len(self.inFlight))]
+    for name, metric, description in (('queueSeconds', 'queue_wait_seconds', 'Time segmented volumes waited in the service queue'),
+        ('endToEndSeconds', 'end_to_end_seconds', 'Time from the arrival of segmented volumes to the end of their segmentation')):
+      lines += ['# HELP %s_%s %s' % (prefix, metric, description), '# TYPE %s_%s summary' % (prefix, metric)]
+      for priority, statistics in self.statistics().items():
+        for key, quantile in (('p50', '0.5'), ('p99', '0.99')):
+          if statistics[name][key] is not None:
+            lines.append('%s_%s{priority="%s",quantile="%s"} %s' % (prefix, metric, priority, quantile, statistics[name][key]))
+        lines.append('%s_%s_count{priority="%s"} %d' % (prefix, metric, priority, statistics[name]['count']))
+    temporaryPath = path + '.%d.tmp' % os.getpid()
+    with open(temporaryPath, 'w') as textFile:
+      textFile.write('\n'.join(lines) + '\n')
+    os.replace(temporaryPath, path)
+
+  def runOnce(self):
+    """
+    One cycle: submit the volumes that became stable, then record the finished jobs.
+    """
+    arrivals, self.retry = self.retry + self.watcher.scan(), []
+    # The most urgent arrivals are submitted first
+    for path, size, mtime, arrival in sorted(arrivals, key=lambda arrival: PRIORITIES[self.priorityOf(arrival[0])]):
+      try:
+        self.ingest(path, size, mtime, arrival)
+      except (ServiceError, ValueError) as error:
+        if isinstance(error, ServiceError) and error.status >= 500:
+          logging.warning('Could not submit %s, retrying: %s' % (path, error))
+          self.retry.append((path, size, mtime, arrival))
+          continue
+        # Rejected by the service, or not a readable volume
+        self.counts['rejected'] += 1
+        logging.warning('%s not submitted: %s' % (path, error))
+      except (OSError, RuntimeError) as error:
+        logging.warning('Could not submit %s, retrying: %s' % (path, error))
+        self.retry.append((path, size, mtime, arrival))
+    try:
+      self.poll()
+    except (OSError, RuntimeError) as error:
+      logging.warning('Could not get the jobs from the service: %s' % error)
+    if self.prometheusPath:
+      self.writePrometheus(self.prometheusPath)
+
+  def run(self):
+    """
+    Watch the inbox until stopping is set.
+    """
+    logging.info('Watching %s (%s), %d jobs still in flight' % (self.inputDirectory,
+      'inotify' if self.watcher.inotify else 'polling every %g s' % self.watcher.pollSeconds, len(self.inFlight)))
+    while not self.stopping.is_set():
+      self.runOnce()
+      self.watcher.wait()
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('input_directory')
+  parser.add_argument('output_directory')
+  parser.add_argument('--service', required=True, help='running temporal_bone_service, at http://HOST:PORT or unix:SOCKET_PATH')
+  parser.add_argument('--default-priority', choices=list(PRIORITIES), default=DEFAULT_PRIORITY,
+    help='priority class of the volumes outside the urgent/, routine/ and research/ directories of the inbox')
+  parser.add_argument('--stable', type=float, default=10.0, help='seconds a file must stay unchanged before it is segmented')
+  parser.add_argument('--poll', type=float, default=2.0, help='seconds between scans of the inbox')
+  parser.add_argument('--prometheus-textfile', help='Prometheus textfile rewritten with the latencies per priority class')
+  args = parser.parse_args(argv)
+
+  logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+  ingestor = Ingestor(RemoteService(args.service), args.input_directory, args.output_directory, args.default_priority,
+    stableSeconds=args.stable, pollSeconds=args.poll)
+  ingestor.prometheusPath = args.prometheus_textfile
+  try:
+    ingestor.run()
+  except KeyboardInterrupt:
+    pass
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,292 @@
+"""
+Local CPU inference of the temporal bone models, as an alternative to the AIAA server.
+
+LocalInferenceClient has the same interface as temporal_bone_inference.AIAAStreamingClient
+(modelList, createSession, segmentation, closeSession), so it can be used wherever the
+server client is. The models are read from a directory holding, for each model name,
+an ONNX file (<model>.onnx, run with ONNX Runtime) or a TorchScript file (<model>.pt,
+run with PyTorch), and an optional <model>.json with its preprocessing:
+
+  {"tileShape": [96, 96, 96], "intensityRange": [-1000, 3000], "labelChannel": 1, "version": "3"}
+
+Models take float32 tiles of shape (batch, 1, K, J, I) and return logits of shape
+(batch, channels, K, J, I). Volumes are segmented with a sliding window of tiles,
+blended with Gaussian weights.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+
+import temporal_bone_inference
+
+# Extension of the model files of each engine, in order of preference
+MODEL_ENGINES = (('.onnx', 'onnx'), ('.pt', 'torchscript'))
+
+DEFAULT_TILE_SHAPE = (96, 96, 96)
+
+
+def tileStarts(size, tileSize, overlap):
+  """
+  Start indices of the tiles covering an axis of size voxels, the last tile ending at the border.
+  """
+  if size <= tileSize:
+    return [0]
+  step = max(1, int(round(tileSize * (1 - overlap))))
+  starts = list(range(0, size - tileSize, step))
+  return starts + [size - tileSize]
+
+
+def gaussianWeights(tileSize, sigmaScale=0.125):
+  """
+  Blending weights along one axis of a tile, highest at the centre where predictions are most reliable.
+  """
+  positions = np.arange(tileSize, dtype=np.float32) - (tileSize - 1) / 2.0
+  weights = np.exp(-positions**2 / (2 * (tileSize * sigmaScale)**2))
+  return np.maximum(weights / weights.max(), 1e-3).astype(np.float32)
+
+
+def _softmaxChannel(logits, channel):
+  # Probability of one channel without materializing the softmax of all channels
+  logits = logits - logits.max(axis=1, keepdims=True)
+  exponentials = np.exp(logits)
+  return exponentials[:, channel] / exponentials.sum(axis=1)
+
+
+class OnnxModel:
+  """
+  Model run with ONNX Runtime.
+  """
+
+  def __init__(self, path, threads):
+    import onnxruntime
+    options = onnxruntime.SessionOptions()
+    if threads:
+      options.intra_op_num_threads = threads
+      options.inter_op_num_threads = 1
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+    self.inputName = self.session.get_inputs()[0].name
+
+  def __call__(self, batch):
+    return self.session.run(None, {self.inputName: batch})[0]
+
+
+class TorchScriptModel:
+  """
+  Model run with PyTorch as a TorchScript module.
+  """
+
+  def __init__(self, path, threads):
+    import torch
+    if threads:
+      torch.set_num_threads(threads)
+    self.torch = torch
+    self.module = torch.jit.load(path, map_location='cpu').eval()
+
+  def __call__(self, batch):
+    with self.torch.inference_mode():
+      return self.module(self.torch.from_numpy(batch)).numpy()
+
+
+MODEL_CLASSES = {'onnx': OnnxModel, 'torchscript': TorchScriptModel}
+
+
+class LocalInferenceClient:
+  """
+  Segment volumes on the local CPU with the models of a directory.
+  bytesSent and bytesReceived are kept at zero for symmetry with the server client.
+  """
+
+  # Models already use all the cores given to them, so runInference requests them one at a time
+  maxConcurrentRequests = 1
+
+  def __init__(self, modelDirectory, threads=None, overlap=0.25, batchSize=1, threshold=0.5):
+    """
+    :param modelDirectory: directory of the model files
+    :param threads: intra-op threads of the engine, all cores by default
+    :param overlap: fraction of a tile shared with its neighbours along each axis
+    :param batchSize: number of tiles evaluated together
+    :param threshold: foreground probability of the mask
+    """
+    self.modelDirectory = modelDirectory
+    self.threads = threads
+    self.overlap = overlap
+    self.batchSize = batchSize
+    self.threshold = threshold
+    self.bytesSent = 0
+    self.bytesReceived = 0
+    self.sessions = {}
+    self._models = {}
+    self._versions = {}
+    self._lock = threading.Lock()
+
+  def _modelFiles(self):
+    files = {}
+    for fileName in sorted(os.listdir(self.modelDirectory)):
+      name, extension = os.path.splitext(fileName)
+      for engineExtension, engine in MODEL_ENGINES:
+        if extension == engineExtension and name not in files:
+          files[name] = (os.path.join(self.modelDirectory, fileName), engine)
+    return files
+
+  def _config(self, name):
+    configPath = os.path.join(self.modelDirectory, name + '.json')
+    if not os.path.exists(configPath):
+      return {}
+    with open(configPath) as configFile:
+      return json.load(configFile)
+
+  def _version(self, name, path):
+    # Content digest of the model file, so that cached outputs follow model updates
+    if name not in self._versions:
+      config = self._config(name)
+      digest = hashlib.blake2b(json.dumps(config, sort_keys=True).encode('utf-8'), digest_size=8)
+      with open(path, 'rb') as modelFile:
+        for chunk in iter(lambda: modelFile.read(1 << 20), b''):
+          digest.update(chunk)
+      self._versions[name] = '%s-%s' % (config.get('version', 'local'), digest.hexdigest())
+    return self._versions[name]
+
+  def _model(self, name):
+    with self._lock:
+      if name not in self._models:
+        files = self._modelFiles()
+        if name not in files:
+          raise temporal_bone_inference.AIAAException('No model file for %s in %s' % (name, self.modelDirectory))
+        path, engine = files[name]
+        self._models[name] = (MODEL_CLASSES[engine](path, self.threads), self._config(name))
+      return self._models[name]
+
+  def modelList(self):
+    return [{"name": name, "labels": [name], "type": "segmentation", "engine": engine, "version": self._version(name, path)}
+      for name, (path, engine) in self._modelFiles().items()]
+
+  def createSession(self, volumeArray, ijkToRAS, expiry=0):
+    """
+    Keep a reference to the volume; nothing is copied.
+    """
+    sessionId = uuid.uuid4().hex
+    self.sessions[sessionId] = (volumeArray, ijkToRAS)
+    return sessionId
+
+  def closeSession(self, sessionId):
+    self.sessions.pop(sessionId, None)
+    return {}
+
+  def predict(self, model, volumeArray):
+    """
+    Foreground probability of every voxel of a KJI volume, from overlapping tiles.
+    :return: float32 sum of the weighted tile probabilities, and the per-axis weight sums
+      that normalize it (the weight of a voxel is the product of its three axis sums)
+    """
+    return self.predictBatch(model, [volumeArray])[0]
+
+  def predictBatch(self, model, volumeArrays):
+    """
+    predict() of several volumes, whose tiles are evaluated together: each network call takes
+    batchSize tiles per volume, so that small volumes or crops still fill large batches.
+    :return: list of (accumulator, weight sums), one per volume
+    """
+    network, config = self._model(model)
+    tileShape = list(config.get('tileShape', DEFAULT_TILE_SHAPE))
+    intensityRange = config.get('intensityRange')
+    labelChannel = config.get('labelChannel', 1)
+    axisWeights = [gaussianWeights(tile) for tile in tileShape]
+    tileWeights = axisWeights[0][:, None, None] * axisWeights[1][None, :, None] * axisWeights[2][None, None, :]
+
+    predictions = []
+    origins = []
+    for index, volumeArray in enumerate(volumeArrays):
+      # Volumes smaller than a tile are padded with their border voxels
+      paddedShape = [max(size, tile) for size, tile in zip(volumeArray.shape, tileShape)]
+      startsByAxis = [tileStarts(size, tile, self.overlap) for size, tile in zip(paddedShape, tileShape)]
+      # Tiles form a regular grid, so the total weight of a voxel factorizes over the axes
+      weightSums = []
+      for size, starts, weights in zip(paddedShape, startsByAxis, axisWeights):
+        weightSum = np.zeros(size, dtype=np.float32)
+        for start in starts:
+          weightSum[start:start+len(weights)] += weights
+        weightSums.append(weightSum)
+      predictions.append((np.zeros(paddedShape, dtype=np.float32), weightSums))
+      origins += [(index, (k, j, i)) for k in startsByAxis[0] for j in startsByAxis[1] for i in startsByAxis[2]]
+
+    batchSize = self.batchSize * len(volumeArrays)
+    for batchStart in range(0, len(origins), batchSize):
+      batchOrigins = origins[batchStart:batchStart+batchSize]
+      batch = np.empty([len(batchOrigins), 1] + list(tileShape), dtype=np.float32)
+      for batchIndex, (index, origin) in enumerate(batchOrigins):
+        volumeArray = volumeArrays[index]
+        box = tuple(slice(start, start + tile) for start, tile in zip(origin, tileShape))
+        tile = volumeArray[tuple(slice(s.start, min(s.stop, size)) for s, size in zip(box, volumeArray.shape))]
+        if tile.shape != tuple(tileShape):
+          tile = np.pad(tile, [(0, tileSize - size) for tileSize, size in zip(tileShape, tile.shape)], mode='edge')
+        batch[batchIndex, 0] = tile
+      if intensityRange:
+        np.clip(batch, intensityRange[0], intensityRange[1], out=batch)
+        batch -= intensityRange[0]
+        batch /= float(intensityRange[1] - intensityRange[0])
+      logits = np.asarray(network(batch), dtype=np.float32)
+      if logits.shape[1] == 1:
+        probabilities = 1 / (1 + np.exp(-logits[:, 0]))
+      else:
+        probabilities = _softmaxChannel(logits, labelChannel)
+      for (index, origin), probability in zip(batchOrigins, probabilities):
+        box = tuple(slice(start, start + tile) for start, tile in zip(origin, tileShape))
+        predictions[index][0][box] += probability * tileWeights
+    return predictions
+
+  def segmentation(self, model, sessionId, outputFile=None, decode=True):
+    """
+    Segment the volume of a session with a model and write the mask as a gzip NRRD file.
+    :return: (mask array or None, NRRD header fields or None, params)
+    """
+    if sessionId not in self.sessions:
+      raise temporal_bone_inference.AIAAException('Unknown session ' + sessionId)
+    volumeArray, ijkToRAS = self.sessions[sessionId]
+    startTime = time.perf_counter()
+    prediction = self.predict(model, volumeArray)
+    return self._result(model, volumeArray, ijkToRAS, prediction, startTime, outputFile, decode)
+
+  def segmentationBatch(self, model, volumes, outputFiles=None, decode=True):
+    """
+    Segment several volumes with a model, evaluating their tiles together (see predictBatch).
+    :param volumes: list of (KJI voxel array, 4x4 IJK to RAS matrix as nested lists)
+    :param outputFiles: list of mask files, one per volume, or None
+    :return: list of segmentation() results, in the order of volumes
+    """
+    startTime = time.perf_counter()
+    predictions = self.predictBatch(model, [volumeArray for volumeArray, ijkToRAS in volumes])
+    return [self._result(model, volumeArray, ijkToRAS, prediction, startTime, outputFile, decode)
+      for (volumeArray, ijkToRAS), prediction, outputFile in zip(volumes, predictions, outputFiles or [None] * len(volumes))]
+
+  def _result(self, model, volumeArray, ijkToRAS, prediction, startTime, outputFile, decode):
+    accumulator, (weightsK, weightsJ, weightsI) = prediction
+
+    # Threshold slice by slice to avoid a second full-size float volume
+    mask = np.empty(volumeArray.shape, dtype=np.uint8)
+    sliceWeights = self.threshold * np.outer(weightsJ[:mask.shape[1]], weightsI[:mask.shape[2]])
+    for k in range(mask.shape[0]):
+      np.greater(accumulator[k, :mask.shape[1], :mask.shape[2]], weightsK[k] * sliceWeights, out=mask[k].view(bool))
+    del accumulator, prediction
+
+    seconds = time.perf_counter() - startTime
+    threads = self.threads or os.cpu_count()
+    logging.info('Local inference of %s: %.1f Mvoxels in %.1f s (%.2f Mvoxels/s per thread)' % (
+      model, mask.size / 1e6, seconds, mask.size / 1e6 / seconds / threads))
+    params = {"model": model, "seconds": seconds, "threads": threads}
+
+    if outputFile:
+      with open(outputFile + '.part', 'wb') as output:
+        for chunk in temporal_bone_inference.iterNrrd(mask, ijkToRAS):
+          output.write(chunk)
+      os.replace(outputFile + '.part', outputFile)
+    if decode:
+      return mask, temporal_bone_inference.parseNrrdHeader(temporal_bone_inference.nrrdHeader(mask, ijkToRAS)), params
+    return None, None, params
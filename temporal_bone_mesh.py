@@ -0,0 +1,173 @@
+"""
+Surface meshes of segmented structures, written as binary PLY or STL files.
+
+Each structure is meshed from its mask cropped to its extent: discrete flying edges,
+windowed sinc smoothing and normals, as the closed surface representation of Slicer
+segmentations does, then optional decimation into several levels of detail. The
+structures are meshed in a thread pool; the VTK filters release the GIL when VTK is
+built with VTK_PYTHON_FULL_THREADSAFE, as it is in Slicer.
+
+Meshes are written in LPS coordinates by default, like the OBJ files exported by the
+Segmentations module with lps=True. Masks are KJI arrays.
+"""
+
+import concurrent.futures
+import os
+import time
+
+import numpy as np
+
+from temporal_bone_postprocessing import _boundingBox
+
+# Writer class of each mesh file format
+MESH_WRITERS = {'ply': 'vtkPLYWriter', 'stl': 'vtkSTLWriter'}
+
+
+def _vtk():
+  import vtk
+  return vtk
+
+
+def maskToPolyData(mask, ijkToRAS, offset=(0, 0, 0), smoothingFactor=0.5, lps=True):
+  """
+  Closed surface of a binary mask.
+  :param mask: boolean KJI mask, may be cropped from the volume; it is cropped to its extent here too
+  :param ijkToRAS: 4x4 IJK to RAS matrix of the volume
+  :param offset: KJI index in the volume of the first voxel of mask
+  :param smoothingFactor: 0 for no smoothing up to 1, with the meaning of the smoothing factor of
+    the closed surface representation of segmentations
+  :param lps: output points in LPS instead of RAS coordinates
+  :return: vtkPolyData with point normals, empty for an empty mask
+  """
+  vtk = _vtk()
+  from vtk.util import numpy_support
+  box = _boundingBox(mask, (0, 0, 0))
+  if box is not None:
+    mask = mask[box]
+    offset = [o + s.start for o, s in zip(offset, box)]
+  # Background border so that the surface is closed where the mask touches the crop
+  padded = np.pad(mask.astype(np.uint8), 1)
+  imageData = vtk.vtkImageData()
+  imageData.SetDimensions(padded.shape[2], padded.shape[1], padded.shape[0])
+  imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(padded.reshape(-1), deep=False))
+
+  surface = vtk.vtkDiscreteFlyingEdges3D()
+  surface.SetInputData(imageData)
+  surface.SetValue(0, 1)
+  surface.ComputeNormalsOff()
+  surface.ComputeGradientsOff()
+  surface.ComputeScalarsOff()
+  output = surface.GetOutputPort()
+
+  if smoothingFactor > 0:
+    smoother = vtk.vtkWindowedSincPolyDataFilter()
+    smoother.SetInputConnection(output)
+    smoother.SetNumberOfIterations(20)
+    smoother.SetPassBand(10.0 ** (-4.0 * smoothingFactor))
+    smoother.BoundarySmoothingOff()
+    smoother.FeatureEdgeSmoothingOff()
+    smoother.NonManifoldSmoothingOn()
+    smoother.NormalizeCoordinatesOn()
+    output = smoother.GetOutputPort()
+
+  # Index of the padded crop to volume IJK, then to RAS (and LPS)
+  matrix = np.asarray(ijkToRAS, dtype=float)
+  shift = np.eye(4)
+  shift[:3, 3] = [offset[2] - 1, offset[1] - 1, offset[0] - 1]
+  matrix = matrix.dot(shift)
+  if lps:
+    matrix = np.diag([-1.0, -1.0, 1.0, 1.0]).dot(matrix)
+  vtkMatrix = vtk.vtkMatrix4x4()
+  for row in range(4):
+    for column in range(4):
+      vtkMatrix.SetElement(row, column, matrix[row, column])
+  transform = vtk.vtkTransform()
+  transform.SetMatrix(vtkMatrix)
+  transformFilter = vtk.vtkTransformPolyDataFilter()
+  transformFilter.SetInputConnection(output)
+  transformFilter.SetTransform(transform)
+
+  # Outward normals whatever the handedness of the matrix
+  normals = vtk.vtkPolyDataNormals()
+  normals.SetInputConnection(transformFilter.GetOutputPort())
+  normals.SplittingOff()
+  normals.ConsistencyOn()
+  normals.AutoOrientNormalsOn()
+  normals.Update()
+  return normals.GetOutput()
+
+
+def decimate(polyData, targetReduction):
+  """
+  Decimated copy of a mesh, with about targetReduction of its triangles removed and its topology kept.
+  """
+  vtk = _vtk()
+  decimator = vtk.vtkDecimatePro()
+  decimator.SetInputData(polyData)
+  decimator.SetTargetReduction(targetReduction)
+  decimator.PreserveTopologyOn()
+  decimator.SplittingOff()
+  decimator.BoundaryVertexDeletionOff()
+  normals = vtk.vtkPolyDataNormals()
+  normals.SetInputConnection(decimator.GetOutputPort())
+  normals.SplittingOff()
+  normals.ConsistencyOn()
+  normals.AutoOrientNormalsOn()
+  normals.Update()
+  return normals.GetOutput()
+
+
+def writeMesh(polyData, path):
+  """
+  Write a mesh as a binary PLY or STL file, depending on the extension of path.
+  """
+  vtk = _vtk()
+  fileFormat = os.path.splitext(path)[1][1:].lower()
+  if fileFormat not in MESH_WRITERS:
+    raise ValueError('Unsupported mesh format: ' + fileFormat)
+  writer = getattr(vtk, MESH_WRITERS[fileFormat])()
+  writer.SetFileName(path)
+  writer.SetInputData(polyData)
+  writer.SetFileTypeToBinary()
+  if not writer.Write():
+    raise IOError('Failed to write ' + path)
+
+
+def meshFileName(baseName, structure, level, fileFormat):
+  """
+  File name of a level of detail of a structure mesh; level 0 is the full resolution mesh.
+  """
+  return '%s_%s%s.%s' % (baseName, structure, '_lod%d' % level if level else '', fileFormat)
+
+
+def exportStructureMeshes(structures, ijkToRAS, directory, baseName, fileFormat='ply', smoothingFactor=0.5,
+    levels=(0.0,), lps=True, workers=None):
+  """
+  Mesh structures in parallel and write one file per structure and level of detail.
+  :param structures: dict mapping structure name to (cropped mask, KJI offset of the crop)
+  :param levels: decimation target reduction of each level of detail, 0 for none
+  :param workers: number of threads, one per structure by default
+  :return: list of dicts (structure, level, path, bytes, triangles, seconds), in the order of structures and levels.
+    Empty structures get no file.
+  """
+  def meshStructure(name):
+    mask, offset = structures[name]
+    if not mask.any():
+      return []
+    startTime = time.perf_counter()
+    polyData = maskToPolyData(mask, ijkToRAS, offset, smoothingFactor, lps)
+    records = []
+    for level, targetReduction in enumerate(levels):
+      levelPolyData = decimate(polyData, targetReduction) if targetReduction > 0 else polyData
+      path = os.path.join(directory, meshFileName(baseName, name, level, fileFormat))
+      writeMesh(levelPolyData, path)
+      records.append({'structure': name, 'level': level, 'path': path, 'bytes': os.path.getsize(path),
+        'triangles': levelPolyData.GetNumberOfPolys(), 'seconds': time.perf_counter() - startTime})
+      startTime = time.perf_counter()
+    return records
+
+  names = list(structures)
+  if not names:
+    return []
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers or min(len(names), os.cpu_count() or 1)) as executor:
+    return [record for records in executor.map(meshStructure, names) for record in records]
@@ -0,0 +1,199 @@
+"""
+Per-stage timing and memory metrics of a segmentation run.
+
+RunMetrics measures named stages with wall time, process CPU time, peak resident
+memory and bytes read and written, and keeps free-form counters. A run is exported
+as a dict, appended to a JSON lines file, or written as a Prometheus textfile for
+the node exporter textfile collector.
+
+Peak memory and I/O are read from /proc and are only available on Linux. They are
+process-wide: a stage running concurrently with others (such as the model requests
+of the inference thread pool) is charged with their I/O too, and peak memory is
+only measured for stages on the thread that created the metrics.
+"""
+
+import contextlib
+import json
+import os
+import re
+import threading
+import time
+
+
+def resetPeakMemory():
+  """
+  Reset the peak resident memory of the process (Linux only), so that it can be measured per stage.
+  :return: whether the peak could be reset
+  """
+  try:
+    with open('/proc/self/clear_refs', 'w') as clearRefs:
+      clearRefs.write('5')
+    return True
+  except OSError:
+    return False
+
+
+def peakMemoryBytes():
+  """
+  Peak resident memory of the process, since the last resetPeakMemory where supported. None if unknown.
+  """
+  try:
+    with open('/proc/self/status') as status:
+      for line in status:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) * 1024
+  except OSError:
+    pass
+  try:
+    import resource
+  except ImportError:
+    return None
+  import sys
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # Bytes on macOS, kilobytes elsewhere
+  return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def ioBytes():
+  """
+  (bytes read, bytes written) by the process so far, files and sockets included. None if unknown.
+  """
+  try:
+    with open('/proc/self/io') as io:
+      fields = dict(line.split(': ') for line in io.read().splitlines() if ': ' in line)
+    return int(fields['rchar']), int(fields['wchar'])
+  except (OSError, KeyError, ValueError):
+    return None
+
+
+class RunMetrics:
+  """
+  Metrics of one run. A stage entered several times (for example the export of each structure)
+  accumulates its times and bytes, and keeps the highest peak memory.
+  """
+
+  def __init__(self, **labels):
+    """
+    :param labels: identify the run in the sinks, for example volume="case01"
+    """
+    self.labels = labels
+    self.stages = {}
+    self.counters = {}
+    self.startTime = time.time()
+    self.endTime = None
+    # Called as stageListener(name) when a stage starts; an exception it raises aborts the stage
+    self.stageListener = None
+    self._lock = threading.Lock()
+    self._ownerThread = threading.get_ident()
+    # Peak memory of the stages open on the owner thread, innermost last
+    self._openPeaks = []
+
+  @contextlib.contextmanager
+  def stage(self, name):
+    """
+    Measure the code of a with block as stage name.
+    """
+    if self.stageListener:
+      self.stageListener(name)
+    onOwnerThread = threading.get_ident() == self._ownerThread
+    measurePeak = False
+    if onOwnerThread:
+      # Keep the peak of the enclosing stage before resetting it for this one
+      if self._openPeaks:
+        self._openPeaks[-1] = max(self._openPeaks[-1], peakMemoryBytes() or 0)
+      measurePeak = resetPeakMemory()
+      self._openPeaks.append(0)
+    io = ioBytes()
+    wallStart = time.perf_counter()
+    cpuStart = time.process_time()
+    try:
+      yield
+    finally:
+      wallSeconds = time.perf_counter() - wallStart
+      cpuSeconds = time.process_time() - cpuStart
+      ioEnd = ioBytes()
+      peak = None
+      if onOwnerThread:
+        innerPeak = self._openPeaks.pop()
+        if measurePeak:
+          peak = max(innerPeak, peakMemoryBytes() or 0)
+          # The enclosing stage saw this peak too
+          if self._openPeaks:
+            self._openPeaks[-1] = max(self._openPeaks[-1], peak)
+      with self._lock:
+        record = self.stages.setdefault(name, {'calls': 0, 'wallSeconds': 0.0, 'cpuSeconds': 0.0,
+          'peakMemoryBytes': None, 'bytesRead': None, 'bytesWritten': None})
+        record['calls'] += 1
+        record['wallSeconds'] += wallSeconds
+        record['cpuSeconds'] += cpuSeconds
+        if peak:
+          record['peakMemoryBytes'] = max(record['peakMemoryBytes'] or 0, peak)
+        if io and ioEnd:
+          record['bytesRead'] = (record['bytesRead'] or 0) + ioEnd[0] - io[0]
+          record['bytesWritten'] = (record['bytesWritten'] or 0) + ioEnd[1] - io[1]
+
+  def increment(self, name, value=1):
+    with self._lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+
+  def finish(self):
+    self.endTime = time.time()
+
+  def asDict(self):
+    with self._lock:
+      return {
+        'labels': dict(self.labels),
+        'startTime': self.startTime,
+        'wallSeconds': round((self.endTime or time.time()) - self.startTime, 4),
+        'stages': {name: {key: round(value, 4) if isinstance(value, float) else value for key, value in record.items()}
+          for name, record in self.stages.items()},
+        'counters': dict(self.counters),
+      }
+
+  def writeJsonLines(self, path):
+    """
+    Append the run as one line of a JSON lines file. Lines are written with a single call,
+    so several processes can append to the same file.
+    """
+    line = (json.dumps(self.asDict()) + '\n').encode('utf-8')
+    fileDescriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+      os.write(fileDescriptor, line)
+    finally:
+      os.close(fileDescriptor)
+
+  def writePrometheus(self, path, prefix='temporal_bone'):
+    """
+    Write the run as a Prometheus textfile, replacing the previous one atomically.
+    """
+    def labelSet(extra=None):
+      labels = dict(self.labels)
+      labels.update(extra or {})
+      escaped = ['%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in sorted(labels.items())]
+      return '{%s}' % ','.join(escaped) if escaped else ''
+
+    run = self.asDict()
+    lines = ['# HELP %s_run_wall_seconds Wall time of the last run' % prefix,
+      '# TYPE %s_run_wall_seconds gauge' % prefix,
+      '%s_run_wall_seconds%s %s' % (prefix, labelSet(), run['wallSeconds'])]
+    for key, metric, description in (
+        ('wallSeconds', 'stage_wall_seconds', 'Wall time of each stage of the last run'),
+        ('cpuSeconds', 'stage_cpu_seconds', 'Process CPU time during each stage of the last run'),
+        ('peakMemoryBytes', 'stage_peak_memory_bytes', 'Peak resident memory during each stage of the last run'),
+        ('bytesRead', 'stage_read_bytes', 'Bytes read by the process during each stage of the last run'),
+        ('bytesWritten', 'stage_written_bytes', 'Bytes written by the process during each stage of the last run'),
+        ('calls', 'stage_calls', 'Times each stage ran in the last run')):
+      lines += ['# HELP %s_%s %s' % (prefix, metric, description), '# TYPE %s_%s gauge' % (prefix, metric)]
+      for name, record in run['stages'].items():
+        if record[key] is not None:
+          lines.append('%s_%s%s %s' % (prefix, metric, labelSet({'stage': name}), record[key]))
+    for name, value in run['counters'].items():
+      # Counters are named in camelCase, metric names in snake_case
+      metric = re.sub('([a-z0-9])([A-Z])', r'\1_\2', name).lower()
+      lines += ['# TYPE %s_%s gauge' % (prefix, metric), '%s_%s%s %s' % (prefix, metric, labelSet(), value)]
+
+    temporaryPath = path + '.%d.tmp' % os.getpid()
+    with open(temporaryPath, 'w') as textFile:
+      textFile.write('\n'.join(lines) + '\n')
+    os.replace(temporaryPath, path)
@@ -0,0 +1,184 @@
+"""
+Memory-mapped NRRD volumes.
+
+openNrrd returns the voxels of an NRRD file as a read-only numpy.memmap in KJI order
+instead of decoding the whole file into memory: only the slabs a stage touches are
+read from disk, and the pages stay in the page cache, reclaimable, rather than in
+the memory of the process. Raw attached (.nrrd) and detached (.nhdr + data file)
+volumes are mapped in place. Compressed volumes cannot be read at random, so on
+first access they are decompressed, slab by slab, into a raw NRRD file of a
+FileCache, which later accesses map directly.
+
+Finding the temporal bones (temporal_bone_roi), cropping, resampling
+(temporal_bone_resample) and uploading to the inference server
+(temporal_bone_inference.iterNrrd) all read views of the mapped array.
+"""
+
+import os
+import tempfile
+import zlib
+
+import numpy as np
+
+import temporal_bone_inference
+from temporal_bone_inference import AIAAException, NRRD_DTYPES, parseNrrdHeader
+
+# Header fields describing where and how the data is stored, replaced in the cached raw file
+_DATA_FIELDS = ('encoding', 'data file', 'datafile', 'byte skip', 'line skip', 'endian')
+
+
+def readNrrdHeader(path):
+  """
+  Header of an NRRD file.
+  :return: (header lines, header fields, offset of the data in the file)
+  """
+  with open(path, 'rb') as nrrdFile:
+    headerBytes = b''
+    while b'\n\n' not in headerBytes:
+      chunk = nrrdFile.read(1 << 16)
+      if not chunk:
+        break
+      headerBytes += chunk
+  if not headerBytes.startswith(b'NRRD'):
+    raise AIAAException('Not an NRRD file: ' + path)
+  headerEnd = headerBytes.find(b'\n\n')
+  if headerEnd < 0:
+    # Detached header without data
+    headerEnd = len(headerBytes.rstrip(b'\n'))
+  header = headerBytes[:headerEnd]
+  return header.decode('latin-1').splitlines(), parseNrrdHeader(header), headerEnd + 2
+
+
+def nrrdKeyValues(lines):
+  """
+  Key/value pairs of the "key:=value" lines of an NRRD header, such as the segment metadata of .seg.nrrd
+  files, which the header fields leave out.
+  """
+  keyValues = {}
+  for line in lines[1:]:
+    if ':=' in line and not line.startswith('#'):
+      key, value = line.split(':=', 1)
+      keyValues[key.strip()] = value.strip()
+  return keyValues
+
+
+def nrrdDataLocation(path):
+  """
+  Where the voxels of an NRRD file are stored.
+  :return: (header lines, header fields, data file path, offset of the data, dtype, KJI shape)
+  """
+  lines, fields, offset = readNrrdHeader(path)
+  try:
+    dtype = NRRD_DTYPES[fields['type']]
+    shape = tuple(int(size) for size in fields['sizes'].split())[::-1]
+  except KeyError:
+    raise AIAAException('Unsupported NRRD type or sizes in ' + path)
+  if len(shape) != 3:
+    raise AIAAException('Only 3D NRRD volumes are supported: ' + path)
+  if dtype.itemsize > 1:
+    dtype = dtype.newbyteorder('>' if fields.get('endian') == 'big' else '<')
+
+  dataFile = fields.get('data file', fields.get('datafile'))
+  dataPath = path
+  if dataFile:
+    if dataFile.startswith('LIST') or len(dataFile.split()) > 1:
+      raise AIAAException('Multiple NRRD data files are not supported: ' + path)
+    dataPath = os.path.join(os.path.dirname(os.path.abspath(path)), dataFile)
+    offset = 0
+  if int(fields.get('line skip', 0)):
+    raise AIAAException('NRRD line skip is not supported: ' + path)
+  byteSkip = int(fields.get('byte skip', 0))
+  if byteSkip == -1:
+    # Data at the end of the file, only defined for raw data
+    offset = os.path.getsize(dataPath) - int(np.prod(shape)) * dtype.itemsize
+  else:
+    offset += byteSkip
+  return lines, fields, dataPath, offset, dtype, shape
+
+
+def decompressToRaw(path, outputPath, slabBytes=1 << 22):
+  """
+  Write a compressed NRRD volume as a raw little-endian attached NRRD file, keeping all other header fields.
+  Only slabBytes of voxels are in memory at a time.
+  """
+  lines, fields, dataPath, offset, dtype, shape = nrrdDataLocation(path)
+  encoding = fields.get('encoding', 'raw')
+  if encoding not in ('gzip', 'gz', 'raw'):
+    raise AIAAException('Unsupported NRRD encoding: ' + encoding)
+  header = [line for line in lines if line.split(':', 1)[0].strip() not in _DATA_FIELDS or ':=' in line]
+  header += ['encoding: raw', 'endian: little']
+  byteSwap = not dtype.isnative and dtype.itemsize > 1
+  expectedBytes = int(np.prod(shape)) * dtype.itemsize
+  state = {'written': 0, 'pending': b''}
+
+  def write(output, data):
+    # Swap whole voxels only, the remainder waits for the next data
+    data = state['pending'] + data
+    usable = min(len(data) - len(data) % dtype.itemsize, expectedBytes - state['written'])
+    data, state['pending'] = data[:usable], data[usable:]
+    if byteSwap:
+      data = np.frombuffer(data, dtype=dtype).astype(dtype.newbyteorder('<')).tobytes()
+    output.write(data)
+    state['written'] += len(data)
+
+  with open(dataPath, 'rb') as dataFile, open(outputPath, 'wb') as output:
+    output.write(('\n'.join(header) + '\n\n').encode('latin-1'))
+    dataFile.seek(offset)
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 32) if encoding in ('gzip', 'gz') else None
+    for chunk in iter(lambda: dataFile.read(1 << 20), b''):
+      if decompressor is None:
+        write(output, chunk)
+      while decompressor and chunk:
+        write(output, decompressor.decompress(chunk, slabBytes))
+        chunk = decompressor.unconsumed_tail
+      if state['written'] >= expectedBytes:
+        break
+    if decompressor and state['written'] < expectedBytes:
+      write(output, decompressor.flush())
+  if state['written'] < expectedBytes:
+    os.remove(outputPath)
+    raise AIAAException('Truncated NRRD data: ' + path)
+
+
+def openNrrd(path, cache=None):
+  """
+  Voxels of an NRRD volume as a read-only memory-mapped array.
+  :param cache: temporal_bone_cache.FileCache with extension '.nrrd' receiving the raw conversion of
+    compressed or big-endian volumes. Without a cache they are decoded into memory instead.
+  :return: (KJI array, header fields)
+  """
+  import temporal_bone_cache
+  lines, fields, dataPath, offset, dtype, shape = nrrdDataLocation(path)
+  if fields.get('encoding', 'raw') == 'raw' and (dtype.isnative or dtype.itemsize == 1):
+    return np.memmap(dataPath, dtype=dtype.newbyteorder('='), mode='r', offset=offset, shape=shape), fields
+  if cache is None:
+    return temporal_bone_inference.readNrrdArray(path) if dataPath == path else _readDetached(path)
+
+  # The conversion is identified by the files it comes from, as they are on disk
+  stats = [os.stat(filePath) for filePath in sorted({path, dataPath})]
+  key = temporal_bone_cache.cacheKey(os.path.abspath(path), [(stat.st_size, stat.st_mtime_ns) for stat in stats])
+  cachedPath = cache.get(key)
+  if not cachedPath:
+    fileHandle, temporaryPath = tempfile.mkstemp(suffix='.part', dir=cache.directory)
+    os.close(fileHandle)
+    try:
+      decompressToRaw(path, temporaryPath)
+    except Exception:
+      if os.path.exists(temporaryPath):
+        os.remove(temporaryPath)
+      raise
+    cachedPath = cache.put(key, temporaryPath, move=True)
+  lines, cachedFields, dataPath, offset, dtype, shape = nrrdDataLocation(cachedPath)
+  return np.memmap(cachedPath, dtype=dtype.newbyteorder('='), mode='r', offset=offset, shape=shape), cachedFields
+
+
+def _readDetached(path):
+  # Decode a compressed detached volume into memory, through a temporary raw file
+  fileHandle, temporaryPath = tempfile.mkstemp(suffix='.nrrd')
+  os.close(fileHandle)
+  try:
+    decompressToRaw(path, temporaryPath)
+    array, fields = openNrrd(temporaryPath)
+    return np.array(array), fields
+  finally:
+    os.remove(temporaryPath)
@@ -0,0 +1,152 @@
+"""
+Processing declared as a graph of stages, re-executed incrementally.
+
+A stage applies a named operation, with explicit parameters, to sources (for example a
+model output and the volume it segmented) and to the results of other stages. The
+result of a stage is identified by a key computed from its operation, version and
+parameters and from the keys of its inputs, so that changing a source or a parameter
+invalidates only the stages downstream of it. Mask results are kept in a FileCache
+between sessions: when only the mask range of the otic capsule changes, only the otic
+capsule stages run again and every other structure is read back from the cache.
+"""
+
+import contextlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from temporal_bone_postprocessing import _boundingBox
+
+
+class Stage:
+  """
+  Node of a pipeline: result = operations[operation](**inputs, **parameters), where each
+  input names a source or another stage.
+  """
+
+  def __init__(self, name, operation, inputs, parameters=None, version=1):
+    """
+    :param inputs: dict mapping argument name to source or stage name
+    :param parameters: dict of JSON-serializable keyword arguments of the operation
+    :param version: increased when the operation changes, to invalidate cached results
+    """
+    self.name = name
+    self.operation = operation
+    self.inputs = dict(inputs)
+    self.parameters = dict(parameters or {})
+    self.version = version
+
+  def __repr__(self):
+    return 'Stage(%r, %r, %r, %r)' % (self.name, self.operation, self.inputs, self.parameters)
+
+
+def saveMask(mask, path):
+  """
+  Write a boolean mask as a .npz file, cropped to its extent and bit-packed.
+  """
+  box = _boundingBox(mask, (0, 0, 0)) or (slice(0, 0),) * 3
+  with open(path, 'wb') as maskFile:
+    np.savez(maskFile, shape=np.array(mask.shape), box=np.array([[s.start, s.stop] for s in box]),
+      bits=np.packbits(mask[box], axis=None))
+
+
+def loadMask(path):
+  """
+  Read a mask written by saveMask.
+  """
+  with np.load(path) as data:
+    mask = np.zeros(tuple(data['shape']), dtype=bool)
+    box = tuple(slice(int(start), int(stop)) for start, stop in data['box'])
+    boxShape = tuple(s.stop - s.start for s in box)
+    mask[box] = np.unpackbits(data['bits'], count=int(np.prod(boxShape))).reshape(boxShape).astype(bool)
+  return mask
+
+
+class Pipeline:
+  """
+  Stages evaluated on demand, with memoization of their mask results in a cache.
+  """
+
+  def __init__(self, stages, operations, cache=None, engine=''):
+    """
+    :param stages: list of Stage
+    :param operations: dict mapping operation name to function
+    :param cache: temporal_bone_cache.FileCache with extension '.npz' keeping the mask results, None for no persistence
+    :param engine: name of the implementation of the operations, part of the keys
+    """
+    self.stages = {}
+    for stage in stages:
+      if stage.name in self.stages:
+        raise ValueError('Duplicate stage ' + stage.name)
+      self.stages[stage.name] = stage
+    self.operations = operations
+    self.cache = cache
+    self.engine = engine
+    # Names of the stages run and read from the cache by the last evaluate()
+    self.computed = []
+    self.reused = []
+
+  def stageKey(self, name, sourceKeys, keys=None, visiting=()):
+    """
+    Key of the result of a stage.
+    :param sourceKeys: dict mapping source name to a digest of its content
+    :param keys: dict of the keys already computed, updated
+    """
+    keys = {} if keys is None else keys
+    if name in sourceKeys:
+      return sourceKeys[name]
+    if name in keys:
+      return keys[name]
+    if name not in self.stages:
+      raise KeyError('Unknown stage or source: ' + name)
+    if name in visiting:
+      raise ValueError('Cycle through stage ' + name)
+    import temporal_bone_cache
+    stage = self.stages[name]
+    inputKeys = sorted((argument, self.stageKey(inputName, sourceKeys, keys, visiting + (name,)))
+      for argument, inputName in stage.inputs.items())
+    keys[name] = temporal_bone_cache.cacheKey(self.engine, stage.operation, stage.version,
+      json.dumps(stage.parameters, sort_keys=True), inputKeys)
+    return keys[name]
+
+  def evaluate(self, targets, sources, sourceKeys, metrics=None):
+    """
+    Results of the target stages. Only the stages whose result is not cached are run, and the
+    inputs of a cached stage are not evaluated at all.
+    :param sources: dict mapping source name to value
+    :param sourceKeys: dict mapping source name to a digest of its content
+    :param metrics: temporal_bone_metrics.RunMetrics receiving a "stage:<name>" stage per stage run
+    :return: (dict mapping target to result, dict mapping target to key)
+    """
+    keys = {}
+    results = dict(sources)
+    self.computed = []
+    self.reused = []
+
+    def resultOf(name):
+      if name in results:
+        return results[name]
+      key = self.stageKey(name, sourceKeys, keys)
+      stage = self.stages[name]
+      cachedPath = self.cache.get(key) if self.cache else None
+      if cachedPath:
+        result = loadMask(cachedPath)
+        self.reused.append(name)
+      else:
+        inputs = {argument: resultOf(inputName) for argument, inputName in stage.inputs.items()}
+        with metrics.stage('stage:' + name) if metrics else contextlib.nullcontext():
+          result = self.operations[stage.operation](**dict(inputs, **stage.parameters))
+        self.computed.append(name)
+        if self.cache and isinstance(result, np.ndarray) and result.dtype == bool:
+          fileHandle, temporaryPath = tempfile.mkstemp(suffix='.part', dir=self.cache.directory)
+          os.close(fileHandle)
+          saveMask(result, temporaryPath)
+          self.cache.put(key, temporaryPath, move=True)
+      if metrics:
+        metrics.increment('pipelineStagesReused' if cachedPath else 'pipelineStagesComputed')
+      results[name] = result
+      return result
+
+    return {target: resultOf(target) for target in targets}, {target: self.stageKey(target, sourceKeys, keys) for target in targets}
@@ -0,0 +1,341 @@
+"""
+Headless post-processing of the temporal bone model outputs.
+
+NumPy/SciPy equivalents of the Segment Editor effects used by
+TemporalBoneAutosegmentationLogic ("Margin", "Islands", "Logical operators"
+and "Smoothing"), working directly on labelmap arrays. Arrays are in KJI order,
+as returned by slicer.util.arrayFromVolume, and spacing is the IJK spacing of
+the volume node, as returned by GetSpacing().
+
+Masking follows the Segment Editor: where the master volume is outside the
+intensity mask range the segment keeps its previous value.
+
+medianFilterVolume replaces the medianimagefilter CLI run on the master volume
+before the facial nerve and sigmoid sinus models.
+"""
+
+import concurrent.futures
+import os
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import ndimage
+
+# Islands effect uses face connectivity ("FullyConnected" off)
+ISLANDS_STRUCTURE = ndimage.generate_binary_structure(3, 1)
+
+
+def _arraySpacing(spacing):
+  return np.asarray(spacing, dtype=float)[::-1]
+
+
+def _boundingBox(mask, padding):
+  """
+  Slices of the bounding box of the nonzero voxels, grown by padding voxels per axis
+  and clipped to the array. None if the mask is empty.
+  """
+  nonzeroAxes = [np.flatnonzero(np.any(mask, axis=tuple(a for a in range(3) if a != axis))) for axis in range(3)]
+  if len(nonzeroAxes[0]) == 0:
+    return None
+  return tuple(slice(max(0, int(nonzero[0]) - pad), min(size, int(nonzero[-1]) + pad + 1))
+    for nonzero, pad, size in zip(nonzeroAxes, padding, mask.shape))
+
+
+def intensityMask(masterArray, minimum, maximum):
+  """
+  Editable region of the master volume intensity mask range (inclusive).
+  """
+  return (masterArray >= minimum) & (masterArray <= maximum)
+
+
+def marginKernelSize(marginSizeMm, spacing):
+  """
+  Kernel size in voxels (array axis order) that the Margin effect uses for a margin.
+  The margin is rounded to whole voxels per axis, so the kernel is always odd.
+  """
+  return [int(round(abs(marginSizeMm) / axisSpacing)) * 2 + 1 for axisSpacing in _arraySpacing(spacing)]
+
+
+def smoothingKernelSize(kernelSizeMm, spacing):
+  """
+  Kernel size in voxels (array axis order) that the Smoothing effect uses, rounded to the nearest odd number.
+  """
+  return [int(round((kernelSizeMm / axisSpacing + 1) / 2) * 2 - 1) for axisSpacing in _arraySpacing(spacing)]
+
+
+def grow(mask, marginSizeMm, spacing, editable=None):
+  """
+  Margin effect with a positive margin: dilation by the ellipsoid kernel of vtkImageDilateErode3D.
+  The kernel of size 2n+1 contains the offsets d with sum((d/(n+0.5))^2) <= 1. Dilating by it
+  is computed as a scaled Euclidean distance transform of the cropped mask, so the cost does
+  not depend on the margin size.
+  """
+  mask = mask.astype(bool)
+  halfSize = [(size - 1) // 2 for size in marginKernelSize(marginSizeMm, spacing)]
+  box = _boundingBox(mask, halfSize)
+  if box is None or not any(halfSize):
+    return mask
+  radius = np.array(halfSize) + 0.5
+  distance = ndimage.distance_transform_edt(~mask[box], sampling=1.0 / radius)
+  grown = mask.copy()
+  grown[box] |= distance <= 1.0
+  if editable is not None:
+    grown[box] &= mask[box] | editable[box]
+  return grown
+
+
+def _islands(mask):
+  labels, count = ndimage.label(mask, structure=ISLANDS_STRUCTURE)
+  sizes = np.bincount(labels.ravel(), minlength=count + 1)
+  sizes[0] = 0
+  return labels, sizes
+
+
+def keepLargestIsland(mask, minimumSize=1000, editable=None):
+  """
+  Islands effect KEEP_LARGEST_ISLAND. The largest island is removed too if it is smaller than minimumSize.
+  """
+  mask = mask.astype(bool)
+  box = _boundingBox(mask, [0, 0, 0])
+  if box is None:
+    return mask
+  labels, sizes = _islands(mask[box])
+  largest = int(np.argmax(sizes))
+  result = np.zeros_like(mask)
+  if sizes[largest] >= minimumSize:
+    result[box] = labels == largest
+  return _applyEditable(mask, result, editable)
+
+
+def removeSmallIslands(mask, minimumSize=1000, editable=None):
+  """
+  Islands effect REMOVE_SMALL_ISLANDS: islands with fewer than minimumSize voxels are removed.
+  """
+  mask = mask.astype(bool)
+  box = _boundingBox(mask, [0, 0, 0])
+  if box is None:
+    return mask
+  labels, sizes = _islands(mask[box])
+  result = np.zeros_like(mask)
+  result[box] = (sizes >= minimumSize)[labels]
+  return _applyEditable(mask, result, editable)
+
+
+def smoothMedian(mask, kernelSizeMm, spacing, editable=None):
+  """
+  Smoothing effect MEDIAN. The median of a binary mask over the box kernel is a majority
+  vote, computed with a separable box filter. Voxels outside the volume count as background.
+  """
+  mask = mask.astype(bool)
+  kernelSize = smoothingKernelSize(kernelSizeMm, spacing)
+  box = _boundingBox(mask, [size // 2 for size in kernelSize])
+  if box is None or kernelSize == [1, 1, 1]:
+    return mask
+  mean = ndimage.uniform_filter(mask[box].astype(np.float64), size=kernelSize, mode='constant')
+  result = np.zeros_like(mask)
+  result[box] = mean > 0.5
+  return _applyEditable(mask, result, editable)
+
+
+def _applyEditable(previous, result, editable):
+  if editable is None:
+    return result
+  return np.where(editable, result, previous)
+
+
+def medianFilterVolume(volumeArray, box=None, out=None, workers=None):
+  """
+  3x3x3 median filter of a volume, like the medianimagefilter CLI with neighborhood 1,1,1
+  (voxels outside the volume repeat the border), computed only inside box.
+  Slices are filtered in parallel threads, each one selecting the median of its 27 neighbours
+  with np.partition, so only the windows of one slice per thread are held in memory at a time.
+  :param box: KJI slice tuple of the region to filter, the whole volume by default
+  :param out: array of the box shape receiving the result, allocated if not given
+  :param workers: number of threads, os.cpu_count() by default
+  :return: the filtered box
+  """
+  box = box or tuple(slice(0, size) for size in volumeArray.shape)
+  boxShape = tuple(s.stop - s.start for s in box)
+  if out is None:
+    out = np.empty(boxShape, dtype=volumeArray.dtype)
+  # Rows and columns of the box with a one voxel margin, repeating the border of the volume beyond it
+  rowsAndColumns = tuple(slice(max(0, s.start - 1), min(size, s.stop + 1)) for s, size in zip(box[1:], volumeArray.shape[1:]))
+  padding = [(0, 0)] + [(1 - (s.start - source.start), 1 - (source.stop - s.stop)) for s, source in zip(box[1:], rowsAndColumns)]
+  region = volumeArray[(slice(None),) + rowsAndColumns]
+
+  def filterSlices(slices):
+    for k in slices:
+      sliceIndices = np.clip(np.arange(box[0].start + k - 1, box[0].start + k + 2), 0, volumeArray.shape[0] - 1)
+      slab = region[sliceIndices]
+      if any(sum(pad) for pad in padding):
+        slab = np.pad(slab, padding, mode='edge')
+      windows = sliding_window_view(slab, (3, 3, 3))[0].reshape(boxShape[1:] + (27,))
+      out[k] = np.partition(windows, 13, axis=-1)[..., 13]
+
+  workers = workers or os.cpu_count() or 1
+  chunks = [range(start, boxShape[0], workers) for start in range(min(workers, boxShape[0]))]
+  if len(chunks) == 1:
+    filterSlices(chunks[0])
+  else:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+      for result in executor.map(filterSlices, chunks):
+        pass
+  return out
+
+
+#
+# Post-processing of each model output, matching TemporalBoneAutosegmentationLogic
+#
+
+def postprocessOticCapsule(innerEar, masterArray, spacing):
+  """
+  Otic capsule from the inner ear: grow 0.3 mm within -300..550, grow spacing*5 within 650..2500,
+  then keep the largest island.
+  """
+  innerEar = grow(innerEar, 0.3, spacing, intensityMask(masterArray, -300, 550))
+  oticCapsule = grow(innerEar, spacing[2]*5, spacing, intensityMask(masterArray, 650, 2500))
+  return keepLargestIsland(oticCapsule)
+
+
+def postprocessOssicles(ossicles, masterArray, spacing):
+  return removeSmallIslands(ossicles, 50)
+
+
+def postprocessCochlearDuct(cochlearDuct, masterArray, spacing):
+  return grow(cochlearDuct, 0.3, spacing, intensityMask(masterArray, -410, 750))
+
+
+def postprocessFacialNerve(facialNerve, masterArray, spacing):
+  return facialNerve.astype(bool)
+
+
+def postprocessSigmoidSinus(sigmoid, masterArray, spacing):
+  return removeSmallIslands(sigmoid, 500, intensityMask(masterArray, -410, 750))
+
+
+def postprocessCochlearDuctScript(cochlearDuct, masterArray, spacing):
+  """
+  Post-processing of Cochlear_duct_prediction_volume_model.py: keep the largest island
+  (minimum 100 voxels), then 0.3 mm median smoothing within -810..500.
+  """
+  cochlearDuct = keepLargestIsland(cochlearDuct, 100)
+  return smoothMedian(cochlearDuct, 0.3, spacing, intensityMask(masterArray, -810, 500))
+
+
+POSTPROCESSING_BY_MODEL = {
+  "inner_ear": postprocessOticCapsule,
+  "ossicles": postprocessOssicles,
+  "cochlear_duct": postprocessCochlearDuct,
+  "facial_nerve": postprocessFacialNerve,
+  "sigmoid_sinus": postprocessSigmoidSinus,
+}
+
+
+#
+# Post-processing as a graph of stages, see temporal_bone_pipeline
+#
+
+def marginSize(master, marginSizeMm=None, marginSlices=None):
+  """
+  Margin of a grow stage: marginSizeMm, or marginSlices times the slice spacing of the master volume.
+  """
+  return marginSizeMm if marginSizeMm is not None else marginSlices * master[1][2]
+
+
+def _editable(master, maskRange):
+  return None if maskRange is None else intensityMask(master[0], *maskRange)
+
+
+def growStage(mask, master, marginSizeMm=None, marginSlices=None, maskRange=None):
+  return grow(mask, marginSize(master, marginSizeMm, marginSlices), master[1], _editable(master, maskRange))
+
+
+def keepLargestIslandStage(mask, master, minimumSize=1000, maskRange=None):
+  return keepLargestIsland(mask, minimumSize, _editable(master, maskRange))
+
+
+def removeSmallIslandsStage(mask, master, minimumSize=1000, maskRange=None):
+  return removeSmallIslands(mask, minimumSize, _editable(master, maskRange))
+
+
+def smoothMedianStage(mask, master, kernelSizeMm, maskRange=None):
+  return smoothMedian(mask, kernelSizeMm, master[1], _editable(master, maskRange))
+
+
+def copyStage(mask, master):
+  return mask.astype(bool)
+
+
+# Operations of the post-processing stages: operation(mask, master, **parameters), master being
+# (master volume array, spacing) and maskRange the optional intensity mask range (inclusive)
+POSTPROCESSING_OPERATIONS = {
+  "grow": growStage,
+  "keepLargestIsland": keepLargestIslandStage,
+  "removeSmallIslands": removeSmallIslandsStage,
+  "smoothMedian": smoothMedianStage,
+  "copy": copyStage,
+}
+
+
+def postprocessingStages():
+  """
+  Stages of the post-processing of the model outputs, as a new list whose parameters can be edited.
+  Source "model:<model name>" is the output of a model and "master:<model name>" the volume it
+  segmented. The stage named after each structure gives its final mask; the same stages as the
+  postprocess functions above.
+  """
+  from temporal_bone_pipeline import Stage
+  return [
+    Stage("inner_ear_grown", "grow", {"mask": "model:inner_ear", "master": "master:inner_ear"},
+      {"marginSizeMm": 0.3, "maskRange": [-300, 550]}),
+    Stage("otic_capsule_grown", "grow", {"mask": "inner_ear_grown", "master": "master:inner_ear"},
+      {"marginSlices": 5, "maskRange": [650, 2500]}),
+    Stage("otic_capsule", "keepLargestIsland", {"mask": "otic_capsule_grown", "master": "master:inner_ear"},
+      {"minimumSize": 1000}),
+    Stage("ossicles", "removeSmallIslands", {"mask": "model:ossicles", "master": "master:ossicles"},
+      {"minimumSize": 50}),
+    Stage("cochlear_duct", "grow", {"mask": "model:cochlear_duct", "master": "master:cochlear_duct"},
+      {"marginSizeMm": 0.3, "maskRange": [-410, 750]}),
+    Stage("facial_nerve", "copy", {"mask": "model:facial_nerve", "master": "master:facial_nerve"}),
+    Stage("sigmoid_sinus", "removeSmallIslands", {"mask": "model:sigmoid_sinus", "master": "master:sigmoid_sinus"},
+      {"minimumSize": 500, "maskRange": [-410, 750]}),
+  ]
+
+
+# Stage parameters counted in voxels, with the number of dimensions they extend over
+VOXEL_PARAMETERS = {"minimumSize": 3}
+
+
+def stagesAtSpacing(stages, spacingByModel, referenceSpacing=0.25):
+  """
+  Stages with their voxel parameters (VOXEL_PARAMETERS) scaled for models segmented at a working
+  spacing other than referenceSpacing, so that they keep the same physical size: an island of 500
+  voxels at 0.25 mm is an island of 62 voxels at 0.5 mm. Margins given in slices become the margin
+  in millimetres they have at referenceSpacing, rather than a rounded number of coarser slices.
+  :param spacingByModel: dict mapping model name to its isotropic working spacing (mm)
+  :return: new list of stages
+  """
+  from temporal_bone_pipeline import Stage
+  scaledStages = []
+  for stage in stages:
+    masters = [source.split(":", 1)[1] for source in stage.inputs.values() if source.startswith("master:")]
+    ratio = referenceSpacing / spacingByModel.get(masters[0], referenceSpacing) if masters else 1.0
+    parameters = dict(stage.parameters)
+    if ratio != 1.0:
+      for name, dimensions in VOXEL_PARAMETERS.items():
+        if name in parameters:
+          parameters[name] = max(1, int(round(parameters[name] * ratio ** dimensions)))
+      if "marginSlices" in parameters:
+        parameters["marginSizeMm"] = parameters.pop("marginSlices") * referenceSpacing
+    scaledStages.append(Stage(stage.name, stage.operation, stage.inputs, parameters, stage.version))
+  return scaledStages
+
+
+# Final stage of the structure segmented from each model
+POSTPROCESSING_TARGETS = {
+  "inner_ear": "otic_capsule",
+  "ossicles": "ossicles",
+  "cochlear_duct": "cochlear_duct",
+  "facial_nerve": "facial_nerve",
+  "sigmoid_sinus": "sigmoid_sinus",
+}
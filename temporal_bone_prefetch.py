@@ -0,0 +1,190 @@
+"""
+Stages connected by bounded queues, overlapping the stages of consecutive items.
+
+Items go through the stages in order. Each stage runs on its own worker threads,
+except at most one stage declared with workers=0, which runs on the thread calling
+run(): work on the Slicer scene (MRML) has to stay on the main thread. The queues are
+bounded, so a stage runs at most queueSize items ahead of the next one and memory
+stays bounded. For a cohort of volumes, volume N+1 is read and decompressed while
+volume N is segmented, and the outputs of volume N-1 are compressed and written in
+the background.
+
+statistics() reports, per stage, the items processed, the busy time and utilization
+(busy time over wall time and workers), the time waiting for input and the mean and
+maximum depth of the input queue, to tune the number of workers and queue sizes: a
+stage with a full input queue and a utilization near 1 is the bottleneck.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+_END = object()
+
+
+class PipelineStage:
+  """
+  Function applied to every item: function(item) returns the item for the next stage, or None to drop it.
+  """
+
+  def __init__(self, name, function, workers=1):
+    """
+    :param workers: number of threads, 0 to run on the thread calling PrefetchPipeline.run
+    """
+    self.name = name
+    self.function = function
+    self.workers = workers
+    self.items = 0
+    self.failures = 0
+    self.busySeconds = 0.0
+    self.waitSeconds = 0.0
+    self.depthSamples = 0
+    self.depthSum = 0
+    self.depthMaximum = 0
+    self._remaining = 0
+    self._lock = threading.Lock()
+
+
+class PrefetchPipeline:
+  """
+  Items passed through stages running concurrently, with bounded queues between them.
+  """
+
+  def __init__(self, stages, queueSize=2):
+    """
+    :param stages: list of PipelineStage or (name, function, workers) tuples
+    :param queueSize: maximum number of items waiting in front of each stage
+    """
+    self.stages = [stage if isinstance(stage, PipelineStage) else PipelineStage(*stage) for stage in stages]
+    if sum(stage.workers == 0 for stage in self.stages) > 1:
+      raise ValueError('At most one stage can run on the calling thread')
+    self.queueSize = queueSize
+    # (stage name, item, exception) of the items dropped by an exception
+    self.errors = []
+    self.wallSeconds = 0.0
+    self._stopped = threading.Event()
+    self._results = []
+    self._lock = threading.Lock()
+
+  def _put(self, itemQueue, item):
+    # Give up when the pipeline stopped, instead of blocking on a queue that is no longer read
+    while not self._stopped.is_set():
+      try:
+        itemQueue.put(item, timeout=0.1)
+        return
+      except queue.Full:
+        continue
+
+  def _feed(self, items, itemQueue, endCount):
+    try:
+      for item in items:
+        if self._stopped.is_set():
+          return
+        self._put(itemQueue, item)
+    except Exception as error:
+      logging.exception('Pipeline input failed')
+      with self._lock:
+        self.errors.append(('input', None, error))
+    finally:
+      for _ in range(endCount):
+        self._put(itemQueue, _END)
+
+  def _work(self, index, inputQueue, outputQueue):
+    stage = self.stages[index]
+    nextStage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+    while True:
+      waitStartTime = time.perf_counter()
+      depth = inputQueue.qsize()
+      item = inputQueue.get()
+      busyStartTime = time.perf_counter()
+      if item is _END:
+        break
+      failed = False
+      try:
+        result = stage.function(item)
+      except Exception as error:
+        logging.exception('Pipeline stage %s failed' % stage.name)
+        result = None
+        failed = True
+        with self._lock:
+          self.errors.append((stage.name, item, error))
+      with stage._lock:
+        stage.items += 1
+        stage.failures += int(failed)
+        stage.waitSeconds += busyStartTime - waitStartTime
+        stage.busySeconds += time.perf_counter() - busyStartTime
+        stage.depthSamples += 1
+        stage.depthSum += depth
+        stage.depthMaximum = max(stage.depthMaximum, depth)
+      if result is None:
+        continue
+      if nextStage is None:
+        with self._lock:
+          self._results.append(result)
+      else:
+        self._put(outputQueue, result)
+    # The last worker of the stage to finish ends the input of the next stage
+    with stage._lock:
+      stage._remaining -= 1
+      last = stage._remaining == 0
+    if last and nextStage is not None:
+      for _ in range(nextStage.workers or 1):
+        self._put(outputQueue, _END)
+
+  def run(self, items):
+    """
+    Pass every item through the stages. An exception in a stage function drops the item;
+    it is logged and kept in self.errors.
+    :param items: iterable of items, consumed by a background thread as the first queue has room
+    :return: results of the last stage, in completion order
+    """
+    queues = [queue.Queue(self.queueSize) for _ in self.stages] + [None]
+    for stage in self.stages:
+      stage._remaining = stage.workers or 1
+    self._stopped.clear()
+    self._results = []
+    startTime = time.perf_counter()
+    threads = [threading.Thread(target=self._feed, args=(items, queues[0], self.stages[0].workers or 1),
+      name='PrefetchPipeline-input', daemon=True)]
+    for index, stage in enumerate(self.stages):
+      for worker in range(stage.workers):
+        threads.append(threading.Thread(target=self._work, args=(index, queues[index], queues[index + 1]),
+          name='PrefetchPipeline-%s-%d' % (stage.name, worker), daemon=True))
+    for thread in threads:
+      thread.start()
+    try:
+      for index, stage in enumerate(self.stages):
+        if stage.workers == 0:
+          self._work(index, queues[index], queues[index + 1])
+      for thread in threads:
+        thread.join()
+    finally:
+      # Interrupted on the calling thread: let the background threads finish their item and exit
+      self._stopped.set()
+      self.wallSeconds = time.perf_counter() - startTime
+    return self._results
+
+  def statistics(self):
+    """
+    :return: dict mapping stage name to dict of items, failures, busySeconds, utilization,
+      waitSeconds, queueDepthMean and queueDepthMaximum
+    """
+    statistics = {}
+    for stage in self.stages:
+      with stage._lock:
+        statistics[stage.name] = {
+          'items': stage.items,
+          'failures': stage.failures,
+          'busySeconds': stage.busySeconds,
+          'utilization': stage.busySeconds / (self.wallSeconds * (stage.workers or 1)) if self.wallSeconds else 0.0,
+          'waitSeconds': stage.waitSeconds,
+          'queueDepthMean': stage.depthSum / stage.depthSamples if stage.depthSamples else 0.0,
+          'queueDepthMaximum': stage.depthMaximum,
+        }
+    return statistics
+
+  def logStatistics(self):
+    logging.info('Pipeline of %d items in %.1f s (queues of %d): %s' % (len(self._results), self.wallSeconds, self.queueSize,
+      ', '.join('%s %d items, %.0f%% busy, queue %.1f (max %d)' % (name, stage['items'], 100 * stage['utilization'],
+        stage['queueDepthMean'], stage['queueDepthMaximum']) for name, stage in self.statistics().items())))
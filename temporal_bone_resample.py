@@ -0,0 +1,192 @@
+"""
+In-process resampling of CT volumes to isotropic spacing.
+
+Reproduces the resamplescalarvolume CLI used by TemporalBoneAutosegmentationLogic:
+the output grid keeps the origin and axes of the input and its size is the input
+extent divided by the output spacing, truncated. Voxels are interpolated linearly
+(border voxels repeated, like itk::LinearInterpolateImageFunction) or with cubic
+B-splines (mirror boundary, like itk::BSplineInterpolateImageFunction), then
+clamped to the range of the input type and truncated like itk::ResampleImageFilter.
+
+Both interpolations are separable, so the volume is resampled one axis at a time,
+each pass split in slabs over a thread pool. Arrays are in KJI order and spacing is
+in IJK order, as everywhere else in the module.
+"""
+
+import concurrent.futures
+import os
+
+import numpy as np
+from scipy import ndimage
+
+# Part of the cache keys of resampled volumes; change it when the results of this module change
+RESAMPLER_VERSION = 1
+
+# Interpolated values are nudged away from zero by this much before truncation to an integer type
+TRUNCATION_TOLERANCE = 1e-3
+
+
+def outputShape(shape, spacing, outputSpacing):
+  """
+  KJI shape of the resampled volume.
+  """
+  return tuple(max(1, int(np.floor(size * axisSpacing / axisOutputSpacing + 1e-6)))
+    for size, axisSpacing, axisOutputSpacing in zip(shape, np.asarray(spacing)[::-1], np.asarray(outputSpacing)[::-1]))
+
+
+def _mirror(indices, size):
+  if size == 1:
+    return np.zeros_like(indices)
+  period = 2 * (size - 1)
+  indices = np.abs(indices) % period
+  return np.where(indices >= size, period - indices, indices)
+
+
+def _cubicBSpline(distance):
+  distance = np.abs(distance)
+  return np.where(distance < 1, 2.0/3 - distance**2 + distance**3 / 2,
+    np.where(distance < 2, (2 - distance)**3 / 6, 0.0))
+
+
+def axisWeights(inputSize, outputSize, scale, interpolation):
+  """
+  Input indices and weights of the taps giving each output sample along one axis.
+  Output sample n is at input position n*scale; samples beyond the last input voxel
+  by half a voxel or more are outside the image and get zero weights.
+  :return: (indices, weights), arrays of shape (taps, outputSize)
+  """
+  positions = np.arange(outputSize) * float(scale)
+  if interpolation == 'linear':
+    base = np.floor(positions).astype(np.int64)
+    fraction = positions - base
+    indices = np.clip(np.stack([base, base + 1]), 0, inputSize - 1)
+    weights = np.stack([1 - fraction, fraction])
+  elif interpolation == 'bspline':
+    base = np.floor(positions).astype(np.int64) - 1
+    taps = np.stack([base + tap for tap in range(4)])
+    weights = _cubicBSpline(positions[None, :] - taps)
+    indices = _mirror(taps, inputSize)
+  else:
+    raise ValueError('Unknown interpolation: ' + interpolation)
+  weights[:, positions >= inputSize - 0.5] = 0
+  return indices, weights
+
+
+def _parallelSlabs(function, size, workers):
+  """
+  Call function(start, stop) on slabs of range(size) in a thread pool.
+  """
+  slabCount = min(size, workers * 4) if workers > 1 else 1
+  bounds = np.linspace(0, size, slabCount + 1).astype(int)
+  if slabCount == 1:
+    function(0, size)
+    return
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+    for result in executor.map(function, bounds[:-1], bounds[1:]):
+      pass
+
+
+def _resampleAxis(array, axis, indices, weights, workers):
+  """
+  Interpolate array along one axis with the taps of axisWeights, in float32.
+  """
+  outputArray = np.empty(array.shape[:axis] + (indices.shape[1],) + array.shape[axis+1:], dtype=np.float32)
+  # Slabs are cut along the largest other axis
+  slabAxis = max((a for a in range(3) if a != axis), key=lambda a: array.shape[a])
+  weightShape = [1, 1, 1]
+  weightShape[axis] = -1
+
+  def resampleSlab(start, stop):
+    slab = [slice(None)] * 3
+    slab[slabAxis] = slice(start, stop)
+    slab = tuple(slab)
+    source = array[slab]
+    target = outputArray[slab]
+    np.multiply(np.take(source, indices[0], axis=axis), weights[0].astype(np.float32).reshape(weightShape), out=target)
+    for tap in range(1, len(indices)):
+      target += np.take(source, indices[tap], axis=axis) * weights[tap].astype(np.float32).reshape(weightShape)
+
+  _parallelSlabs(resampleSlab, array.shape[slabAxis], workers)
+  return outputArray
+
+
+def _splineCoefficients(volumeArray, workers):
+  """
+  Cubic B-spline coefficients of the volume (mirror boundary), one axis at a time.
+  """
+  coefficients = volumeArray.astype(np.float32)
+  for axis in range(3):
+    slabAxis = max((a for a in range(3) if a != axis), key=lambda a: coefficients.shape[a])
+
+    def filterSlab(start, stop):
+      slab = [slice(None)] * 3
+      slab[slabAxis] = slice(start, stop)
+      slab = tuple(slab)
+      coefficients[slab] = ndimage.spline_filter1d(coefficients[slab], order=3, axis=axis, mode='mirror', output=np.float32)
+
+    _parallelSlabs(filterSlab, coefficients.shape[slabAxis], workers)
+  return coefficients
+
+
+def resampleArray(volumeArray, spacing, outputSpacing=(0.25, 0.25, 0.25), interpolation='linear', workers=None):
+  """
+  Resample a volume to outputSpacing.
+  :param volumeArray: KJI voxel array
+  :param spacing: IJK spacing of the volume
+  :param interpolation: "linear" or "bspline"
+  :param workers: number of threads, os.cpu_count() by default
+  :return: resampled array, of the type of volumeArray
+  """
+  workers = workers or os.cpu_count() or 1
+  shape = outputShape(volumeArray.shape, spacing, outputSpacing)
+  scales = [axisOutputSpacing / axisSpacing for axisSpacing, axisOutputSpacing in
+    zip(np.asarray(spacing)[::-1], np.asarray(outputSpacing)[::-1])]
+
+  array = _splineCoefficients(volumeArray, workers) if interpolation == 'bspline' else volumeArray
+  # Axes that shrink the volume the most go first, so that the later passes work on less data
+  for axis in sorted(range(3), key=lambda a: shape[a] / volumeArray.shape[a]):
+    indices, weights = axisWeights(volumeArray.shape[axis], shape[axis], scales[axis], interpolation)
+    array = _resampleAxis(array, axis, indices, weights, workers)
+
+  if np.issubdtype(volumeArray.dtype, np.integer):
+    # Values are truncated like the CLI does; the nudge keeps float32 rounding errors from
+    # truncating values that are integers in double precision, such as voxels on the input grid
+    array += np.copysign(TRUNCATION_TOLERANCE, array, dtype=np.float32)
+    limits = np.iinfo(volumeArray.dtype)
+    np.clip(array, limits.min, limits.max, out=array)
+  return array.astype(volumeArray.dtype)
+
+
+def upsampleMask(mask, spacingRatio, offset, shape, workers=None):
+  """
+  Resample a mask of a coarse grid onto a finer grid with the same axes, such as the mask of a
+  structure segmented at a coarser working resolution onto the reference volume. The mask is
+  interpolated linearly and thresholded at one half, only around its extent.
+  :param spacingRatio: coarse spacing over fine spacing along each KJI axis
+  :param offset: position of the first coarse voxel in fine voxel indices along each KJI axis
+  :param shape: KJI shape of the fine grid
+  :return: boolean array of shape
+  """
+  from temporal_bone_postprocessing import _boundingBox
+  workers = workers or os.cpu_count() or 1
+  output = np.zeros(shape, dtype=bool)
+  box = _boundingBox(mask, (1, 1, 1))
+  if box is None:
+    return output
+  array = mask[box].astype(np.float32)
+  outputBox = []
+  for axis in range(3):
+    # Fine voxels whose position falls within the box of the coarse grid
+    first = offset[axis] + box[axis].start * spacingRatio[axis]
+    last = offset[axis] + (box[axis].stop - 1) * spacingRatio[axis]
+    start, stop = max(0, int(np.ceil(first - 1e-6))), min(shape[axis], int(np.floor(last + 1e-6)) + 1)
+    if stop <= start:
+      return output
+    positions = (np.arange(start, stop) - first) / spacingRatio[axis]
+    base = np.floor(positions).astype(np.int64)
+    fraction = positions - base
+    indices = np.clip(np.stack([base, base + 1]), 0, array.shape[axis] - 1)
+    array = _resampleAxis(array, axis, indices, np.stack([1 - fraction, fraction]), workers)
+    outputBox.append(slice(start, stop))
+  output[tuple(outputBox)] = array >= 0.5
+  return output
@@ -0,0 +1,57 @@
+"""
+Localization of the temporal bones in a CT volume.
+
+The otic capsule and petrous bone are the densest bone of the head, so on each
+side of the midline the densest voxels cluster around the temporal bone. A box
+of fixed physical size centred on them covers the structures segmented by the
+AIAA models. Arrays are in KJI order, as returned by slicer.util.arrayFromVolume,
+and spacing is the IJK spacing of the volume node.
+"""
+
+import numpy as np
+
+# Physical size (mm, IJK order) of the region cropped around each temporal bone
+TEMPORAL_BONE_BOX_SIZE_MM = (60.0, 60.0, 50.0)
+
+
+def _sampleStep(shape, maximumSamples):
+  """
+  Stride along every axis giving at most about maximumSamples voxels.
+  """
+  return max(1, int(np.ceil((np.prod(shape) / maximumSamples) ** (1.0 / 3))))
+
+
+def findTemporalBoneBoxes(volumeArray, spacing, boxSizeMm=TEMPORAL_BONE_BOX_SIZE_MM, densePercentile=99.9,
+    minimumDensity=1200, maximumCoverage=0.7, maximumSamples=4000000):
+  """
+  Find a box around each temporal bone.
+  The volume is split in two halves along I (left-right for axial CT). In each half, the voxels
+  above both densePercentile of the half and minimumDensity HU are located on a subsampled grid and
+  a box of boxSizeMm is centred on their median position, then clipped to the volume.
+  :return: list of KJI slice tuples, one per side where dense bone was found. Empty when the boxes
+    together would cover more than maximumCoverage of the volume, for example on scans that are
+    already limited to the temporal bones, where cropping would not save anything.
+  """
+  step = _sampleStep(volumeArray.shape, maximumSamples)
+  sample = volumeArray[::step, ::step, ::step]
+  halfSize = [int(round(size / axisSpacing / 2)) for size, axisSpacing in zip(boxSizeMm[::-1], np.asarray(spacing)[::-1])]
+  midline = sample.shape[2] // 2
+
+  boxes = []
+  for half in (slice(0, midline), slice(midline, sample.shape[2])):
+    halfSample = sample[:, :, half]
+    if halfSample.size == 0:
+      continue
+    threshold = max(minimumDensity, np.percentile(halfSample, densePercentile))
+    dense = np.argwhere(halfSample >= threshold)
+    if len(dense) == 0:
+      continue
+    dense[:, 2] += half.start
+    center = np.median(dense, axis=0) * step
+    boxes.append(tuple(slice(max(0, int(c) - h), min(size, int(c) + h + 1))
+      for c, h, size in zip(center, halfSize, volumeArray.shape)))
+
+  coveredVoxels = sum(int(np.prod([s.stop - s.start for s in box])) for box in boxes)
+  if coveredVoxels > maximumCoverage * volumeArray.size:
+    return []
+  return boxes
@@ -0,0 +1,170 @@
+"""
+Compact store of the binary masks of the structures segmented in one volume.
+
+Each mask is kept cropped to its bounding box, so a structure costs the size of its
+box rather than a labelmap of the whole volume. When the cropped masks outgrow an
+explicit memory budget, the least recently added are spilled to .npy files and read
+back memory-mapped. The structures are turned back into full labelmaps only when
+exported: one multi-label array per group of non-overlapping structures (shared
+segmentation layers), or a single bit-packed array. Arrays are in KJI order.
+"""
+
+import collections
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from temporal_bone_postprocessing import _boundingBox
+
+
+def _relativeBox(box, outerBox):
+  # Slices of box within the array cropped to outerBox
+  return tuple(slice(inner.start - outer.start, inner.stop - outer.start) for inner, outer in zip(box, outerBox))
+
+
+class SegmentationStore:
+  """
+  Structures of a volume of the given shape, by name, in the order they were added.
+  """
+
+  def __init__(self, shape, memoryBudgetBytes=None, spillDirectory=None):
+    """
+    :param shape: KJI shape of the volume
+    :param memoryBudgetBytes: cropped masks kept in memory at most, None for no limit
+    :param spillDirectory: directory of the spilled masks, a new temporary directory by default
+    """
+    self.shape = tuple(shape)
+    self.memoryBudgetBytes = memoryBudgetBytes
+    self.spillDirectory = spillDirectory
+    self.colors = {}
+    self.spilledBytes = 0
+    self._spillCount = 0
+    # name: (box, cropped mask array, or path of its spilled .npy file)
+    self._segments = collections.OrderedDict()
+    self._temporaryDirectory = None
+
+  @property
+  def names(self):
+    return list(self._segments)
+
+  def __contains__(self, name):
+    return name in self._segments
+
+  def box(self, name):
+    return self._segments[name][0]
+
+  def residentBytes(self):
+    return sum(mask.nbytes for box, mask in self._segments.values() if isinstance(mask, np.ndarray))
+
+  def add(self, name, mask, color=None):
+    """
+    Store a full-size boolean mask, replacing the structure of the same name.
+    """
+    if mask.shape != self.shape:
+      raise ValueError('Mask of %s has shape %s, expected %s' % (name, mask.shape, self.shape))
+    self.remove(name)
+    box = _boundingBox(mask, (0, 0, 0)) or (slice(0, 0),) * 3
+    self._segments[name] = (box, np.ascontiguousarray(mask[box], dtype=bool))
+    if color is not None:
+      self.colors[name] = tuple(color)
+    self._enforceBudget(keep=name)
+
+  def remove(self, name):
+    if name not in self._segments:
+      return
+    box, mask = self._segments.pop(name)
+    self.colors.pop(name, None)
+    if not isinstance(mask, np.ndarray):
+      self.spilledBytes -= os.path.getsize(mask)
+      os.remove(mask)
+
+  def _enforceBudget(self, keep):
+    if self.memoryBudgetBytes is None:
+      return
+    for name, (box, mask) in list(self._segments.items()):
+      if self.residentBytes() <= self.memoryBudgetBytes:
+        return
+      if name == keep or not isinstance(mask, np.ndarray):
+        continue
+      if self._temporaryDirectory is None:
+        if self.spillDirectory and not os.path.exists(self.spillDirectory):
+          os.makedirs(self.spillDirectory)
+        self._temporaryDirectory = tempfile.mkdtemp(prefix='TemporalBoneSegments-', dir=self.spillDirectory)
+      self._spillCount += 1
+      path = os.path.join(self._temporaryDirectory, '%d.npy' % self._spillCount)
+      np.save(path, mask)
+      self.spilledBytes += os.path.getsize(path)
+      self._segments[name] = (box, path)
+
+  def croppedMask(self, name):
+    """
+    Mask of a structure within its box (read-only memory map when spilled).
+    """
+    box, mask = self._segments[name]
+    return mask if isinstance(mask, np.ndarray) else np.load(mask, mmap_mode='r')
+
+  def mask(self, name, out=None):
+    """
+    Full-size boolean mask of a structure.
+    """
+    if out is None:
+      out = np.zeros(self.shape, dtype=bool)
+    else:
+      out[...] = False
+    out[self.box(name)] = self.croppedMask(name)
+    return out
+
+  def _overlap(self, name, otherName):
+    box, otherBox = self.box(name), self.box(otherName)
+    common = tuple(slice(max(a.start, b.start), min(a.stop, b.stop)) for a, b in zip(box, otherBox))
+    if any(s.start >= s.stop for s in common):
+      return False
+    return bool(np.any(self.croppedMask(name)[_relativeBox(common, box)] &
+      self.croppedMask(otherName)[_relativeBox(common, otherBox)]))
+
+  def layers(self):
+    """
+    Group the structures so that no two structures of a group overlap; each group can share one labelmap.
+    :return: list of lists of names
+    """
+    layers = []
+    for name in self._segments:
+      for layer in layers:
+        if not any(self._overlap(name, otherName) for otherName in layer):
+          layer.append(name)
+          break
+      else:
+        layers.append([name])
+    return layers
+
+  def layerArray(self, names):
+    """
+    uint8 labelmap where the i-th structure of names has value i+1. The structures must not overlap.
+    """
+    labelmap = np.zeros(self.shape, dtype=np.uint8)
+    for value, name in enumerate(names, 1):
+      labelmap[self.box(name)][self.croppedMask(name)] = value
+    return labelmap
+
+  def packedLabelmap(self, names):
+    """
+    uint8 labelmap where bit i marks the i-th structure of names, so that overlapping structures are kept.
+    Structures missing from the store leave their bit empty.
+    """
+    labelmap = np.zeros(self.shape, dtype=np.uint8)
+    for bit, name in enumerate(names):
+      if name in self._segments:
+        labelmap[self.box(name)] |= self.croppedMask(name).astype(np.uint8) << bit
+    return labelmap
+
+  def close(self):
+    """
+    Remove all structures and delete the spilled masks.
+    """
+    for name in self.names:
+      self.remove(name)
+    if self._temporaryDirectory:
+      shutil.rmtree(self._temporaryDirectory, ignore_errors=True)
+      self._temporaryDirectory = None
@@ -0,0 +1,494 @@
+"""
+Long-lived headless segmentation service.
+
+Slicer is started once and keeps one TemporalBoneAutosegmentationLogic warm: the
+segment editor widget and node are reused from one job to the next, the model list
+of the server is cached, and local models stay loaded. Jobs are accepted over a local
+HTTP port or Unix socket and run one after the other on the main thread of Slicer,
+so the latency of a request is the segmentation itself rather than Slicer startup
+and widget construction. Queued jobs run by priority class (PRIORITIES), then in the
+order they were submitted: an urgent case goes ahead of the queued research cohort,
+once the running job finishes.
+
+  Slicer --no-splash --no-main-window --python-script temporal_bone_service.py [--port 8765 | --socket /tmp/temporal_bone.sock]
+    [--watch INBOX_DIR --watch-output OUTPUT_DIR]
+
+API (JSON bodies):
+
+  POST   /jobs              {"input": VOLUME_FILE, "output": OUTPUT_DIR, "priority": CLASS, options...} -> {"id", "status"}
+  GET    /jobs/ID?wait=S    job record, waiting up to S seconds for the job to finish
+  DELETE /jobs/ID           cancel a queued or running job
+  GET    /stats             job counts and p50/p99 of the queue, run and total latencies, overall and per priority class
+  GET    /health
+  POST   /shutdown          stop after the running job
+
+Options are the arguments of TemporalBoneAutosegmentationLogic.run (JOB_OPTIONS) and
+the per-job settings of the logic (JOB_SETTINGS). batch_segmentation.py --service
+sends its volumes to a running service with ServiceClient, and temporal_bone_ingest
+submits the volumes arriving in a watched directory, from its own process or, with
+--watch, from a thread of the service.
+"""
+
+import argparse
+import collections
+import http.client
+import itertools
+import json
+import logging
+import math
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Arguments of TemporalBoneAutosegmentationLogic.run a job can set
+JOB_OPTIONS = ('exportlabelmaps', 'exportOBJ', 'medianFilter', 'exportDICOM', 'postprocessingEngine', 'cropToROI', 'exportMode')
+
+# Attributes of TemporalBoneAutosegmentationLogic a job can set, restored after the job
+JOB_SETTINGS = ('meshFormat', 'meshLevels', 'dicomFormat', 'dicomSegmentation')
+
+# Finished jobs whose latencies are kept for the percentiles
+LATENCY_WINDOW = 1000
+
+# Finished job records kept for GET /jobs/ID
+MAXIMUM_RECORDS = 10000
+
+DEFAULT_PORT = 8765
+
+# Priority classes of the jobs, queued jobs of a lower rank run first
+PRIORITIES = {'urgent': 0, 'routine': 1, 'research': 2}
+DEFAULT_PRIORITY = 'routine'
+
+
+def percentile(values, fraction):
+  """
+  Nearest-rank percentile of values, None when there are none.
+  """
+  ordered = sorted(values)
+  if not ordered:
+    return None
+  return ordered[min(len(ordered) - 1, max(0, int(math.ceil(fraction * len(ordered))) - 1))]
+
+
+class SegmentationService:
+  """
+  Queue of segmentation jobs run on the thread calling serve().
+  """
+
+  def __init__(self, logic):
+    self.logic = logic
+    # (priority rank, submission number, job ID) of the queued jobs
+    self.jobs = queue.PriorityQueue()
+    self._sequence = itertools.count()
+    self.records = collections.OrderedDict()
+    self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+    self.stopping = threading.Event()
+    # Labels added to the metrics of every job
+    self.metricsLabels = {}
+    self.startTime = time.time()
+    self._finished = {}
+    self._cancelEvents = {}
+    self._lock = threading.Lock()
+
+  def submit(self, request):
+    """
+    Queue a job.
+    :param request: dict with "input" (volume file), "output" (directory) and optional "priority" (PRIORITIES),
+      JOB_OPTIONS and JOB_SETTINGS
+    :return: the job record
+    """
+    if not isinstance(request.get('input'), str) or not isinstance(request.get('output'), str):
+      raise ValueError('"input" and "output" paths are required')
+    if not os.path.exists(request['input']):
+      raise ValueError('Input not found: ' + request['input'])
+    unknown = set(request) - {'input', 'output', 'priority'} - set(JOB_OPTIONS) - set(JOB_SETTINGS)
+    if unknown:
+      raise ValueError('Unknown options: ' + ', '.join(sorted(unknown)))
+    priority = request.get('priority', DEFAULT_PRIORITY)
+    if priority not in PRIORITIES:
+      raise ValueError('Unknown priority %r, one of %s' % (priority, ', '.join(PRIORITIES)))
+    record = {'id': uuid.uuid4().hex, 'status': 'queued', 'request': request, 'priority': priority, 'submitted': time.time(),
+      'queueSeconds': None, 'runSeconds': None, 'totalSeconds': None, 'error': None, 'metrics': None}
+    with self._lock:
+      self.records[record['id']] = record
+      self._finished[record['id']] = threading.Event()
+      self._cancelEvents[record['id']] = threading.Event()
+      while len(self.records) > MAXIMUM_RECORDS:
+        oldId, oldRecord = next(iter(self.records.items()))
+        if oldRecord['status'] in ('queued', 'running'):
+          break
+        del self.records[oldId]
+        del self._finished[oldId]
+        del self._cancelEvents[oldId]
+    self.jobs.put((PRIORITIES[priority], next(self._sequence), record['id']))
+    return dict(record)
+
+  def job(self, jobId, wait=0):
+    """
+    Record of a job, after waiting up to wait seconds for it to finish. None for an unknown job.
+    """
+    with self._lock:
+      finished = self._finished.get(jobId)
+    if finished is None:
+      return None
+    if wait:
+      finished.wait(wait)
+    with self._lock:
+      return dict(self.records[jobId])
+
+  def cancel(self, jobId):
+    """
+    Cancel a job: a queued job is skipped and a running one stops at its next stage.
+    :return: False for an unknown job
+    """
+    with self._lock:
+      if jobId not in self._cancelEvents:
+        return False
+      self._cancelEvents[jobId].set()
+    return True
+
+  def statistics(self):
+    """
+    Job counts and p50/p99 latencies (seconds) of the last LATENCY_WINDOW finished jobs, overall and
+    per priority class under "priorities".
+    """
+    with self._lock:
+      counts = collections.Counter(record['status'] for record in self.records.values())
+      latencies = list(self.latencies)
+    statistics = {'uptimeSeconds': round(time.time() - self.startTime, 1), 'jobs': dict(counts), 'queued': self.jobs.qsize()}
+
+    def summary(latencies):
+      percentiles = {}
+      for name in ('queueSeconds', 'runSeconds', 'totalSeconds'):
+        values = [latency[name] for latency in latencies]
+        percentiles[name] = {'p50': percentile(values, 0.5), 'p99': percentile(values, 0.99), 'count': len(values)}
+      return percentiles
+
+    statistics.update(summary(latencies))
+    statistics['priorities'] = {priority: summary([latency for latency in latencies if latency['priority'] == priority])
+      for priority in PRIORITIES}
+    return statistics
+
+  def _update(self, jobId, **fields):
+    with self._lock:
+      self.records[jobId].update(fields)
+      return dict(self.records[jobId])
+
+  def runJob(self, jobId):
+    """
+    Run a job on the calling thread, the main thread of Slicer.
+    """
+    import slicer
+    from temporal_bone_slicer_module import RunCancelled
+    with self._lock:
+      record = self.records[jobId]
+      cancelEvent = self._cancelEvents[jobId]
+    request = record['request']
+    startTime = time.time()
+    if cancelEvent.is_set():
+      self._update(jobId, status='cancelled', queueSeconds=startTime - record['submitted'])
+      self._finished[jobId].set()
+      return
+    self._update(jobId, status='running', started=startTime, queueSeconds=startTime - record['submitted'])
+    logic = self.logic
+    defaults = {name: getattr(logic, name) for name in JOB_SETTINGS}
+    nodeIDs = set(node.GetID() for node in slicer.util.getNodes('*').values())
+    status, error, metrics = 'failed', None, None
+    try:
+      for name in JOB_SETTINGS:
+        if name in request:
+          setattr(logic, name, request[name])
+      logic.cancelEvent = cancelEvent
+      logic.metricsLabels = dict(self.metricsLabels, path=request['input'], job=jobId, priority=record['priority'],
+        queueSeconds=round(record['queueSeconds'], 3))
+      if not os.path.exists(request['output']):
+        os.makedirs(request['output'])
+      options = {name: request[name] for name in JOB_OPTIONS if name in request}
+      if options.get('cropToROI'):
+        inputVolume, options['crops'] = logic.loadTemporalBoneCrops(request['input'])
+      else:
+        inputVolume = logic.loadVolume(request['input'])
+      metrics = logic.run(inputVolume, request['output'], showResult=False, **options)
+      status = 'done'
+    except RunCancelled:
+      status = 'cancelled'
+    except Exception as exception:
+      logging.exception('Job %s failed' % jobId)
+      error = str(exception)
+    finally:
+      for name, value in defaults.items():
+        setattr(logic, name, value)
+      logic.cancelEvent = None
+      # Remove the nodes of the job; the kept segment editor node stays for the next one
+      keptNode = logic._segmentEditor[1] if logic._segmentEditor else None
+      for node in list(slicer.util.getNodes('*').values()):
+        if node.GetID() not in nodeIDs and node is not keptNode and not node.IsSingleton() and node.GetScene():
+          slicer.mrmlScene.RemoveNode(node)
+    endTime = time.time()
+    record = self._update(jobId, status=status, error=error, metrics=metrics, finished=endTime, runSeconds=endTime - startTime,
+      totalSeconds=endTime - record['submitted'])
+    with self._lock:
+      if status == 'done':
+        self.latencies.append({name: record[name] for name in ('priority', 'queueSeconds', 'runSeconds', 'totalSeconds')})
+    self._finished[jobId].set()
+    statistics = self.statistics()
+    logging.info('Job %s (%s) %s in %.1f s (queued %.1f s); total latency p50 %.1f s, p99 %.1f s over %d jobs' % (jobId, record['priority'], status,
+      record['runSeconds'], record['queueSeconds'], statistics['totalSeconds']['p50'] or 0, statistics['totalSeconds']['p99'] or 0,
+      statistics['totalSeconds']['count']))
+
+  def serve(self):
+    """
+    Run the queued jobs until stopping is set. Runs on the main thread of Slicer, processing its events between jobs.
+    """
+    import slicer
+    while not self.stopping.is_set():
+      try:
+        rank, sequence, jobId = self.jobs.get(timeout=0.2)
+      except queue.Empty:
+        slicer.app.processEvents()
+        continue
+      self.runJob(jobId)
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+  """
+  JSON API of a SegmentationService, which the server holds as its service attribute.
+  """
+  protocol_version = 'HTTP/1.1'
+
+  def _send(self, status, body):
+    data = json.dumps(body, default=str).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def _jobId(self, path):
+    parts = path.strip('/').split('/')
+    return parts[1] if len(parts) == 2 and parts[0] == 'jobs' else None
+
+  def do_GET(self):
+    url = urlparse(self.path)
+    service = self.server.service
+    if url.path == '/health':
+      self._send(200, {'status': 'ok'})
+    elif url.path == '/stats':
+      self._send(200, service.statistics())
+    elif self._jobId(url.path):
+      wait = float(parse_qs(url.query).get('wait', ['0'])[0])
+      record = service.job(self._jobId(url.path), min(wait, 300))
+      self._send(200 if record else 404, record or {'error': 'unknown job'})
+    else:
+      self._send(404, {'error': 'not found'})
+
+  def do_POST(self):
+    url = urlparse(self.path)
+    service = self.server.service
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    if url.path == '/jobs':
+      try:
+        self._send(202, service.submit(json.loads(body or b'{}')))
+      except ValueError as error:
+        self._send(400, {'error': str(error)})
+    elif url.path == '/shutdown':
+      service.stopping.set()
+      self._send(200, {'status': 'stopping'})
+    else:
+      self._send(404, {'error': 'not found'})
+
+  def do_DELETE(self):
+    jobId = self._jobId(urlparse(self.path).path)
+    if jobId and self.server.service.cancel(jobId):
+      self._send(200, {'id': jobId, 'status': 'cancelling'})
+    else:
+      self._send(404, {'error': 'unknown job'})
+
+  def address_string(self):
+    # Unix socket clients have no address
+    return self.client_address[0] if self.client_address else 'unix'
+
+  def log_message(self, format, *args):
+    logging.debug('%s %s' % (self.address_string(), format % args))
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+  def server_bind(self):
+    if os.path.exists(self.server_address):
+      os.remove(self.server_address)
+    socketserver.UnixStreamServer.server_bind(self)
+
+
+def createServer(service, host='127.0.0.1', port=DEFAULT_PORT, socketPath=None):
+  """
+  HTTP server of the API of service, on a Unix socket when socketPath is given.
+  """
+  server = UnixHTTPServer(socketPath, ServiceRequestHandler) if socketPath else ThreadingHTTPServer((host, port), ServiceRequestHandler)
+  server.service = service
+  return server
+
+
+class ServiceError(RuntimeError):
+  """
+  Error answered by the service, with the HTTP status of the response.
+  """
+
+  def __init__(self, message, status):
+    RuntimeError.__init__(self, message)
+    self.status = status
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+  def __init__(self, socketPath, timeout=None):
+    http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+    self.socketPath = socketPath
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.settimeout(self.timeout)
+    self.sock.connect(self.socketPath)
+
+
+class ServiceClient:
+  """
+  Client of a running service, at "http://HOST:PORT" or "unix:SOCKET_PATH".
+  """
+
+  def __init__(self, address, timeout=600):
+    self.address = address
+    self.timeout = timeout
+
+  def _connection(self):
+    if self.address.startswith('unix:'):
+      return UnixHTTPConnection(self.address[len('unix:'):], self.timeout)
+    url = urlparse(self.address if '://' in self.address else 'http://' + self.address)
+    return http.client.HTTPConnection(url.netloc, timeout=self.timeout)
+
+  def _request(self, method, path, body=None):
+    connection = self._connection()
+    try:
+      data = json.dumps(body).encode('utf-8') if body is not None else None
+      connection.request(method, path, body=data, headers={'Content-Type': 'application/json'} if data else {})
+      response = connection.getresponse()
+      result = json.loads(response.read() or b'{}')
+      if response.status >= 400:
+        raise ServiceError('%s %s failed with status %d: %s' % (method, path, response.status, result.get('error')), response.status)
+      return result
+    finally:
+      connection.close()
+
+  def submit(self, inputPath, outputDirectory, **options):
+    """
+    :return: the job record, with its "id"
+    """
+    return self._request('POST', '/jobs', dict(options, input=os.path.abspath(inputPath), output=os.path.abspath(outputDirectory)))
+
+  def wait(self, jobId, timeout=None, pollSeconds=60):
+    """
+    Wait for a job to finish.
+    :return: its record, still queued or running if timeout expired
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    while True:
+      wait = pollSeconds if deadline is None else max(0, min(pollSeconds, deadline - time.time()))
+      record = self._request('GET', '/jobs/%s?wait=%g' % (jobId, wait))
+      if record['status'] not in ('queued', 'running') or (deadline is not None and time.time() >= deadline):
+        return record
+
+  def job(self, jobId, wait=0):
+    """
+    Record of a job, after waiting up to wait seconds for it to finish. None for a job the service does not
+    know, such as one submitted before it restarted.
+    """
+    try:
+      return self._request('GET', '/jobs/%s?wait=%g' % (jobId, wait))
+    except ServiceError as error:
+      if error.status == 404:
+        return None
+      raise
+
+  def cancel(self, jobId):
+    return self._request('DELETE', '/jobs/' + jobId)
+
+  def statistics(self):
+    return self._request('GET', '/stats')
+
+
+def main(argv):
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--host', default='127.0.0.1')
+  parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+  parser.add_argument('--socket', help='listen on this Unix socket instead of the TCP port')
+  parser.add_argument('--model-list-max-age', type=float, default=300, help='seconds the model list of the server is reused for')
+  parser.add_argument('--model-directory', help='run the models on the CPU from the ONNX/TorchScript files of this directory '
+    'instead of requesting the AIAA server; they are loaded once')
+  parser.add_argument('--metrics-file', help='JSON lines file receiving the per-stage metrics of every job')
+  parser.add_argument('--statistics-file', help='CSV file receiving the statistics of the structures of every job')
+  parser.add_argument('--watch', help='segment the volumes arriving in this directory, see temporal_bone_ingest')
+  parser.add_argument('--watch-output', help='output directory of the watched volumes')
+  parser.add_argument('--default-priority', choices=list(PRIORITIES), default=DEFAULT_PRIORITY,
+    help='priority class of the watched volumes outside the urgent/, routine/ and research/ directories')
+  parser.add_argument('--prometheus-textfile', help='Prometheus textfile rewritten with the latencies of the watched volumes')
+  args = parser.parse_args(argv)
+  if args.watch and not args.watch_output:
+    parser.error('--watch requires --watch-output')
+
+  import slicer
+  sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+  import temporal_bone_slicer_module
+  from temporal_bone_slicer_module import TemporalBoneAutosegmentationLogic
+  logging.getLogger().setLevel(logging.INFO)
+  logic = TemporalBoneAutosegmentationLogic()
+  logic.keepSegmentEditor = True
+  logic.modelListMaxAgeSeconds = args.model_list_max_age
+  logic.metricsJsonLinesPath = args.metrics_file
+  if args.statistics_file:
+    import temporal_bone_statistics
+    logic.statisticsWriter = temporal_bone_statistics.StatisticsWriter(args.statistics_file)
+  if args.model_directory:
+    import temporal_bone_local_inference
+    logic.inferenceClient = temporal_bone_local_inference.LocalInferenceClient(args.model_directory)
+
+  if logic.inferenceCache:
+    # Request the model list now rather than in the first job, opening the first pooled connection
+    try:
+      logic.modelVersions(logic.inferenceClient or logic.serverClient(temporal_bone_slicer_module.AIAA_SERVER_URL))
+    except Exception as error:
+      logging.warning('Could not get the model list: %s' % error)
+
+  service = SegmentationService(logic)
+  server = createServer(service, args.host, args.port, args.socket)
+  serverThread = threading.Thread(target=server.serve_forever, name='TemporalBoneService', daemon=True)
+  serverThread.start()
+  logging.info('Segmentation service listening on %s' % (args.socket or '%s:%d' % (args.host, args.port)))
+  ingestor = None
+  if args.watch:
+    import temporal_bone_ingest
+    ingestor = temporal_bone_ingest.Ingestor(service, args.watch, args.watch_output, args.default_priority)
+    ingestor.prometheusPath = args.prometheus_textfile
+    threading.Thread(target=ingestor.run, name='TemporalBoneIngest', daemon=True).start()
+  try:
+    service.serve()
+  finally:
+    if ingestor:
+      ingestor.stopping.set()
+    server.shutdown()
+    server.server_close()
+    if logic.statisticsWriter:
+      logic.statisticsWriter.close()
+  return 0
+
+
+if __name__ == '__main__':
+  exitCode = main(sys.argv[1:])
+  import slicer
+  slicer.util.exit(exitCode)
@@ -1,4 +1,7 @@
 import os
+import json
+import shutil
+import time
 import unittest
 import logging
 import vtk, qt, ctk, slicer
@@ -82,6 +85,32 @@ class TemporalBoneAutosegmentationWidget(ScriptedLoadableModuleWidget, VTKObserv
     self.ui.medianFilterCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
     #self.ui.exportDICOMCheckBox.connect("toggled(bool)", self.updateParameterNodeFromGUI)
 
+    # Background runs: queued volumes are segmented one after the other in separate Slicer processes
+    self.backgroundQueue = BackgroundRunQueue(self.onBackgroundProgress, self.onBackgroundFinished)
+    backgroundCollapsibleButton = ctk.ctkCollapsibleButton()
+    backgroundCollapsibleButton.text = "Background runs"
+    self.layout.addWidget(backgroundCollapsibleButton)
+    backgroundLayout = qt.QFormLayout(backgroundCollapsibleButton)
+    self.queueButton = qt.QPushButton("Add to queue")
+    self.queueButton.toolTip = "Segment the input volume in the background with the current options."
+    backgroundLayout.addRow(self.queueButton)
+    self.progressLabel = qt.QLabel("Idle")
+    self.progressBar = qt.QProgressBar()
+    backgroundLayout.addRow(self.progressLabel, self.progressBar)
+    self.queueList = qt.QListWidget()
+    self.queueList.toolTip = "Volumes waiting for their background run"
+    backgroundLayout.addRow("Queued:", self.queueList)
+    self.cancelButton = qt.QPushButton("Cancel current run")
+    self.clearQueueButton = qt.QPushButton("Clear queue")
+    buttonsLayout = qt.QHBoxLayout()
+    buttonsLayout.addWidget(self.cancelButton)
+    buttonsLayout.addWidget(self.clearQueueButton)
+    backgroundLayout.addRow(buttonsLayout)
+    self.queueButton.connect('clicked(bool)', self.onQueueButton)
+    self.cancelButton.connect('clicked(bool)', self.onCancelButton)
+    self.clearQueueButton.connect('clicked(bool)', self.onClearQueueButton)
+    self.updateBackgroundGUI()
+
     # Initial GUI update
     self.updateGUIFromParameterNode()
 
@@ -90,6 +119,7 @@ class TemporalBoneAutosegmentationWidget(ScriptedLoadableModuleWidget, VTKObserv
     Called when the application closes and the module widget is destroyed.
     """
     self.removeObservers()
+    self.backgroundQueue.shutdown()
 
   def setParameterNode(self, inputParameterNode):
     """
@@ -165,6 +195,7 @@ class TemporalBoneAutosegmentationWidget(ScriptedLoadableModuleWidget, VTKObserv
     else:
       self.ui.applyButton.toolTip = "Select input volume nodes"
       self.ui.applyButton.enabled = False
+    self.queueButton.enabled = self.ui.applyButton.enabled
 
   def updateParameterNodeFromGUI(self, caller=None, event=None):
     """
@@ -195,11 +226,266 @@ class TemporalBoneAutosegmentationWidget(ScriptedLoadableModuleWidget, VTKObserv
       import traceback
       traceback.print_exc()
 
+  def onQueueButton(self):
+    """
+    Queue the input volume for a background run with the current options.
+    """
+    try:
+      self.backgroundQueue.enqueue(self.ui.inputSelector.currentNode(), self.ui.DirectoryButton.directory,
+        exportlabelmaps=self.ui.exportlabelmapsCheckBox.checked, exportOBJ=self.ui.exportOBJCheckBox.checked,
+        medianFilter=self.ui.medianFilterCheckBox.checked, exportDICOM=self.ui.exportDICOMcheckBox.checked)
+    except Exception as e:
+      slicer.util.errorDisplay("Failed to queue the volume: "+str(e))
+    self.updateBackgroundGUI()
+
+  def onCancelButton(self):
+    self.backgroundQueue.cancel()
+    self.updateBackgroundGUI()
+
+  def onClearQueueButton(self):
+    self.backgroundQueue.clear()
+    self.updateBackgroundGUI()
+
+  def onBackgroundProgress(self, job, stage, percent):
+    self.progressLabel.text = "%s: %s" % (job['name'], stage)
+    self.progressBar.value = percent
+
+  def onBackgroundFinished(self, job, status):
+    """
+    Show the structures of a finished background run, or report why it stopped.
+    """
+    if status == 'done':
+      self.logic.loadExportedStructures(job['directory'], job['name'] + '_segmentation')
+    elif status == 'failed':
+      slicer.util.errorDisplay("Background run of %s failed, see %s" % (job['name'], job['logFile']))
+    logging.info('Background run of %s: %s' % (job['name'], status))
+    self.updateBackgroundGUI()
+
+  def updateBackgroundGUI(self):
+    self.queueList.clear()
+    for job in self.backgroundQueue.pending:
+      self.queueList.addItem(job['name'])
+    running = self.backgroundQueue.current is not None
+    self.cancelButton.enabled = running
+    self.clearQueueButton.enabled = len(self.backgroundQueue.pending) > 0
+    if not running:
+      self.progressLabel.text = "Idle"
+      self.progressBar.value = 0
+
+#
+# BackgroundRunQueue
+#
+
+class BackgroundRunQueue:
+  """
+  Volumes segmented one after the other, each in a headless Slicer process running the worker of
+  batch_segmentation.py, so that the application stays responsive. Progress is read from the
+  progress file the worker appends to. Cancelling asks the worker to stop at its next stage, and
+  kills it if it has not stopped after CANCEL_TIMEOUT_SECONDS (for example in a stuck server request).
+  """
+
+  POLL_INTERVAL_MS = 500
+  CANCEL_TIMEOUT_SECONDS = 30
+
+  def __init__(self, onProgress, onFinished):
+    """
+    :param onProgress: called as onProgress(job, stage name, percent)
+    :param onFinished: called as onFinished(job, status) with status "done", "failed" or "cancelled"
+    """
+    self.onProgress = onProgress
+    self.onFinished = onFinished
+    self.pending = []
+    self.current = None
+    self.process = None
+    self.timer = qt.QTimer()
+    self.timer.setInterval(self.POLL_INTERVAL_MS)
+    self.timer.connect('timeout()', self.poll)
+
+  def enqueue(self, volumeNode, directory, exportlabelmaps=True, exportOBJ=True, medianFilter=True, exportDICOM=True):
+    """
+    Queue a volume. It is saved right away, so later changes of the node do not affect the run.
+    The outputs are written to directory as by TemporalBoneAutosegmentationLogic.run.
+    """
+    import tempfile
+    if not volumeNode:
+      raise ValueError("Input volume is invalid")
+    if not directory:
+      raise ValueError("Output directory is not set")
+    workDirectory = tempfile.mkdtemp(prefix='TemporalBoneBackground-', dir=slicer.app.temporaryPath)
+    name = volumeNode.GetName()
+    volumeFile = os.path.join(workDirectory, name + '.nrrd')
+    slicer.util.saveNode(volumeNode, volumeFile)
+    options = [option for option, enabled in (('--no-labelmaps', exportlabelmaps), ('--no-obj', exportOBJ),
+      ('--no-median', medianFilter), ('--no-dicom', exportDICOM)) if not enabled]
+    self.pending.append({'name': name, 'volumeFile': volumeFile, 'directory': directory, 'options': options,
+      'workDirectory': workDirectory, 'progressFile': os.path.join(workDirectory, 'progress.jsonl'),
+      'cancelFile': os.path.join(workDirectory, 'cancel'), 'logFile': os.path.join(workDirectory, 'slicer.log')})
+    if self.current is None:
+      self.startNext()
+
+  def startNext(self):
+    if not self.pending:
+      self.timer.stop()
+      return
+    self.current = job = self.pending.pop(0)
+    job['progressOffset'] = 0
+    job['cancelTime'] = None
+    if not os.path.exists(job['directory']):
+      os.makedirs(job['directory'])
+    batchScript = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'batch_segmentation.py')
+    self.process = qt.QProcess()
+    self.process.setProcessChannelMode(qt.QProcess.MergedChannels)
+    self.process.setStandardOutputFile(job['logFile'])
+    self.process.start(slicer.app.launcherExecutableFilePath, ['--no-splash', '--no-main-window', '--python-script',
+      batchScript, '--worker', job['volumeFile'], job['directory'], '--progress-file', job['progressFile'],
+      '--cancel-file', job['cancelFile']] + job['options'])
+    self.onProgress(job, 'starting', 0)
+    self.timer.start()
+
+  def poll(self):
+    job = self.current
+    if job is None:
+      return
+    if os.path.exists(job['progressFile']):
+      with open(job['progressFile']) as progressFile:
+        progressFile.seek(job['progressOffset'])
+        lines = progressFile.readlines()
+        # A line still being written is read again at the next poll
+        if lines and not lines[-1].endswith('\n'):
+          lines.pop()
+        job['progressOffset'] += sum(len(line) for line in lines)
+      for line in lines:
+        progress = json.loads(line)
+        self.onProgress(job, progress['stage'], progress['percent'])
+
+    if self.process.state() != qt.QProcess.NotRunning:
+      if job['cancelTime'] is not None and time.time() - job['cancelTime'] > self.CANCEL_TIMEOUT_SECONDS:
+        self.process.kill()
+      return
+    if job['cancelTime'] is not None:
+      status = 'cancelled'
+    elif self.process.exitStatus() == qt.QProcess.NormalExit and self.process.exitCode() == 0:
+      status = 'done'
+    else:
+      status = 'failed'
+    self.current = None
+    self.process = None
+    # The log is kept with the outputs, named after the volume as jobs can share an output directory,
+    # and the saved volume is deleted
+    if os.path.exists(job['logFile']):
+      logFile = os.path.join(job['directory'], job['name'] + '_slicer.log')
+      shutil.copy(job['logFile'], logFile)
+      job['logFile'] = logFile
+    shutil.rmtree(job['workDirectory'], ignore_errors=True)
+    self.onFinished(job, status)
+    self.startNext()
+
+  def cancel(self):
+    """
+    Cancel the current run. Queued volumes still run.
+    """
+    if self.current is None or self.current['cancelTime'] is not None:
+      return
+    open(self.current['cancelFile'], 'w').close()
+    self.current['cancelTime'] = time.time()
+
+  def clear(self):
+    """
+    Remove the volumes that have not started yet.
+    """
+    for job in self.pending:
+      shutil.rmtree(job['workDirectory'], ignore_errors=True)
+    self.pending = []
+
+  def shutdown(self):
+    """
+    Stop the current run without waiting and forget the queue, when the application closes.
+    """
+    self.clear()
+    self.timer.stop()
+    if self.process is not None:
+      self.process.kill()
+      self.process.waitForFinished(5000)
+      shutil.rmtree(self.current['workDirectory'], ignore_errors=True)
+      self.process = None
+      self.current = None
+
 
 #
 # TemporalBoneAutosegmentationLogic
 #
 
+AIAA_SERVER_URL = "http://tbone.onthewifi.com:956/v1/models"
+
+# Maximum size of the on-disk cache of model outputs
+INFERENCE_CACHE_SIZE_BYTES = 20*1024**3
+
+# Maximum size of the on-disk cache of resampled volumes
+RESAMPLE_CACHE_SIZE_BYTES = 10*1024**3
+
+# Maximum size of the on-disk cache of post-processing stage results
+PIPELINE_CACHE_SIZE_BYTES = 2*1024**3
+
+# Maximum size of the on-disk cache of compressed input volumes converted to raw, memory-mappable NRRD files
+VOLUME_CACHE_SIZE_BYTES = 20*1024**3
+
+# File of the output directory recording the stage keys of the exported structures and the stats of
+# their files, so that structures whose key did not change and whose files are intact are not exported again
+EXPORT_MANIFEST_NAME = 'pipeline.json'
+
+# Memory held at most by the cropped structure masks of a volume being segmented; more is spilled to disk
+SEGMENTATION_MEMORY_BUDGET_BYTES = 256*1024**2
+
+# Labelmap file name and OBJ name suffix of the structure exported from each AIAA model.
+# The inner ear model is post-processed into the otic capsule.
+AIAA_MODEL_EXPORTS = {
+  "inner_ear": ("oticcapsule_labelmap", "otic capsule"),
+  "ossicles": ("ossicles_labelmap", "ossicles"),
+  "cochlear_duct": ("cochlear_duct_labelmap", "cochlear_duct"),
+  "facial_nerve": ("facial_labelmap", "facial_nerve"),
+  "sigmoid_sinus": ("sigmoid_labelmap", "sigmoid"),
+}
+
+# Isotropic spacing (mm) the volume is resampled to, the geometry of the exported structures
+REFERENCE_SPACING_MM = 0.25
+
+# Isotropic spacing (mm) each AIAA model segments the volume at. Coarse structures can be segmented at a
+# coarser spacing, for example logic.workingSpacing["sigmoid_sinus"] = 0.5 segments the sigmoid sinus on
+# 8 times fewer voxels, its mask being upsampled to REFERENCE_SPACING_MM afterwards. The models were
+# trained at 0.25 mm, so check the accuracy of a coarser spacing with benchmarks/benchmark_working_resolution.py.
+STRUCTURE_WORKING_SPACING_MM = dict.fromkeys(AIAA_MODEL_EXPORTS, REFERENCE_SPACING_MM)
+
+# Models segmenting the median filtered volume, and those of them given only the region of it around the
+# temporal bones: the sigmoid sinus runs along the posterior fossa and can leave that region
+MEDIAN_FILTER_MODELS = ("facial_nerve", "sigmoid_sinus")
+CROPPED_MEDIAN_FILTER_MODELS = ("facial_nerve",)
+
+# Display color of the structure segmented from each AIAA model
+AIAA_MODEL_COLORS = {
+  "inner_ear": (0.89,0.92,0.65),
+  "ossicles": (1,1,0.88),
+  "cochlear_duct": (1,0,0),
+  "facial_nerve": (0.9,1,0),
+}
+
+# Progress (percent) reported when each stage of run() starts. The post-processing of each structure
+# advances it from "inference" to "save-volume".
+RUN_STAGE_PROGRESS = {
+  "crop": 1,
+  "resample": 3,
+  "median": 12,
+  "inference": 18,
+  "save-volume": 88,
+  "dicom": 92,
+  "display": 97,
+}
+
+class RunCancelled(Exception):
+  """
+  Raised by run() when its cancelEvent is set, at the start of the next stage.
+  """
+  pass
+
 class TemporalBoneAutosegmentationLogic(ScriptedLoadableModuleLogic):
   """This class should implement all the actual
   computation done by your module.  The interface
@@ -210,6 +496,81 @@ class TemporalBoneAutosegmentationLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  def __init__(self):
+    """
+    Called when the logic class is instantiated. Can be used for initializing member variables.
+    """
+    ScriptedLoadableModuleLogic.__init__(self)
+    import temporal_bone_cache
+    # Raw model outputs, reused when the same volume is segmented again with the same model version.
+    # Set to None to always request the server.
+    self.inferenceCache = temporal_bone_cache.FileCache(
+      os.path.join(slicer.app.cachePath, 'TemporalBoneAutosegmentation', 'inference'), INFERENCE_CACHE_SIZE_BYTES)
+    # Resampled volumes, reused when the same volume is segmented again. Set to None to always resample.
+    self.resampleCache = temporal_bone_cache.FileCache(
+      os.path.join(slicer.app.cachePath, 'TemporalBoneAutosegmentation', 'resample'), RESAMPLE_CACHE_SIZE_BYTES)
+    # Results of the post-processing stages, reused when only some of their inputs or parameters change.
+    # Set to None to always run all stages.
+    self.pipelineCache = temporal_bone_cache.FileCache(
+      os.path.join(slicer.app.cachePath, 'TemporalBoneAutosegmentation', 'pipeline'), PIPELINE_CACHE_SIZE_BYTES, extension='.npz')
+    # Raw copies of compressed NRRD inputs, memory-mapped by loadVolume. Set to None to decode them in memory.
+    self.volumeCache = temporal_bone_cache.FileCache(
+      os.path.join(slicer.app.cachePath, 'TemporalBoneAutosegmentation', 'volumes'), VOLUME_CACHE_SIZE_BYTES)
+    # Post-processing of the model outputs, see temporal_bone_postprocessing.postprocessingStages. The parameters
+    # of the stages can be edited, for example the mask range of the otic capsule:
+    # logic.postprocessingStages[1].parameters["maskRange"] = [600, 2500]
+    import temporal_bone_postprocessing
+    self.postprocessingStages = temporal_bone_postprocessing.postprocessingStages()
+    # "numpy" resamples in process with temporal_bone_resample, "cli" with the resamplescalarvolume CLI
+    self.resamplingEngine = "numpy"
+    # Working spacing of each model, see STRUCTURE_WORKING_SPACING_MM
+    self.workingSpacing = dict(STRUCTURE_WORKING_SPACING_MM)
+    # Memory budget of the structures kept while a volume is segmented, see temporal_bone_segmentation_store
+    self.segmentationMemoryBudgetBytes = SEGMENTATION_MEMORY_BUDGET_BYTES
+    # Client running the segmentation models. None requests the AIAA server; set it to a
+    # temporal_bone_local_inference.LocalInferenceClient to segment on this computer.
+    self.inferenceClient = None
+    import temporal_bone_metrics
+    # Per-stage metrics of the last run, see run()
+    self.metrics = temporal_bone_metrics.RunMetrics()
+    # When set, each run is appended to this JSON lines file and written to this Prometheus textfile
+    self.metricsJsonLinesPath = None
+    self.metricsPrometheusPath = None
+    # Labels added to the metrics of every run, for example the path of the input file
+    self.metricsLabels = {}
+    # When set to a temporal_bone_statistics.StatisticsWriter, the statistics of the structures of
+    # every segmented volume are appended to its cohort file once its run has succeeded
+    self.statisticsWriter = None
+    # Statistics rows of the volumes segmented by the current run, not written yet
+    self._statisticsRows = []
+    # Format of the structure surfaces: "obj" exports them through the segmentation as each structure
+    # is post-processed; "ply" or "stl" meshes all structures in parallel at the end, as binary files
+    # (see temporal_bone_mesh) with meshSmoothingFactor and a file per decimation level of meshLevels
+    self.meshFormat = "obj"
+    self.meshSmoothingFactor = 0.5
+    self.meshLevels = (0.0,)
+    # DICOM export of the isotropic volume: "slicer" exports it through the subject hierarchy and the
+    # DICOM module; "classic" writes one CT file per slice and "enhanced" a single Enhanced CT file,
+    # straight from the voxel array (see temporal_bone_dicom and benchmarks/benchmark_dicom.py)
+    self.dicomFormat = "slicer"
+    # Also export the structures as a DICOM Segmentation object referencing the volume series
+    self.dicomSegmentation = False
+    # Called as progressCallback(stage name, percent) as run() goes through its stages
+    self.progressCallback = None
+    # Object with an is_set() method, such as a threading.Event; run() stops with RunCancelled
+    # at the start of the next stage once it is set
+    self.cancelEvent = None
+    # Reuse the segment editor widget and node from one run to the next, for long-lived logics
+    # such as temporal_bone_service
+    self.keepSegmentEditor = False
+    # Seconds the model list of a server is reused for, 0 to request it at every run
+    self.modelListMaxAgeSeconds = 0
+    self._progress = 0
+    self._volumeDigests = {}
+    self._segmentEditor = None
+    self._modelVersions = {}
+    self._serverClients = {}
+
   def setDefaultParameters(self, parameterNode):
     """
     Initialize parameter node with default settings.
@@ -221,307 +582,993 @@ class TemporalBoneAutosegmentationLogic(ScriptedLoadableModuleLogic):
     if not parameterNode.GetParameter("exportDICOM"):
       parameterNode.SetParameter("exportDICOM", "True")
 
-  def run(self, inputVolume, directory, exportlabelmaps=True, exportOBJ=True, medianFilter=True, exportDICOM=True, showResult=True):
+  def loadVolume(self, path):
     """
-    Run the processing algorithm.
-    Can be used without GUI widget.
-    :param inputVolume: volume to be segmented
-    :param exportOBJ: export to OBJ files
-    :param exportlabelmaps: export to labelmaps
-    :param medianFilter: Whether the medial filter is used for improving the segmentation
-    :param exportDICOM: Whether the isotropic volume is exported as a DICOM series
-    :param showResult: show output volume in slice viewers
+    Load a volume file as a volume node. NRRD files are memory-mapped (see temporal_bone_mmap) and their
+    voxels copied straight into the node: compressed files are decompressed once into self.volumeCache and
+    mapped from there on, instead of being decoded whole by the Slicer reader at every load.
+    The node holds a full in-memory copy of the voxels, so this only saves load time; loadTemporalBoneCrops
+    also saves the memory of the whole volume when only the temporal bones are segmented.
+    Other formats, and NRRD files the mapping does not handle, are loaded by Slicer.
     """
+    mapped = self._mapNrrd(path)
+    if mapped is None:
+      return slicer.util.loadVolume(path)
+    volumeArray, ijkToRAS, name = mapped
+    return slicer.util.addVolumeFromArray(volumeArray, ijkToRAS=ijkToRAS, name=name)
 
-    if not inputVolume:
-      raise ValueError("Input volume is invalid")
+  def loadTemporalBoneCrops(self, path):
+    """
+    Load only the temporal bones of a volume file, for run() with cropToROI. The temporal bones of NRRD
+    files are found in the memory-mapped voxels (see loadVolume) and only their crops are copied into
+    volume nodes, so the whole volume is never held in memory.
+    :return: (volume node, crops as cropTemporalBones returns them). When both temporal bones are found,
+      the volume node has the axes and extent of the volume but no voxels, for exporting the labelmaps
+      of both sides in its geometry. Otherwise the volume is loaded whole by loadVolume and crops is empty.
+    """
+    import numpy as np
+    import temporal_bone_roi
+    mapped = self._mapNrrd(path)
+    if mapped is None:
+      return self.loadVolume(path), []
+    volumeArray, ijkToRAS, name = mapped
+    spacing = np.linalg.norm(np.asarray(ijkToRAS, dtype=float)[:3, :3], axis=0)
+    boxes = temporal_bone_roi.findTemporalBoneBoxes(volumeArray, spacing)
+    if len(boxes) != 2:
+      return slicer.util.addVolumeFromArray(volumeArray, ijkToRAS=ijkToRAS, name=name), []
+    volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', name)
+    volumeNode.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(np.asarray(ijkToRAS, dtype=float)))
+    # Extent without allocated voxels
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(volumeArray.shape[::-1])
+    volumeNode.SetAndObserveImageData(imageData)
+    return volumeNode, self.cropVolumes(volumeArray, volumeNode, boxes)
+
+  def _mapNrrd(self, path):
+    """
+    :return: (memory-mapped KJI array, IJK to RAS rows, node name) of an NRRD file, None when it is not mapped
+    """
+    import temporal_bone_inference
+    import temporal_bone_mmap
+    if not path.lower().endswith(('.nrrd', '.nhdr')):
+      return None
+    try:
+      volumeArray, header = temporal_bone_mmap.openNrrd(path, self.volumeCache)
+      ijkToRAS = temporal_bone_inference.nrrdIJKToRAS(header)
+    except (temporal_bone_inference.AIAAException, KeyError, ValueError) as error:
+      logging.info('Loading %s with Slicer: %s' % (path, error))
+      return None
+    name = os.path.basename(path)
+    return volumeArray, ijkToRAS, name[:name.rfind('.')]
+
+  def resampleVolume(self, inputVolume, outputSpacing=(REFERENCE_SPACING_MM,)*3, outputVolume=None):
+    """
+    Resample the volume to isotropic spacing, in place or into outputVolume.
+    Linear interpolation is used when the slices are already as thin as the output spacing or thinner, bspline otherwise.
+    Resampled volumes are kept in self.resampleCache, keyed by the content and geometry of the input,
+    the output spacing, the interpolation and the engine, so that segmenting a volume again skips resampling.
+    """
+    import temporal_bone_cache
+    import temporal_bone_inference
+    import temporal_bone_resample
+    outputSpacing = tuple(outputSpacing)
+    spacing = inputVolume.GetSpacing()[2]
+    interpolationType = 'linear' if spacing <= outputSpacing[2] else 'bspline'
+    if outputVolume is None:
+      outputVolume = inputVolume
+    elif outputVolume is not inputVolume:
+      ijkToRAS = vtk.vtkMatrix4x4()
+      inputVolume.GetIJKToRASMatrix(ijkToRAS)
+      outputVolume.SetIJKToRASMatrix(ijkToRAS)
+
+    cache = self.resampleCache
+    if cache:
+      engineVersion = temporal_bone_resample.RESAMPLER_VERSION if self.resamplingEngine == "numpy" else slicer.app.revision
+      key = temporal_bone_cache.cacheKey(self.volumeDigest(inputVolume), outputSpacing, interpolationType,
+        self.resamplingEngine, engineVersion)
+      cachedFile = cache.get(key)
+      self.metrics.increment('resampleCacheHits' if cachedFile else 'resampleCacheMisses')
+      if cachedFile:
+        volumeArray, header = temporal_bone_inference.readNrrdArray(cachedFile)
+        slicer.util.updateVolumeFromArray(outputVolume, volumeArray)
+        outputVolume.SetSpacing(*outputSpacing)
+        return
+
+    if self.resamplingEngine == "numpy":
+      volumeArray = temporal_bone_resample.resampleArray(slicer.util.arrayFromVolume(inputVolume), inputVolume.GetSpacing(),
+        outputSpacing, interpolationType)
+      slicer.util.updateVolumeFromArray(outputVolume, volumeArray)
+      outputVolume.SetSpacing(*outputSpacing)
+    else:
+      parameters = {"outputPixelSpacing":",".join(str(s) for s in outputSpacing), "InputVolume":inputVolume,
+        "interpolationType":interpolationType,"OutputVolume":outputVolume}
+      slicer.cli.runSync(slicer.modules.resamplescalarvolume, None, parameters)
+
+    if cache:
+      ijkToRAS = vtk.vtkMatrix4x4()
+      outputVolume.GetIJKToRASMatrix(ijkToRAS)
+      ijkToRASRows = [[ijkToRAS.GetElement(row, column) for column in range(4)] for row in range(4)]
+      temporaryPath = os.path.join(slicer.app.temporaryPath, 'TemporalBoneResample-%s.nrrd' % key)
+      with open(temporaryPath, 'wb') as nrrdFile:
+        for chunk in temporal_bone_inference.iterNrrd(slicer.util.arrayFromVolume(outputVolume), ijkToRASRows):
+          nrrdFile.write(chunk)
+      cache.put(key, temporaryPath, move=True)
+
+  def volumeDigest(self, volumeNode):
+    """
+    Digest of the voxels and geometry of a volume, identifying it in the caches.
+    Kept until the volume or its image is modified.
+    """
+    import temporal_bone_cache
+    modified = (volumeNode.GetMTime(), volumeNode.GetImageData().GetMTime())
+    if volumeNode.GetID() in self._volumeDigests and self._volumeDigests[volumeNode.GetID()][0] == modified:
+      return self._volumeDigests[volumeNode.GetID()][1]
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    digest = temporal_bone_cache.volumeArrayDigest(slicer.util.arrayFromVolume(volumeNode), slicer.util.arrayFromVTKMatrix(ijkToRAS))
+    self._volumeDigests[volumeNode.GetID()] = (modified, digest)
+    return digest
+
+  def runInference(self, volumeByModel, onResult, serverUrl=AIAA_SERVER_URL, maxWorkers=None):
+    """
+    Request the AIAA segmentation models concurrently, or run them locally with self.inferenceClient.
+    Each distinct input volume is uploaded once as a server session, streamed as compressed
+    slabs straight from its voxel array, and every model request refers to it by session ID.
+    Masks are streamed to disk as they download. onResult is called on the calling thread as each mask arrives,
+    so post-processing of one structure overlaps the inference of the others.
+    Masks found in self.inferenceCache, keyed by volume content, model name and model version,
+    are delivered first without contacting the models.
+    :param volumeByModel: dict mapping AIAA model name to the volume node it segments
+    :param onResult: called as onResult(modelName, labelmapFile); the file must not be modified
+    :param serverUrl: AIAA server address, unused with a local inference client
+    :param maxWorkers: number of concurrent model requests, by default one per model
+      (or the maxConcurrentRequests of the inference client)
+    """
+    import concurrent.futures
+    import shutil
+    import tempfile
+    import temporal_bone_cache
+    import temporal_bone_inference
+
+    client = self.inferenceClient or self.serverClient(serverUrl)
+    bytesSent, bytesReceived = client.bytesSent, client.bytesReceived
+    tempDir = tempfile.mkdtemp(prefix='TemporalBoneAIAA-', dir=slicer.app.temporaryPath)
+
+    def segment(modelName, sessionId):
+      resultFile = os.path.join(tempDir, modelName + '.nrrd')
+      with self.metrics.stage('model:' + modelName):
+        client.segmentation(modelName, sessionId, resultFile, decode=False)
+      return modelName, resultFile
+
+    # Serve cached masks, the remaining models go to the server
+    cache = self.inferenceCache
+    cacheKeys = {}
+    if cache:
+      versions = self.modelVersions(client)
+      digests = {}
+      for modelName, volumeNode in list(volumeByModel.items()):
+        if volumeNode.GetID() not in digests:
+          digests[volumeNode.GetID()] = self.volumeDigest(volumeNode)
+        cacheKeys[modelName] = temporal_bone_cache.cacheKey(digests[volumeNode.GetID()], modelName, versions.get(modelName, ''))
+        cachedFile = cache.get(cacheKeys[modelName])
+        self.metrics.increment('inferenceCacheHits' if cachedFile else 'inferenceCacheMisses')
+        if cachedFile:
+          onResult(modelName, cachedFile)
+          volumeByModel = {name: volume for name, volume in volumeByModel.items() if name != modelName}
+    if not volumeByModel:
+      shutil.rmtree(tempDir, ignore_errors=True)
+      if cache:
+        logging.info('Inference cache: %s' % cache.statistics())
+      return
 
-    logging.info('Processing started')
+    sessionIds = {}
+    try:
+      # Upload each distinct volume only once
+      for volumeNode in volumeByModel.values():
+        if volumeNode.GetID() in sessionIds:
+          continue
+        ijkToRAS = vtk.vtkMatrix4x4()
+        volumeNode.GetIJKToRASMatrix(ijkToRAS)
+        ijkToRASRows = [[ijkToRAS.GetElement(row, column) for column in range(4)] for row in range(4)]
+        with self.metrics.stage('upload'):
+          sessionIds[volumeNode.GetID()] = client.createSession(slicer.util.arrayFromVolume(volumeNode), ijkToRASRows)
+
+      with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers or
+          getattr(client, 'maxConcurrentRequests', None) or len(volumeByModel)) as executor:
+        futures = [executor.submit(segment, modelName, sessionIds[volumeNode.GetID()])
+          for modelName, volumeNode in volumeByModel.items()]
+        for future in concurrent.futures.as_completed(futures):
+          modelName, resultFile = future.result()
+          if cache:
+            resultFile = cache.put(cacheKeys[modelName], resultFile, move=True)
+          onResult(modelName, resultFile)
+    finally:
+      for sessionId in sessionIds.values():
+        client.closeSession(sessionId)
+      shutil.rmtree(tempDir, ignore_errors=True)
+    bytesSent, bytesReceived = client.bytesSent - bytesSent, client.bytesReceived - bytesReceived
+    logging.info('Inference transfer: %.1f MB sent, %.1f MB received' % (bytesSent / 1e6, bytesReceived / 1e6))
+    self.metrics.increment('inferenceBytesSent', bytesSent)
+    self.metrics.increment('inferenceBytesReceived', bytesReceived)
+    if cache:
+      logging.info('Inference cache: %s' % cache.statistics())
+
+  def importModelResult(self, segmentationNode, modelName, labelmapFile):
+    """
+    Import a downloaded model mask as a segment named after the model.
+    :return: ID of the new segment
+    """
+    labelmapNode = slicer.util.loadLabelVolume(labelmapFile)
+    labelmapNode.SetName(modelName)
+    slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapNode, segmentationNode)
+    slicer.mrmlScene.RemoveNode(labelmapNode)
+    return segmentationNode.GetSegmentation().GetSegmentIdBySegmentName(modelName)
 
-    # Perform the temporal bone autosegmentation
-    InputVolume: inputVolume.GetID()
-    spacing = inputVolume.GetSpacing()[2]
-    # resample
-    if spacing<= 0.25:
-        parameters = {"outputPixelSpacing":"0.25,0.25,0.25", "InputVolume":inputVolume,"interpolationType":'linear',"OutputVolume":inputVolume}
-        slicer.cli.runSync(slicer.modules.resamplescalarvolume, None, parameters)
+  def postprocessModelResult(self, modelName, modelMask, masterVolume, editor=None):
+    """
+    Post-process a model mask through the stages of self.postprocessingStages (see temporal_bone_pipeline).
+    Stages whose inputs and parameters did not change are read back from self.pipelineCache.
+    :param modelMask: boolean array of the model output, in the geometry of masterVolume
+    :param masterVolume: volume node segmented by the model
+    :param editor: (segment editor widget, segment editor node, segmentation node) to run the stages with
+      Segment Editor effects (see effectOperations), None to run them with temporal_bone_postprocessing
+    :return: (structure name, mask array in the geometry of masterVolume, key of the mask)
+    """
+    import temporal_bone_cache
+    import temporal_bone_pipeline
+    import temporal_bone_postprocessing
+    if editor:
+      operations, engine, master = self.effectOperations(*editor), "effects", masterVolume
     else:
-        parameters = {"outputPixelSpacing":"0.25,0.25,0.25", "InputVolume":inputVolume,"interpolationType":'bspline',"OutputVolume":inputVolume}
-        slicer.cli.runSync(slicer.modules.resamplescalarvolume, None, parameters)
-    print('\nResampling...\n')
-    spacing = inputVolume.GetSpacing()[2]
-    volumeName = inputVolume.GetName()
-    # Create segmentation
-    segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
-    segmentationNode.CreateDefaultDisplayNodes() # only needed for display
-    segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(inputVolume)
-    otic_capsule_segment = segmentationNode.GetSegmentation().AddEmptySegment("otic_capsule")
-    # Create segment editor to get access to effects
-    segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
-    segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
-    segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
-    segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
+      operations, engine = temporal_bone_postprocessing.POSTPROCESSING_OPERATIONS, "numpy"
+      master = (slicer.util.arrayFromVolume(masterVolume), masterVolume.GetSpacing())
+    stages = self.postprocessingStages
+    if engine == "numpy":
+      # Masks are post-processed at the working spacing of the model; the effects work in the geometry of the
+      # segmentation node, at the reference spacing
+      stages = temporal_bone_postprocessing.stagesAtSpacing(stages, {modelName: masterVolume.GetSpacing()[0]}, REFERENCE_SPACING_MM)
+    pipeline = temporal_bone_pipeline.Pipeline(stages, operations, self.pipelineCache, engine)
+    structureName = temporal_bone_postprocessing.POSTPROCESSING_TARGETS[modelName]
+    sources = {"model:" + modelName: modelMask, "master:" + modelName: master}
+    sourceKeys = {"model:" + modelName: temporal_bone_cache.arrayDigest(modelMask),
+      "master:" + modelName: self.volumeDigest(masterVolume)}
+    results, keys = pipeline.evaluate([structureName], sources, sourceKeys, self.metrics)
+    logging.info('%s: %d stages run, %d read from the cache' % (structureName, len(pipeline.computed), len(pipeline.reused)))
+    return structureName, results[structureName], keys[structureName]
+
+  def applyEffect(self, effect):
+    """
+    Apply the active Segment Editor effect, measured as stage "effect:<effect name>".
+    """
+    with self.metrics.stage('effect:' + effect.name):
+      effect.self().onApply()
+
+  def createSegmentEditor(self, segmentationNode, masterVolume):
+    """
+    Create a segment editor widget, to get access to the effects, editing segmentationNode.
+    With self.keepSegmentEditor, the widget and node of the previous run are reused while their
+    node is still in the scene.
+    :return: the widget and its segment editor node
+    """
+    if self.keepSegmentEditor and self._segmentEditor and self._segmentEditor[1].GetScene() == slicer.mrmlScene:
+      segmentEditorWidget, segmentEditorNode = self._segmentEditor
+    else:
+      segmentEditorWidget = slicer.qMRMLSegmentEditorWidget()
+      segmentEditorWidget.setMRMLScene(slicer.mrmlScene)
+      # Undo states would keep a copy of the segmentation for every effect
+      segmentEditorWidget.setMaximumNumberOfUndoStates(0)
+      segmentEditorNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
+      segmentEditorWidget.setMRMLSegmentEditorNode(segmentEditorNode)
+      if self.keepSegmentEditor:
+        self._segmentEditor = (segmentEditorWidget, segmentEditorNode)
     segmentEditorWidget.setSegmentationNode(segmentationNode)
-    segmentEditorWidget.setMasterVolumeNode(inputVolume)
-
-    segmentationNode1 = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
-    segmentationNode1.CreateDefaultDisplayNodes() # only needed for display
-    segmentationNode1.SetReferenceImageGeometryParameterFromVolumeNode(inputVolume)
-    # Create segment editor to get access to effects
-    segmentEditorWidget1 = slicer.qMRMLSegmentEditorWidget()
-    segmentEditorWidget1.setMRMLScene(slicer.mrmlScene)
-    segmentEditorNode1 = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentEditorNode")
-    segmentEditorWidget1.setMRMLSegmentEditorNode(segmentEditorNode1)
-    segmentEditorWidget1.setSegmentationNode(segmentationNode1)
-    segmentEditorWidget1.setMasterVolumeNode(inputVolume)
-
-    ## Autosegmentation of the otic capsule
-    # NVIDIA auto segmentation
-    segmentEditorWidget.setActiveEffectByName("Nvidia AIAA")
-    effect = segmentEditorWidget.activeEffect()
-    serverUrl = "http://tbone.onthewifi.com:956/v1/models"
-    effect.self().ui.serverComboBox.currentText = serverUrl
-    effect.self().onClickFetchModels()
-    effect.self().ui.segmentationModelSelector.currentText = "inner_ear"
-    effect.self().onClickSegmentation()
-    inner_ear = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName("inner_ear")
-    segmentEditorWidget.setCurrentSegmentID(inner_ear)
-    segmentationNode.GetSegmentation().GetSegment(inner_ear).SetColor(1,0,0)
-    segmentationNode.GetSegmentation().GetSegment(otic_capsule_segment).SetColor(0.89,0.92,0.65)
-    segmentEditorNode.SetMasterVolumeIntensityMaskRange(-300, 550)
-    #Turn mask range on
-    segmentEditorNode.MasterVolumeIntensityMaskOn()
-    #growing the membranous labyrinth
-    # Margin effect
-    segmentEditorWidget.setActiveEffectByName("Margin")
-    effect = segmentEditorWidget.activeEffect()
-    effect.setParameter("MarginSizeMm", 0.3)
-    effect.self().onApply()
-    segmentEditorWidget.setCurrentSegmentID('otic_capsule')
-    #Copying the inner ear segment to otic capsule
-    # Logical effect
-    segmentEditorWidget.setActiveEffectByName("Logical operators")
-    effect = segmentEditorWidget.activeEffect()
-    effect.setParameter("Operation", 'COPY')
-    effect.setParameter("ModifierSegmentID", inner_ear)
-    effect.setParameter("BypassMasking", 1)
-    effect.self().onApply()
-    # Define the Mask range for bony labyrinth
-    segmentEditorNode.SetMasterVolumeIntensityMaskRange(650, 2500)
-    #Turn mask range on
-    segmentEditorNode.MasterVolumeIntensityMaskOn()
-    #segmenting the otic capsule from the inner ear 
-    # Margin effect
-    segmentEditorWidget.setActiveEffectByName("Margin")
-    effect = segmentEditorWidget.activeEffect()
-    effect.setParameter("MarginSizeMm", spacing*5)
-    effect.self().onApply()
-    segmentEditorNode.MasterVolumeIntensityMaskOff()
-    # Islands effect
-    segmentEditorWidget.setActiveEffectByName("Islands")
-    effect = segmentEditorWidget.activeEffect()
-    effect.setParameter("Operation", 'KEEP_LARGEST_ISLAND')	
-    effect.self().onApply()
-    #Make the inner ear not visible to export only the otic capsule
-    #segmentationNode.GetDisplayNode().SetSegmentVisibility(inner_ear, False)
-	#copy the inner ear segment to another segmentation Node
-    #segmentationNode1.GetSegmentation().CopySegmentFromSegmentation(segmentationNode.GetSegmentation(),inner_ear)
-    # Remove the inner ear to export only the otic capsule
-    segmentationNode.GetSegmentation().RemoveSegment(inner_ear)
-    
-    if exportlabelmaps==True:
-      #Create labelmap for otic capsule and export the segment
-      oticcapsule_labelmap = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
-      oticcapsule_labelmap.SetName('oticcapsule_labelmap')
-      slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(segmentationNode, oticcapsule_labelmap, inputVolume)
-      slicer.util.saveNode(oticcapsule_labelmap, directory+'/oticcapsule_labelmap.nrrd')
+    segmentEditorWidget.setMasterVolumeNode(masterVolume)
+    return segmentEditorWidget, segmentEditorNode
 
-    if exportOBJ==True:
-      shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-      segnumber = shNode.GetItemByDataNode(segmentationNode)
-      shNode.SetItemName(segnumber, volumeName+'_otic capsule')
-      segmentIDs = vtk.vtkStringArray()
-      segmentationNode.GetSegmentation().GetSegmentIDs(segmentIDs)
-      slicer.modules.segmentations.logic().ExportSegmentsClosedSurfaceRepresentationToFiles(directory,
-        segmentationNode, segmentIDs, "OBJ", True,  1.0, False)
+  def releaseSegmentEditor(self, segmentEditorWidget, segmentEditorNode):
+    """
+    Remove a segment editor node created by createSegmentEditor, or only detach it from its
+    segmentation and volume when it is kept for the next run.
+    """
+    if self._segmentEditor and self._segmentEditor[1] is segmentEditorNode:
+      segmentEditorWidget.setSegmentationNode(None)
+      segmentEditorWidget.setMasterVolumeNode(None)
+    else:
+      slicer.mrmlScene.RemoveNode(segmentEditorNode)
 
-	#copy the otic capsule segment to another segmentation Node
-    segmentationNode1.GetSegmentation().CopySegmentFromSegmentation(segmentationNode.GetSegmentation(),otic_capsule_segment)
-	
-    # Remove the otic capsule after exporting
-    segmentationNode.GetSegmentation().RemoveSegment('otic_capsule')
-
-    # Autosegmentation of the ossicles
-    segmentEditorWidget.setActiveEffectByName("Nvidia AIAA")
-    effect = segmentEditorWidget.activeEffect()
-    effect.self().ui.segmentationModelSelector.currentText = 'ossicles'
-    effect.self().onClickSegmentation()
-    ossicles = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName("ossicles")
-    segmentationNode.GetSegmentation().GetSegment(ossicles).SetColor(1,1,0.88)
-    segmentEditorWidget.setCurrentSegmentID(ossicles)
-    # Islands effect
-    segmentEditorWidget.setActiveEffectByName("Islands")
-    effect = segmentEditorWidget.activeEffect()
-    effect.setParameter("Operation", 'REMOVE_SMALL_ISLANDS')
-    effect.setParameter("MinimumSize", 50)
-    effect.self().onApply()
-    
+  def serverClient(self, serverUrl):
+    """
+    Client of an AIAA server, kept with its pool of keep-alive connections for the next runs.
+    """
+    import temporal_bone_inference
+    if serverUrl not in self._serverClients:
+      self._serverClients[serverUrl] = temporal_bone_inference.AIAAStreamingClient(serverUrl)
+    return self._serverClients[serverUrl]
+
+  def modelVersions(self, client):
+    """
+    Version of each model of an inference client, from its model list. The list of a server is
+    kept for self.modelListMaxAgeSeconds, so that a long-lived logic does not request it every run.
+    :return: dict mapping model name to version
+    """
+    serverKey = (type(client).__name__, getattr(client, 'netloc', None) or id(client))
+    cached = self._modelVersions.get(serverKey)
+    if cached and time.time() - cached[0] < self.modelListMaxAgeSeconds:
+      return cached[1]
+    versions = {model.get('name'): model.get('version', '') for model in client.modelList()}
+    self._modelVersions[serverKey] = (time.time(), versions)
+    return versions
+
+  def effectOperations(self, segmentEditorWidget, segmentEditorNode, segmentationNode):
+    """
+    Operations of the post-processing stages (see temporal_bone_postprocessing.POSTPROCESSING_OPERATIONS)
+    applied with Segment Editor effects. The master of a stage is the volume node segmented by the
+    model, and masks are arrays in its geometry. Each operation imports its mask as a temporary
+    segment of segmentationNode, applies the effect and removes the segment.
+    :return: dict mapping operation name to function
+    """
+    def applyEffect(mask, master, maskRange, effectName, parameters):
+      segmentID = segmentationNode.GetSegmentation().AddEmptySegment()
+      slicer.util.updateSegmentBinaryLabelmapFromArray(mask.astype('uint8'), segmentationNode, segmentID, master)
+      segmentEditorWidget.setMasterVolumeNode(master)
+      segmentEditorWidget.setCurrentSegmentID(segmentID)
+      if maskRange is None:
+        segmentEditorNode.MasterVolumeIntensityMaskOff()
+      else:
+        segmentEditorNode.SetMasterVolumeIntensityMaskRange(*maskRange)
+        segmentEditorNode.MasterVolumeIntensityMaskOn()
+      segmentEditorWidget.setActiveEffectByName(effectName)
+      effect = segmentEditorWidget.activeEffect()
+      for name, value in parameters.items():
+        effect.setParameter(name, value)
+      self.applyEffect(effect)
+      segmentEditorNode.MasterVolumeIntensityMaskOff()
+      result = slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, segmentID, master) > 0
+      segmentationNode.GetSegmentation().RemoveSegment(segmentID)
+      return result
+
+    def grow(mask, master, marginSizeMm=None, marginSlices=None, maskRange=None):
+      # Slices of the segmentation geometry, the reference spacing whatever the working spacing of the model
+      if marginSizeMm is None:
+        marginSizeMm = marginSlices * REFERENCE_SPACING_MM
+      return applyEffect(mask, master, maskRange, "Margin", {"MarginSizeMm": marginSizeMm})
+
+    def keepLargestIsland(mask, master, minimumSize=1000, maskRange=None):
+      return applyEffect(mask, master, maskRange, "Islands", {"Operation": "KEEP_LARGEST_ISLAND", "MinimumSize": minimumSize})
+
+    def removeSmallIslands(mask, master, minimumSize=1000, maskRange=None):
+      return applyEffect(mask, master, maskRange, "Islands", {"Operation": "REMOVE_SMALL_ISLANDS", "MinimumSize": minimumSize})
+
+    def smoothMedian(mask, master, kernelSizeMm, maskRange=None):
+      return applyEffect(mask, master, maskRange, "Smoothing", {"SmoothingMethod": "MEDIAN", "KernelSizeMm": kernelSizeMm})
+
+    return {
+      "grow": grow,
+      "keepLargestIsland": keepLargestIsland,
+      "removeSmallIslands": removeSmallIslands,
+      "smoothMedian": smoothMedian,
+      "copy": lambda mask, master: mask.astype(bool),
+    }
+
+  def exportStructure(self, segmentationNode, referenceVolume, directory, labelmapName, objName, exportlabelmaps=True, exportOBJ=True):
+    """
+    Export the visible segments of the segmentation as a labelmap and as OBJ files.
+    :param labelmapName: name of the labelmap node and of its .nrrd file
+    :param objName: name of the segmentation subject hierarchy item, used for naming the OBJ files
+    """
     if exportlabelmaps==True:
-      #Create labelmap for ossicles and export the segment
-      ossicles_labelmap = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
-      ossicles_labelmap.SetName('ossicles_labelmap')
-      slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(segmentationNode, ossicles_labelmap, inputVolume)
-      slicer.util.saveNode(ossicles_labelmap, directory+'/ossicles_labelmap.nrrd')
+      labelmapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+      labelmapNode.SetName(labelmapName)
+      slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(segmentationNode, labelmapNode, referenceVolume)
+      slicer.util.saveNode(labelmapNode, directory+'/'+labelmapName+'.nrrd')
 
     if exportOBJ==True:
       shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
       segnumber = shNode.GetItemByDataNode(segmentationNode)
-      shNode.SetItemName(segnumber, volumeName+'_ossicles')
+      shNode.SetItemName(segnumber, objName)
       segmentIDs = vtk.vtkStringArray()
       segmentationNode.GetSegmentation().GetSegmentIDs(segmentIDs)
       slicer.modules.segmentations.logic().ExportSegmentsClosedSurfaceRepresentationToFiles(directory,
         segmentationNode, segmentIDs, "OBJ", True,  1.0, False)
 
-	#copy the ossicles segment to another segmentation Node
-    segmentationNode1.GetSegmentation().CopySegmentFromSegmentation(segmentationNode.GetSegmentation(),ossicles)
-	
-    # Remove the ossicles after exporting
-    segmentationNode.GetSegmentation().RemoveSegment(ossicles)
-
-    # Autosegmentation of Cochlear duct
-    segmentEditorWidget.setActiveEffectByName("Nvidia AIAA")
-    effect = segmentEditorWidget.activeEffect()
-    effect.self().ui.segmentationModelSelector.currentText = "cochlear_duct"
-    effect.self().onClickSegmentation()
-    cochlear_duct = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName("cochlear_duct")
-    segmentEditorWidget.setCurrentSegmentID(cochlear_duct)
-    segmentationNode.GetSegmentation().GetSegment(cochlear_duct).SetColor(1,0,0)
-    segmentEditorNode.SetMasterVolumeIntensityMaskRange(-410, 750)
-    #Turn mask range on
-    segmentEditorNode.MasterVolumeIntensityMaskOn()
-    #growing the membranous labyrinth
-    # Margin effect
-    segmentEditorWidget.setActiveEffectByName("Margin")
-    effect = segmentEditorWidget.activeEffect()
-    effect.setParameter("MarginSizeMm", 0.3)
-    effect.self().onApply()
-    
-    if exportlabelmaps==True:
-      #Create labelmap for cochlear duct and export the segment
-      cochlear_duct_labelmap = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
-      cochlear_duct_labelmap.SetName('cochlear_duct_labelmap')
-      slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(segmentationNode, cochlear_duct_labelmap, inputVolume)
-      slicer.util.saveNode(cochlear_duct_labelmap, directory+'/cochlear_duct_labelmap.nrrd')
+  def cropTemporalBones(self, inputVolume):
+    """
+    Crop the volume around each temporal bone, without resampling.
+    :return: list of (side name, cropped volume node). Empty when cropping would not make the volume smaller.
+    """
+    import temporal_bone_roi
+    volumeArray = slicer.util.arrayFromVolume(inputVolume)
+    return self.cropVolumes(volumeArray, inputVolume, temporal_bone_roi.findTemporalBoneBoxes(volumeArray, inputVolume.GetSpacing()))
 
-    if exportOBJ==True:
-      shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-      segnumber = shNode.GetItemByDataNode(segmentationNode)
-      shNode.SetItemName(segnumber, volumeName+'_cochlear_duct')
-      segmentIDs = vtk.vtkStringArray()
-      segmentationNode.GetSegmentation().GetSegmentIDs(segmentIDs)
-      slicer.modules.segmentations.logic().ExportSegmentsClosedSurfaceRepresentationToFiles(directory,
-        segmentationNode, segmentIDs, "OBJ", True,  1.0, False)  
-	
-	#copy the cochlear_duct segment to another segmentation Node
-    segmentationNode1.GetSegmentation().CopySegmentFromSegmentation(segmentationNode.GetSegmentation(),cochlear_duct)
-	
-    # Remove the cochlear_duct after exporting
-    segmentationNode.GetSegmentation().RemoveSegment(cochlear_duct)
-
-    if medianFilter==True:
-      volumesLogic = slicer.modules.volumes.logic()
-      median = volumesLogic.CloneVolume(slicer.mrmlScene, inputVolume, 'Volume_median_filter')
-    
-      parameters = {"neighborhood":"1,1,1", "inputVolume":inputVolume,"outputVolume":median}
-      slicer.cli.runSync(slicer.modules.medianimagefilter, None, parameters)
-    
-      segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(median)
-      segmentEditorWidget.setMasterVolumeNode(median)
-
-    # Autosegmentation of Facial Nerve
-    segmentEditorWidget.setActiveEffectByName("Nvidia AIAA")
-    effect = segmentEditorWidget.activeEffect()
-    effect.self().ui.segmentationModelSelector.currentText = 'facial_nerve'
-    effect.self().onClickSegmentation()
-    facial_nerve = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName("facial_nerve")
-    segmentationNode.GetSegmentation().GetSegment(facial_nerve).SetColor(0.9,1,0)
-    
-    if exportlabelmaps==True:
-      #Create labelmap for facial nerve and export the segment
-      facial_labelmap = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
-      slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(segmentationNode, facial_labelmap, inputVolume)
-      facial_labelmap.SetName('facial_labelmap')
-      slicer.util.saveNode(facial_labelmap, directory+'/facial_labelmap.nrrd')
+  def cropVolumes(self, volumeArray, inputVolume, boxes):
+    """
+    Volume nodes of boxes of the voxels of inputVolume, each holding a copy of its box only.
+    :param volumeArray: KJI voxels of inputVolume, such as a memory-mapped array
+    :param boxes: KJI slice tuples, see temporal_bone_roi.findTemporalBoneBoxes
+    :return: list of (side name, cropped volume node), from left to right
+    """
+    ijkToRAS = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRAS)
+
+    crops = []
+    for box in boxes:
+      cropVolume = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode')
+      cropVolume.SetIJKToRASMatrix(self.boxIJKToRAS(inputVolume, box))
+      slicer.util.updateVolumeFromArray(cropVolume, volumeArray[box].copy())
+      cropVolume.CreateDefaultDisplayNodes()
+      # Center of the box along R decides the side
+      center = [(s.start + s.stop) / 2.0 for s in box[::-1]] + [1]
+      crops.append((ijkToRAS.MultiplyPoint(center)[0], cropVolume))
+
+    crops.sort(key=lambda crop: crop[0])
+    sides = ['left', 'right'] if len(crops) == 2 else ['left' if r < 0 else 'right' for r, _ in crops]
+    for side, (_, cropVolume) in zip(sides, crops):
+      cropVolume.SetName(inputVolume.GetName() + '_' + side)
+    return [(side, cropVolume) for side, (_, cropVolume) in zip(sides, crops)]
+
+  def boxIJKToRAS(self, volumeNode, box):
+    """
+    IJK to RAS matrix of a box (KJI slice tuple) of the volume: the axes of the volume, with the origin
+    shifted to the first voxel of the box.
+    """
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    origin = ijkToRAS.MultiplyPoint([box[2].start, box[1].start, box[0].start, 1])
+    for row in range(3):
+      ijkToRAS.SetElement(row, 3, origin[row])
+    return ijkToRAS
+
+  def exportStructureLabelmaps(self, segmentationNodes, referenceVolume, directory, exportMode="separate"):
+    """
+    Export the structures of one or more segmentation nodes, such as the two sides of a cropped
+    volume, into labelmaps with the geometry of referenceVolume and save them in directory.
+    :param exportMode: "separate" saves one labelmap file per structure. "combined" saves a single
+      bit-packed structures_labelmap.nrrd where value 2**i marks the structure of the i-th model
+      of AIAA_MODEL_EXPORTS, so that overlapping structures are kept.
+    """
+    import numpy as np
+    exportLabelmap = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+    labelmapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+    packedArray = None
+    for bit, (modelName, (labelmapName, objName)) in enumerate(AIAA_MODEL_EXPORTS.items()):
+      segmentName = "otic_capsule" if modelName == "inner_ear" else modelName
+      structureArray = None
+      for segmentationNode in segmentationNodes:
+        segmentIDs = vtk.vtkStringArray()
+        segmentIDs.InsertNextValue(segmentationNode.GetSegmentation().GetSegmentIdBySegmentName(segmentName))
+        slicer.modules.segmentations.logic().ExportSegmentsToLabelmapNode(segmentationNode, segmentIDs, exportLabelmap, referenceVolume)
+        mask = slicer.util.arrayFromVolume(exportLabelmap) > 0
+        structureArray = mask if structureArray is None else structureArray | mask
+      labelmapNode.CopyOrientation(exportLabelmap)
+      if exportMode == "combined":
+        if packedArray is None:
+          packedArray = np.zeros(structureArray.shape, dtype=np.uint8)
+        packedArray |= structureArray.astype(np.uint8) << bit
+      else:
+        labelmapNode.SetName(labelmapName)
+        slicer.util.updateVolumeFromArray(labelmapNode, structureArray.astype(np.uint8))
+        slicer.util.saveNode(labelmapNode, directory+'/'+labelmapName+'.nrrd')
+    if exportMode == "combined":
+      labelmapNode.SetName('structures_labelmap')
+      slicer.util.updateVolumeFromArray(labelmapNode, packedArray)
+      slicer.util.saveNode(labelmapNode, directory+'/structures_labelmap.nrrd')
+    slicer.mrmlScene.RemoveNode(exportLabelmap)
+    slicer.mrmlScene.RemoveNode(labelmapNode)
+
+  def exportStructureMeshes(self, store, volumeNode, directory, baseName, names=None):
+    """
+    Mesh the structures of a temporal_bone_segmentation_store.SegmentationStore in parallel and write them
+    to directory in self.meshFormat, as <baseName>_<structure>[_lod<level>].<format>.
+    :param names: structures to mesh, all by default
+    :return: list of the written files, see temporal_bone_mesh.exportStructureMeshes
+    """
+    import temporal_bone_mesh
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    ijkToRASRows = [[ijkToRAS.GetElement(row, column) for column in range(4)] for row in range(4)]
+    structures = {name: (store.croppedMask(name), [s.start for s in store.box(name)]) for name in (store.names if names is None else names)}
+    records = temporal_bone_mesh.exportStructureMeshes(structures, ijkToRASRows, directory, baseName, self.meshFormat,
+      self.meshSmoothingFactor, self.meshLevels)
+    logging.info('Meshes (%s): %s' % (self.meshFormat, ', '.join('%s level %d %d triangles %.1f MB %.2f s' % (
+      record['structure'], record['level'], record['triangles'], record['bytes'] / 1e6, record['seconds']) for record in records)))
+    return records
+
+  def structureStatistics(self, store, volumeNode):
+    """
+    Statistics of the structures of a temporal_bone_segmentation_store.SegmentationStore segmented in volumeNode.
+    :return: list of rows of temporal_bone_statistics.STATISTICS_COLUMNS, one per structure
+    """
+    import temporal_bone_statistics
+    volumeArray = slicer.util.arrayFromVolume(volumeNode)
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    ijkToRASRows = [[ijkToRAS.GetElement(row, column) for column in range(4)] for row in range(4)]
+    rows = []
+    for name in store.names:
+      box = store.box(name)
+      row = temporal_bone_statistics.structureStatistics(store.croppedMask(name), volumeNode.GetSpacing(), ijkToRASRows,
+        volumeArray[box], offset=[s.start for s in box])
+      row.update(volume=volumeNode.GetName(), structure=name)
+      rows.append(row)
+    return rows
+
+  def segmentationNodeFromStore(self, store, referenceVolume):
+    """
+    Segmentation node of the structures of a temporal_bone_segmentation_store.SegmentationStore, in the
+    geometry of referenceVolume. Structures that do not overlap are imported from one multi-label
+    labelmap, so that they share a single labelmap in the segmentation.
+    """
+    segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+    segmentationNode.CreateDefaultDisplayNodes() # only needed for display
+    segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(referenceVolume)
+    segmentation = segmentationNode.GetSegmentation()
+    ijkToRAS = vtk.vtkMatrix4x4()
+    referenceVolume.GetIJKToRASMatrix(ijkToRAS)
+    labelmapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
+    labelmapNode.SetIJKToRASMatrix(ijkToRAS)
+    for layer in store.layers():
+      # Empty structures would get no segment from the import
+      names = [name for name in layer if store.box(name)[0].stop > store.box(name)[0].start]
+      if names:
+        slicer.util.updateVolumeFromArray(labelmapNode, store.layerArray(names))
+        firstSegment = segmentation.GetNumberOfSegments()
+        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapNode, segmentationNode)
+        # Segments are imported in the order of their label values
+        for index, name in enumerate(names):
+          segmentation.GetNthSegment(firstSegment + index).SetName(name)
+      for name in layer:
+        if name not in names:
+          segmentation.AddEmptySegment(name)
+    slicer.mrmlScene.RemoveNode(labelmapNode)
+    for name, color in store.colors.items():
+      segmentation.GetSegment(segmentation.GetSegmentIdBySegmentName(name)).SetColor(*color)
+    return segmentationNode
+
+  def loadExportedStructures(self, directory, name):
+    """
+    Load the structure labelmaps exported to directory by a run (exportMode "separate") into a new
+    segmentation node, for example to show the result of a run done in another process.
+    :return: the segmentation node, None if no labelmap was found
+    """
+    segmentationNode = None
+    for modelName, (labelmapName, objName) in AIAA_MODEL_EXPORTS.items():
+      labelmapFile = os.path.join(directory, labelmapName + '.nrrd')
+      if not os.path.exists(labelmapFile):
+        continue
+      if segmentationNode is None:
+        segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", name)
+        segmentationNode.CreateDefaultDisplayNodes()
+      segmentID = self.importModelResult(segmentationNode, "otic_capsule" if modelName == "inner_ear" else modelName, labelmapFile)
+      if segmentID and modelName in AIAA_MODEL_COLORS:
+        segmentationNode.GetSegmentation().GetSegment(segmentID).SetColor(*AIAA_MODEL_COLORS[modelName])
+    return segmentationNode
+
+  def saveArrayAsLabelmap(self, labelmapArray, referenceVolume, path):
+    """
+    Save a KJI array as a labelmap file with the geometry of referenceVolume.
+    """
+    ijkToRAS = vtk.vtkMatrix4x4()
+    referenceVolume.GetIJKToRASMatrix(ijkToRAS)
+    labelmapNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode', os.path.splitext(os.path.basename(path))[0])
+    labelmapNode.SetIJKToRASMatrix(ijkToRAS)
+    slicer.util.updateVolumeFromArray(labelmapNode, labelmapArray)
+    slicer.util.saveNode(labelmapNode, path)
+    slicer.mrmlScene.RemoveNode(labelmapNode)
+
+  def exportStructureModels(self, segmentationNode, directory, objName):
+    """
+    Export all structures of the segmentation as a single multi-object OBJ file named objName.
+    """
+    segmentationNode.SetName(objName)
+    segmentIDs = vtk.vtkStringArray()
+    segmentationNode.GetSegmentation().GetSegmentIDs(segmentIDs)
+    slicer.modules.segmentations.logic().ExportSegmentsClosedSurfaceRepresentationToFiles(directory,
+      segmentationNode, segmentIDs, "OBJ", True,  1.0, True)
+
+  @staticmethod
+  def fileStats(directory):
+    """
+    (size, modification time) of each file in directory, to measure what an export step wrote.
+    """
+    stats = {}
+    for entry in os.scandir(directory):
+      if entry.is_file():
+        stat = entry.stat()
+        stats[entry.path] = (stat.st_size, stat.st_mtime_ns)
+    return stats
+
+  def run(self, inputVolume, directory, exportlabelmaps=True, exportOBJ=True, medianFilter=True, exportDICOM=True, showResult=True,
+      postprocessingEngine="effects", cropToROI=False, exportMode="separate", crops=None):
+    """
+    Run the processing algorithm.
+    Can be used without GUI widget.
+    :param inputVolume: volume to be segmented
+    :param exportOBJ: export to OBJ files
+    :param exportlabelmaps: export to labelmaps
+    :param medianFilter: Whether the medial filter is used for improving the segmentation
+    :param exportDICOM: Whether the isotropic volume is exported as a DICOM series
+    :param showResult: show the segmentation in the 3D view
+    :param postprocessingEngine: "effects" to post-process with Segment Editor effects,
+      "numpy" to use the headless engine of temporal_bone_postprocessing. Both run the stages of
+      self.postprocessingStages, reusing the results of self.pipelineCache that did not change, and
+      structures exported by a previous run to the same directory are only exported again if they changed.
+    :param cropToROI: crop each temporal bone before resampling and segment only the crops.
+      The outputs of each side are written to the left and right subdirectories, and the
+      labelmaps of both sides are merged in the geometry of the input volume. The whole volume is
+      segmented when only one temporal bone is found.
+    :param crops: crops of both temporal bones already made, as loadTemporalBoneCrops returns them, segmented
+      as with cropToROI; inputVolume then only gives the geometry the labelmaps of both sides are merged in.
+    :param exportMode: "separate" writes a labelmap and OBJ files per structure as each one is
+      post-processed. "combined" writes all structures at the end, as one bit-packed labelmap
+      (see exportStructureLabelmaps) and one multi-object OBJ file.
+    :return: per-stage metrics of the run (see temporal_bone_metrics.RunMetrics.asDict), also kept in self.metrics
+    Progress is reported to self.progressCallback as each stage starts, and the run stops with
+    RunCancelled at the next stage once self.cancelEvent is set.
+    """
 
-    if exportOBJ==True:
-      shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-      segnumber = shNode.GetItemByDataNode(segmentationNode)
-      shNode.SetItemName(segnumber, volumeName+'_facial_nerve')
-      segmentIDs = vtk.vtkStringArray()
-      segmentationNode.GetSegmentation().GetSegmentIDs(segmentIDs)
-      slicer.modules.segmentations.logic().ExportSegmentsClosedSurfaceRepresentationToFiles(directory,
-        segmentationNode, segmentIDs, "OBJ", True,  1.0, False)
+    if not inputVolume:
+      raise ValueError("Input volume is invalid")
 
-	#copy the facial nerve segment to another segmentation Node
-    segmentationNode1.GetSegmentation().CopySegmentFromSegmentation(segmentationNode.GetSegmentation(),facial_nerve)
-	
-    # Remove the facial_nerve after exporting
-    segmentationNode.GetSegmentation().RemoveSegment(facial_nerve)
-
-
-    # Autosegmentation of Sigmoid sinus
-    segmentEditorWidget.setActiveEffectByName("Nvidia AIAA")
-    effect = segmentEditorWidget.activeEffect()
-    effect.self().ui.segmentationModelSelector.currentText = 'sigmoid_sinus'
-    effect.self().onClickSegmentation()
-    sigmoid = segmentationNode.GetSegmentation().GetSegmentIdBySegmentName("sigmoid_sinus")
-    segmentEditorWidget.setCurrentSegmentID(sigmoid)
-    # Islands effect
-    segmentEditorWidget.setActiveEffectByName("Islands")
-    effect = segmentEditorWidget.activeEffect()
-    effect.setParameter("Operation", 'REMOVE_SMALL_ISLANDS')
-    effect.setParameter("MinimumSize", 500)
-    effect.self().onApply()
+    import temporal_bone_metrics
+    self.metrics = temporal_bone_metrics.RunMetrics(**dict(self.metricsLabels, volume=inputVolume.GetName()))
+    self.metrics.stageListener = self.onStageStarted
+    self._progress = 0
+    self._statisticsRows = []
+    logging.info('Processing started')
+    status = 'failed'
+    try:
+      crops = list(crops or [])
+      if cropToROI and not crops:
+        with self.metrics.stage('crop'):
+          crops = self.cropTemporalBones(inputVolume)
+        if len(crops) == 1:
+          # The other temporal bone would be left out of the outputs
+          logging.warning('Only the %s temporal bone was found, the whole volume is segmented' % crops[0][0])
+          slicer.mrmlScene.RemoveNode(crops[0][1])
+          crops = []
+      if crops:
+        # Voxels the whole volume would have been segmented on, once resampled
+        import temporal_bone_resample
+        fullVoxels = 1
+        for size in temporal_bone_resample.outputShape(inputVolume.GetImageData().GetDimensions()[::-1], inputVolume.GetSpacing(),
+            (REFERENCE_SPACING_MM,)*3):
+          fullVoxels *= int(size)
+        segmentationNodes = []
+        try:
+          for side, cropVolume in crops:
+            sideDirectory = os.path.join(directory, side)
+            if not os.path.exists(sideDirectory):
+              os.makedirs(sideDirectory)
+            segmentationNodes.append(self.segmentVolume(cropVolume, sideDirectory, exportlabelmaps, exportOBJ, medianFilter,
+              exportDICOM, postprocessingEngine, exportMode))
+          if exportlabelmaps==True:
+            with self.metrics.stage('export'):
+              self.exportStructureLabelmaps(segmentationNodes, inputVolume, directory, exportMode)
+          # The crops are resampled in place, so these are the voxels they were segmented on
+          cropVoxels = sum(cropVolume.GetImageData().GetNumberOfPoints() for side, cropVolume in crops)
+        finally:
+          for side, cropVolume in crops:
+            slicer.mrmlScene.RemoveNode(cropVolume)
+        # Wall time and peak memory measured on this run, the peak memory being the highest of the stages
+        metrics = self.metrics.asDict()
+        peaks = [stage['peakMemoryBytes'] for stage in metrics['stages'].values() if stage['peakMemoryBytes']]
+        logging.info('Cropped to %s: segmented %.1f Mvoxels instead of %.1f Mvoxels for the whole volume (%.0f%% fewer '
+          'voxels in every resampled and filtered copy) in %.1f s, peak RSS %s' % (' and '.join(side for side, cropVolume in crops),
+          cropVoxels / 1e6, fullVoxels / 1e6, 100.0 * (1 - float(cropVoxels) / fullVoxels), metrics['wallSeconds'],
+          '%.0f MB' % (max(peaks) / 1e6) if peaks else 'not measured'))
+      else:
+        segmentationNodes = [self.segmentVolume(inputVolume, directory, exportlabelmaps, exportOBJ, medianFilter,
+          exportDICOM, postprocessingEngine, exportMode)]
+
+      # Make segmentation results visible in 3D (there are no views when running headless)
+      if showResult and slicer.app.layoutManager():
+        with self.metrics.stage('display'):
+          for segmentationNode1 in segmentationNodes:
+            segmentationNode1.CreateClosedSurfaceRepresentation()
+
+        layoutManager = slicer.app.layoutManager()
+        threeDWidget = layoutManager.threeDWidget(0)
+        threeDView = threeDWidget.threeDView()
+        threeDView.resetFocalPoint()
+      # Written last, so that a run failing in a later step and retried does not append its rows twice
+      if self.statisticsWriter:
+        with self.metrics.stage('statistics'):
+          self.statisticsWriter.write(self._statisticsRows)
+      status = 'done'
+    except RunCancelled:
+      status = 'cancelled'
+      raise
+    finally:
+      self.metrics.labels['status'] = status
+      self.metrics.finish()
+      if self.metricsJsonLinesPath:
+        self.metrics.writeJsonLines(self.metricsJsonLinesPath)
+      if self.metricsPrometheusPath:
+        self.metrics.writePrometheus(self.metricsPrometheusPath)
+
+    if self.progressCallback:
+      self.progressCallback('done', 100)
+    metrics = self.metrics.asDict()
+    logging.info('Processing completed in %.1f s: %s' % (metrics['wallSeconds'], ', '.join('%s %.1f s' % (name, stage['wallSeconds'])
+      for name, stage in sorted(metrics['stages'].items(), key=lambda item: -item[1]['wallSeconds'])[:8])))
+    return metrics
+
+  def onStageStarted(self, name):
+    """
+    Stage listener of the metrics of run(): stop if cancelled, otherwise report the progress.
+    Also called from the inference threads, for the stages of each model request.
+    """
+    if self.cancelEvent is not None and self.cancelEvent.is_set():
+      raise RunCancelled('Cancelled before stage ' + name)
+    if name.startswith('postprocess:'):
+      progress = self._progress + (RUN_STAGE_PROGRESS['save-volume'] - RUN_STAGE_PROGRESS['inference']) // (len(AIAA_MODEL_EXPORTS) + 1)
+    elif name in RUN_STAGE_PROGRESS:
+      progress = RUN_STAGE_PROGRESS[name]
+    else:
+      return
+    # Cropped volumes go through the stages once per side; progress never goes back
+    self._progress = min(99, max(self._progress, progress))
+    if self.progressCallback:
+      self.progressCallback(name, self._progress)
 
-    if exportlabelmaps==True:
-      # Create labelmap for sigmoid sinus and export the segment
-      sigmoid_labelmap = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLabelMapVolumeNode')
-      sigmoid_labelmap.SetName('sigmoid_labelmap')
-      slicer.modules.segmentations.logic().ExportVisibleSegmentsToLabelmapNode(segmentationNode, sigmoid_labelmap, inputVolume)
-      slicer.util.saveNode(sigmoid_labelmap, directory+'/sigmoid_labelmap.nrrd')
+  def segmentVolume(self, inputVolume, directory, exportlabelmaps=True, exportOBJ=True, medianFilter=True, exportDICOM=True,
+      postprocessingEngine="effects", exportMode="separate"):
+    """
+    Resample the volume in place, segment and post-process the temporal bone structures and
+    export them to directory. Parameters are the same as for run().
+    :return: segmentation node containing the post-processed structures
+    """
+    import time
+    filesBeforeExport = self.fileStats(directory)
+    exportSeconds = 0.0
 
-    if exportOBJ==True:
-      shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
-      segnumber = shNode.GetItemByDataNode(segmentationNode)
-      shNode.SetItemName(segnumber, volumeName+'_sigmoid')
-      segmentIDs = vtk.vtkStringArray()
-      segmentationNode.GetSegmentation().GetSegmentIDs(segmentIDs)
-      slicer.modules.segmentations.logic().ExportSegmentsClosedSurfaceRepresentationToFiles(directory,
-        segmentationNode, segmentIDs, "OBJ", True,  1.0, False)  
-
-	#copy the sigmoid segment to another segmentation Node
-    segmentationNode1.GetSegmentation().CopySegmentFromSegmentation(segmentationNode.GetSegmentation(),sigmoid)
-	
-    # Remove the sigmoid after exporting
-    segmentationNode.GetSegmentation().RemoveSegment(sigmoid)
-
-	# Remove the empty segmentation node
-    slicer.mrmlScene.RemoveNode(segmentationNode)
-	
-	# Export the isotropic volume as nrrd file
-    slicer.util.saveNode(inputVolume, directory+'/Volume.nrrd')
-
-	# Export the isotropic volume as a DICOM series
-    if exportDICOM==True:
-      from datetime import datetime
-      now = datetime.now()
-      patient = now.strftime("%b-%d-%Y_%H-%M-%S")
+    # Perform the temporal bone autosegmentation
+    # resample, once per working spacing, the coarser ones from the input before it is resampled in place
+    volumeName = inputVolume.GetName()
+    levels = {}
+    medians = {}
+    segmentationNode = segmentEditorWidget = store = segmentationNode1 = None
+    completed = False
+    try:
+      with self.metrics.stage('resample'):
+        for spacing in sorted(set(self.workingSpacing.get(modelName, REFERENCE_SPACING_MM) for modelName in AIAA_MODEL_EXPORTS)):
+          if spacing != REFERENCE_SPACING_MM:
+            levels[spacing] = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', '%s_%gmm' % (volumeName, spacing))
+            self.resampleVolume(inputVolume, (spacing,)*3, levels[spacing])
+        self.resampleVolume(inputVolume)
+        levels[REFERENCE_SPACING_MM] = inputVolume
+      # Create segmentation
+      segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode")
+      segmentationNode.CreateDefaultDisplayNodes() # only needed for display
+      segmentationNode.SetReferenceImageGeometryParameterFromVolumeNode(inputVolume)
+      # Create segment editor to get access to effects
+      segmentEditorWidget, segmentEditorNode = self.createSegmentEditor(segmentationNode, inputVolume)
+
+      # Post-processed structures, cropped to their extent until the segmentation node is built at the end
+      import temporal_bone_segmentation_store
+      store = temporal_bone_segmentation_store.SegmentationStore(slicer.util.arrayFromVolume(inputVolume).shape,
+        self.segmentationMemoryBudgetBytes, os.path.join(slicer.app.temporaryPath, 'TemporalBoneSegments'))
+
+      # Each model segments the volume at its working spacing, the facial nerve and sigmoid sinus models
+      # its median filtered version. Each level is filtered once, the facial nerve getting the region of
+      # the filtered level around the temporal bones. Models at the same spacing share the same volume.
+      volumeByModel = {modelName: levels[self.workingSpacing.get(modelName, REFERENCE_SPACING_MM)] for modelName in AIAA_MODEL_EXPORTS}
+      if medianFilter==True:
+        with self.metrics.stage('median'):
+          for modelName in MEDIAN_FILTER_MODELS:
+            level = volumeByModel[modelName]
+            if level.GetID() not in medians:
+              medians[level.GetID()] = self.medianFilterVolume(level)
+            volumeByModel[modelName] = medians[level.GetID()]
+          for modelName in CROPPED_MEDIAN_FILTER_MODELS:
+            level = levels[self.workingSpacing.get(modelName, REFERENCE_SPACING_MM)]
+            if (level.GetID(), 'region') not in medians:
+              medians[(level.GetID(), 'region')] = self.temporalBoneRegionVolume(medians[level.GetID()], level)
+            volumeByModel[modelName] = medians[(level.GetID(), 'region')]
+
+      # Structures exported to directory by a previous run, with the key of their stage and export options
+      # and the (size, modification time) of the files they were written to. A structure whose key is the
+      # same is not exported again, as long as its files are all still there unchanged.
+      import temporal_bone_cache
+      import temporal_bone_inference
+      manifestPath = os.path.join(directory, EXPORT_MANIFEST_NAME)
+      exported = {}
+      if os.path.exists(manifestPath):
+        with open(manifestPath) as manifestFile:
+          exported = json.load(manifestFile)
+      exportedKeys = {name: entry['key'] for name, entry in exported.items() if isinstance(entry, dict) and
+        all(filesBeforeExport.get(os.path.join(directory, fileName)) == tuple(stat) for fileName, stat in entry['files'].items())}
+      exportKeys = {}
+      exportFiles = {name: exported[name]['files'] for name in exportedKeys}
+
+      def writtenFiles(statsBefore):
+        return {os.path.basename(path): list(stat) for path, stat in self.fileStats(directory).items()
+          if statsBefore.get(path) != stat and os.path.basename(path) != EXPORT_MANIFEST_NAME}
+
+      def onResult(modelName, labelmapFile):
+        # Post-process and export each structure as soon as its mask arrives
+        nonlocal exportSeconds
+        masterVolume = volumeByModel[modelName]
+        with self.metrics.stage('postprocess:' + modelName):
+          modelMask = temporal_bone_inference.readNrrdArray(labelmapFile)[0] > 0
+          structureName, mask, key = self.postprocessModelResult(modelName, modelMask, masterVolume,
+            None if postprocessingEngine == "numpy" else (segmentEditorWidget, segmentEditorNode, segmentationNode))
+          if masterVolume.GetSpacing() != inputVolume.GetSpacing():
+            with self.metrics.stage('upsample:' + modelName):
+              mask = self.upsampleMask(mask, masterVolume, inputVolume)
+            masterVolume = inputVolume
+          segmentID = segmentationNode.GetSegmentation().AddEmptySegment(structureName)
+          slicer.util.updateSegmentBinaryLabelmapFromArray(mask.astype('uint8'), segmentationNode, segmentID, masterVolume)
+        segment = segmentationNode.GetSegmentation().GetSegment(segmentID)
+        if modelName in AIAA_MODEL_COLORS:
+          segment.SetColor(*AIAA_MODEL_COLORS[modelName])
+        exportKeys[structureName] = temporal_bone_cache.cacheKey(key, volumeName, exportlabelmaps, exportOBJ,
+          self.meshFormat, exportMode)
+        if exportMode == "separate" and exportedKeys.get(structureName) == exportKeys[structureName]:
+          logging.info('%s did not change, not exported again' % structureName)
+        elif exportMode == "separate":
+          exportStartTime = time.time()
+          labelmapName, objName = AIAA_MODEL_EXPORTS[modelName]
+          statsBefore = self.fileStats(directory)
+          with self.metrics.stage('export'):
+            self.exportStructure(segmentationNode, inputVolume, directory, labelmapName, volumeName+'_'+objName,
+              exportlabelmaps, exportOBJ and self.meshFormat == "obj")
+          exportFiles[structureName] = writtenFiles(statsBefore)
+          exportSeconds += time.time() - exportStartTime
+        # Keep the structure in the store and remove it from the working segmentation
+        store.add(segment.GetName(), slicer.util.arrayFromSegmentBinaryLabelmap(segmentationNode, segmentID, inputVolume) > 0,
+          AIAA_MODEL_COLORS.get(modelName))
+        segmentationNode.GetSegmentation().RemoveSegment(segmentID)
+
+      # The stage includes the post-processing and export of each structure, which overlap the model requests
+      with self.metrics.stage('inference'):
+        self.runInference(volumeByModel, onResult)
+
+      # Remove the empty segmentation node and its editor
+      slicer.mrmlScene.RemoveNode(segmentationNode)
+      segmentationNode = None
+      self.releaseSegmentEditor(segmentEditorWidget, segmentEditorNode)
+      segmentEditorWidget = None
+      if store.spilledBytes:
+        logging.info('Structures over the memory budget: %.1f MB spilled to disk' % (store.spilledBytes / 1e6))
+
+      # One segmentation node for all structures, non-overlapping structures sharing a labelmap
+      segmentationNode1 = self.segmentationNodeFromStore(store, inputVolume)
+      changedNames = [name for name in store.names if exportedKeys.get(name) != exportKeys.get(name)]
+      if exportMode == "combined" and changedNames:
+        exportStartTime = time.time()
+        statsBefore = self.fileStats(directory)
+        with self.metrics.stage('export'):
+          if exportlabelmaps==True:
+            self.saveArrayAsLabelmap(store.packedLabelmap(["otic_capsule" if modelName == "inner_ear" else modelName
+              for modelName in AIAA_MODEL_EXPORTS]), inputVolume, directory+'/structures_labelmap.nrrd')
+          if exportOBJ==True and self.meshFormat == "obj":
+            self.exportStructureModels(segmentationNode1, directory, volumeName+'_structures')
+        # The files hold every structure
+        combinedFiles = writtenFiles(statsBefore)
+        for name in store.names:
+          exportFiles[name] = dict(combinedFiles)
+        exportSeconds += time.time() - exportStartTime
+      if exportOBJ==True and self.meshFormat != "obj" and changedNames:
+        exportStartTime = time.time()
+        with self.metrics.stage('mesh'):
+          records = self.exportStructureMeshes(store, inputVolume, directory, volumeName, changedNames)
+        for record in records:
+          stat = os.stat(record['path'])
+          exportFiles.setdefault(record['structure'], {})[os.path.basename(record['path'])] = [stat.st_size, stat.st_mtime_ns]
+        exportSeconds += time.time() - exportStartTime
+      with open(manifestPath, 'w') as manifestFile:
+        json.dump({name: {'key': key, 'files': exportFiles.get(name, {})} for name, key in exportKeys.items()},
+          manifestFile, indent=2, sort_keys=True)
+      if self.statisticsWriter:
+        with self.metrics.stage('statistics'):
+          self._statisticsRows += self.structureStatistics(store, inputVolume)
+      filesAfterExport = self.fileStats(directory)
+      writtenFiles = [path for path, stat in filesAfterExport.items() if filesBeforeExport.get(path) != stat]
+      logging.info('Structure export (%s): %d files, %.1f MB in %.2f s' % (exportMode, len(writtenFiles),
+        sum(filesAfterExport[path][0] for path in writtenFiles) / 1e6, exportSeconds))
+
+      # Export the isotropic volume as nrrd file
+      with self.metrics.stage('save-volume'):
+        slicer.util.saveNode(inputVolume, directory+'/Volume.nrrd')
+
+      # Export the isotropic volume as a DICOM series
+      if exportDICOM==True:
+        with self.metrics.stage('dicom'):
+          self.exportVolumeDICOM(inputVolume, directory, store)
+      completed = True
+    finally:
+      # Also on failure or cancellation, so that the long-lived service does not accumulate nodes and spilled masks
+      if segmentEditorWidget is not None:
+        self.releaseSegmentEditor(segmentEditorWidget, segmentEditorNode)
+      if segmentationNode is not None:
+        slicer.mrmlScene.RemoveNode(segmentationNode)
+      if segmentationNode1 is not None and not completed:
+        slicer.mrmlScene.RemoveNode(segmentationNode1)
+      if store is not None:
+        store.close()
+      # A region node may be its median itself, when the temporal bones fill the volume
+      for volumeNode in set(medians.values()) | set(level for level in levels.values() if level is not inputVolume):
+        slicer.mrmlScene.RemoveNode(volumeNode)
+
+    return segmentationNode1
+
+  def upsampleMask(self, mask, maskVolume, referenceVolume):
+    """
+    Mask in the geometry of maskVolume, segmented at a coarser working spacing, resampled onto the grid of
+    referenceVolume (same axes) with temporal_bone_resample.upsampleMask.
+    :return: boolean array in the geometry of referenceVolume
+    """
+    import temporal_bone_resample
+    rasToIJK = vtk.vtkMatrix4x4()
+    referenceVolume.GetRASToIJKMatrix(rasToIJK)
+    ijkToRAS = vtk.vtkMatrix4x4()
+    maskVolume.GetIJKToRASMatrix(ijkToRAS)
+    # Position of the first voxel of the mask in the voxels of the reference volume
+    origin = rasToIJK.MultiplyPoint(ijkToRAS.MultiplyPoint([0, 0, 0, 1]))[:3]
+    spacingRatio = [maskSpacing / referenceSpacing for maskSpacing, referenceSpacing in zip(maskVolume.GetSpacing(), referenceVolume.GetSpacing())]
+    return temporal_bone_resample.upsampleMask(mask, spacingRatio[::-1], origin[::-1], slicer.util.arrayFromVolume(referenceVolume).shape)
+
+  def medianFilterVolume(self, inputVolume):
+    """
+    Median filter (3x3x3 neighborhood) of the volume, as a new volume node.
+    The filter writes straight into the image of the new node, the input is not cloned first.
+    """
+    import temporal_bone_postprocessing
+    median = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', 'Volume_median_filter')
+    ijkToRAS = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRAS)
+    median.SetIJKToRASMatrix(ijkToRAS)
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(inputVolume.GetImageData().GetDimensions())
+    imageData.AllocateScalars(inputVolume.GetImageData().GetScalarType(), 1)
+    median.SetAndObserveImageData(imageData)
+    temporal_bone_postprocessing.medianFilterVolume(slicer.util.arrayFromVolume(inputVolume), out=slicer.util.arrayFromVolume(median))
+    slicer.util.arrayFromVolumeModified(median)
+    median.CreateDefaultDisplayNodes()
+    return median
+
+  def temporalBoneRegionVolume(self, volumeNode, referenceVolume=None):
+    """
+    Region of the volume around both temporal bones, as a new volume node holding a copy of that region only.
+    :param referenceVolume: volume of the same geometry the temporal bones are found in, volumeNode by default,
+      such as the unfiltered volume of a median filtered one
+    :return: the new node, or volumeNode itself when the temporal bones are not found or already fill it
+    """
+    import temporal_bone_roi
+    volumeArray = slicer.util.arrayFromVolume(volumeNode)
+    referenceVolume = referenceVolume or volumeNode
+    boxes = temporal_bone_roi.findTemporalBoneBoxes(slicer.util.arrayFromVolume(referenceVolume), referenceVolume.GetSpacing())
+    if not boxes:
+      return volumeNode
+    # One region enclosing both sides, so that each model is still requested once
+    box = tuple(slice(min(b[axis].start for b in boxes), max(b[axis].stop for b in boxes)) for axis in range(3))
+    if all(s.start == 0 and s.stop == size for s, size in zip(box, volumeArray.shape)):
+      return volumeNode
+    region = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode', volumeNode.GetName() + '_region')
+    region.SetIJKToRASMatrix(self.boxIJKToRAS(volumeNode, box))
+    slicer.util.updateVolumeFromArray(region, volumeArray[box].copy())
+    region.CreateDefaultDisplayNodes()
+    logging.info('Temporal bone region: %.1f%% of the volume' % (100.0 * region.GetImageData().GetNumberOfPoints() / volumeArray.size))
+    return region
+
+  def exportVolumeDICOM(self, volumeNode, directory, store=None):
+    """
+    Export the volume as a DICOM series in directory, under a new patient named after the current time.
+    With dicomSegmentation, the structures of store (a temporal_bone_segmentation_store.SegmentationStore)
+    are exported too, as a DICOM Segmentation object.
+    """
+    from datetime import datetime
+    now = datetime.now()
+    patient = now.strftime("%b-%d-%Y_%H-%M-%S")
+    startTime = time.time()
 
+    if self.dicomFormat == "slicer":
       # Create patient and study and put the volume under the study
       shNode = slicer.vtkMRMLSubjectHierarchyNode.GetSubjectHierarchyNode(slicer.mrmlScene)
       patientItemID = shNode.CreateSubjectItem(shNode.GetSceneItemID(), patient)
       studyItemID = shNode.CreateStudyItem(patientItemID, "Auto-segmentation Study")
-      volumeShItemID = shNode.GetItemByDataNode(inputVolume)
+      volumeShItemID = shNode.GetItemByDataNode(volumeNode)
       shNode.SetItemParent(volumeShItemID, studyItemID)
 
       import DICOMScalarVolumePlugin
@@ -531,19 +1578,32 @@ class TemporalBoneAutosegmentationLogic(ScriptedLoadableModuleLogic):
         exp.directory = directory
 
       exporter.export(exportables)
+      if self.dicomSegmentation:
+        logging.warning('DICOM Segmentation export needs the classic or enhanced DICOM format')
+      logging.info('DICOM export (slicer): %.2f s' % (time.time() - startTime))
+      return
 
-    # Make segmentation results visible in 3D
-    segmentationNode1.CreateClosedSurfaceRepresentation()
-
-    layoutManager = slicer.app.layoutManager()
-    threeDWidget = layoutManager.threeDWidget(0)
-    threeDView = threeDWidget.threeDView()
-    threeDView.resetFocalPoint()
-    
-    # Remove volume 
-    #slicer.mrmlScene.RemoveNode(median)
-
-    #saveNode(inputVolume, directory+'/inputVolume.nrrd')
-    #slicer.mrmlScene.RemoveNode(segmentationNode)
-    #print(path)
-    logging.info('Processing completed')
+    # Written straight from the voxel arrays, the scene is left as it is
+    import temporal_bone_dicom
+    study = temporal_bone_dicom.newStudy(patient)
+    volumeArray = slicer.util.arrayFromVolume(volumeNode)
+    ijkToRAS = vtk.vtkMatrix4x4()
+    volumeNode.GetIJKToRASMatrix(ijkToRAS)
+    ijkToRAS = slicer.util.arrayFromVTKMatrix(ijkToRAS)
+    if self.dicomFormat == "enhanced":
+      result = temporal_bone_dicom.writeEnhancedCT(volumeArray, ijkToRAS, os.path.join(directory, 'EnhancedCT.dcm'), study)
+    elif self.dicomFormat == "classic":
+      result = temporal_bone_dicom.writeClassicSeries(volumeArray, ijkToRAS, directory, study)
+    else:
+      raise ValueError("Unknown DICOM format: " + self.dicomFormat)
+    files, totalBytes = result['files'], result['bytes']
+    if self.dicomSegmentation and store is not None:
+      segments = [(name, store.croppedMask(name), store.box(name)) for name in store.names]
+      segmentation = temporal_bone_dicom.writeSegmentation(segments, volumeArray.shape, ijkToRAS,
+        os.path.join(directory, 'Segmentation.dcm'), study, result)
+      files += segmentation['files']
+      totalBytes += segmentation['bytes']
+    self.metrics.increment('dicomFiles', files)
+    self.metrics.increment('dicomBytes', totalBytes)
+    logging.info('DICOM export (%s): %d files, %.1f MB in %.2f s' % (self.dicomFormat, files, totalBytes / 1e6,
+      time.time() - startTime))
@@ -0,0 +1,156 @@
+"""
+Shape and intensity statistics of segmented structures, computed from their mask arrays.
+
+Gives for each structure the measurements the cochlear duct script used to get from
+SegmentStatistics (voxel count, volume, intensity minimum, maximum, mean, median and
+standard deviation), with the voxel surface area, bounding box and centroid, without
+table nodes or the GUI. Statistics of a whole cohort are appended by StatisticsWriter
+to a single CSV file, or a Parquet file when pyarrow is available. Parquet files are
+written by one process, so each worker of a batch writes its own part file and the
+parts are merged with mergeParquetParts.
+
+Arrays are in KJI order and spacing is in IJK order. Surface area is the area of the
+voxel faces between the structure and the background, larger than the area of a
+smoothed closed surface.
+"""
+
+import csv
+import io
+import os
+
+import numpy as np
+
+from temporal_bone_postprocessing import _boundingBox
+
+# Columns of the cohort statistics file, keys of the rows of structureStatistics
+STATISTICS_COLUMNS = ['volume', 'structure', 'voxel_count', 'volume_mm3', 'volume_cm3', 'surface_area_mm2',
+  'bbox_min_i', 'bbox_min_j', 'bbox_min_k', 'bbox_max_i', 'bbox_max_j', 'bbox_max_k',
+  'centroid_r', 'centroid_a', 'centroid_s', 'min', 'max', 'mean', 'median', 'stdev']
+# Parquet type of the text and integer columns, the others are floating point. The types are fixed
+# rather than inferred, as the values of an empty structure are None.
+TEXT_COLUMNS = ('volume', 'structure')
+INTEGER_COLUMNS = ('voxel_count', 'bbox_min_i', 'bbox_min_j', 'bbox_min_k', 'bbox_max_i', 'bbox_max_j', 'bbox_max_k')
+
+
+def structureStatistics(mask, spacing, ijkToRAS=None, volumeArray=None, offset=(0, 0, 0)):
+  """
+  Statistics of one structure.
+  :param mask: boolean KJI mask, may be cropped from the volume
+  :param spacing: IJK spacing in mm
+  :param ijkToRAS: 4x4 IJK to RAS matrix of the volume, the centroid is in IJK when None
+  :param volumeArray: intensities of the voxels of mask (same shape), for the intensity statistics
+  :param offset: KJI index in the volume of the first voxel of mask
+  :return: dict of the statistics columns, None for the values of an empty structure
+  """
+  row = dict.fromkeys(STATISTICS_COLUMNS[2:])
+  row.update(voxel_count=0, volume_mm3=0.0, volume_cm3=0.0, surface_area_mm2=0.0)
+  box = _boundingBox(mask, (0, 0, 0))
+  if box is None:
+    return row
+  local = mask[box]
+  spacingKJI = np.asarray(spacing, dtype=float)[::-1]
+
+  # Voxels per plane along each axis give the count and the centroid without listing the voxels
+  planeCounts = [local.sum(axis=tuple(a for a in range(3) if a != axis), dtype=np.int64) for axis in range(3)]
+  count = int(planeCounts[0].sum())
+  volume = count * float(np.prod(spacingKJI))
+  start = [o + s.start for o, s in zip(offset, box)]
+  centroidKJI = [first + float(np.dot(np.arange(len(counts)), counts)) / count for first, counts in zip(start, planeCounts)]
+  centroid = [centroidKJI[2], centroidKJI[1], centroidKJI[0]]
+  if ijkToRAS is not None:
+    centroid = list(np.dot(np.asarray(ijkToRAS, dtype=float), centroid + [1.0])[:3])
+
+  # Faces between the structure and the background, along each axis
+  padded = np.pad(local, 1)
+  area = 0.0
+  for axis in range(3):
+    before = [slice(None)] * 3
+    after = [slice(None)] * 3
+    before[axis] = slice(None, -1)
+    after[axis] = slice(1, None)
+    faces = np.count_nonzero(padded[tuple(before)] != padded[tuple(after)])
+    area += faces * float(np.prod(np.delete(spacingKJI, axis)))
+
+  row.update(voxel_count=count, volume_mm3=volume, volume_cm3=volume / 1000.0, surface_area_mm2=area,
+    bbox_min_i=start[2], bbox_min_j=start[1], bbox_min_k=start[0],
+    bbox_max_i=start[2] + local.shape[2] - 1, bbox_max_j=start[1] + local.shape[1] - 1, bbox_max_k=start[0] + local.shape[0] - 1,
+    centroid_r=centroid[0], centroid_a=centroid[1], centroid_s=centroid[2])
+  if volumeArray is not None:
+    values = volumeArray[box][local]
+    row.update({'min': float(values.min()), 'max': float(values.max()), 'mean': float(values.mean()),
+      'median': float(np.median(values)), 'stdev': float(values.std())})
+  return row
+
+
+class StatisticsWriter:
+  """
+  Cohort statistics file receiving the rows of each volume as it is processed.
+  CSV files get their header when the writer is created, if they have none yet, and rows are
+  appended with a single write per call. Several processes can share one once it has its header,
+  so create a writer before starting them. Parquet files (path ending in .parquet, requires
+  pyarrow) get a row group per call; the rows of an existing file are kept, and the file is
+  complete once the writer is closed. A Parquet file has a single writer at a time.
+  """
+
+  def __init__(self, path, columns=STATISTICS_COLUMNS):
+    self.path = path
+    self.columns = list(columns)
+    self.parquet = path.endswith('.parquet')
+    self._parquetWriter = None
+    if not self.parquet and (not os.path.exists(path) or os.path.getsize(path) == 0):
+      with open(path, 'w') as csvFile:
+        csv.DictWriter(csvFile, self.columns, lineterminator='\n').writeheader()
+
+  def write(self, rows):
+    """
+    Append rows, dicts keyed by column name.
+    """
+    if not rows:
+      return
+    if self.parquet:
+      self._writeParquet(rows)
+      return
+    text = io.StringIO()
+    writer = csv.DictWriter(text, self.columns, extrasaction='ignore', lineterminator='\n')
+    writer.writerows(rows)
+    fileDescriptor = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+      os.write(fileDescriptor, text.getvalue().encode('utf-8'))
+    finally:
+      os.close(fileDescriptor)
+
+  def _writeParquet(self, rows):
+    import pyarrow
+    import pyarrow.parquet
+    schema = pyarrow.schema([(column, pyarrow.string() if column in TEXT_COLUMNS else
+      pyarrow.int64() if column in INTEGER_COLUMNS else pyarrow.float64()) for column in self.columns])
+    table = pyarrow.Table.from_pylist([{column: row.get(column) for column in self.columns} for row in rows], schema)
+    if self._parquetWriter is None:
+      previous = pyarrow.parquet.read_table(self.path) if os.path.exists(self.path) else None
+      if previous is not None:
+        table = pyarrow.concat_tables([previous, table.cast(previous.schema)])
+      self._temporaryPath = self.path + '.%d.tmp' % os.getpid()
+      self._parquetWriter = pyarrow.parquet.ParquetWriter(self._temporaryPath, table.schema)
+    self._parquetWriter.write_table(table.cast(self._parquetWriter.schema))
+
+  def close(self):
+    if self._parquetWriter is not None:
+      self._parquetWriter.close()
+      os.replace(self._temporaryPath, self.path)
+      self._parquetWriter = None
+
+
+def mergeParquetParts(path, partPaths):
+  """
+  Append the rows of Parquet part files, such as those of the workers of a batch, to the Parquet
+  file path, and delete the parts once it is complete.
+  """
+  import pyarrow.parquet
+  if not partPaths:
+    return
+  writer = StatisticsWriter(path)
+  for partPath in partPaths:
+    writer.write(pyarrow.parquet.read_table(partPath).to_pylist())
+  writer.close()
+  for partPath in partPaths:
+    os.remove(partPath)